@@ -1,4 +1,5 @@
-from graphene_django.views import GraphQLView
+from django.http import HttpResponseBadRequest
+from graphene_django.views import GraphQLView, HttpError
 import json
 
 from graphene_file_upload.django import FileUploadGraphQLView
@@ -6,6 +7,14 @@ from strawberry.django.views import AsyncGraphQLView
 
 
 class CustomGraphQLView(FileUploadGraphQLView):
+    def parse_body(self, request):
+        if request.content_type == 'multipart/form-data':
+            # Разбор тела через AvatarUploadHandler: отклоненный файл обрывает загрузку
+            request.FILES
+            if getattr(request, '_upload_error', None):
+                raise HttpError(HttpResponseBadRequest(request._upload_error))
+        return super().parse_body(request)
+
     def dispatch(self, request, *args, **kwargs):
         response = super().dispatch(request, *args, **kwargs)
         if hasattr(request, "_access_token") and hasattr(request, "_refresh_token"):
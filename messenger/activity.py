@@ -0,0 +1,27 @@
+from django.db.models import F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from messenger.models import Chatroom, Message
+
+
+def touch_chatroom(message):
+    # Новое сообщение становится превью чата и поднимает чат в списке
+    return Chatroom.objects.filter(id=message.chatroom_id) \
+        .update(last_message=message, last_activity_at=message.created_at)
+
+
+def refresh_last_message(queryset):
+    """
+    Заново выбирает последнее сообщение чатов одним UPDATE с подзапросом.
+    Чат без сообщений остается без превью, активность - время создания чата.
+    """
+    latest = Message.objects.filter(chatroom_id=OuterRef('pk')).order_by('-created_at', '-id')
+    return queryset.update(
+        last_message=Subquery(latest.values('id')[:1]),
+        last_activity_at=Coalesce(Subquery(latest.values('created_at')[:1]), F('created_at')),
+    )
+
+
+def refresh_after_delete(chatroom_id):
+    # Удаление последнего сообщения обнуляет ссылку (SET_NULL), тогда превью берем из оставшихся
+    return refresh_last_message(Chatroom.objects.filter(id=chatroom_id, last_message__isnull=True))
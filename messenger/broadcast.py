@@ -0,0 +1,139 @@
+import asyncio
+
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+
+class InMemoryBroadcast:
+    """Доставляет сообщения только подписчикам текущего процесса"""
+
+    def __init__(self, deliver, deliver_membership=None, group=None):
+        self.deliver = deliver
+        self.deliver_membership = deliver_membership
+
+    async def start(self):
+        pass
+
+    async def stop(self):
+        pass
+
+    async def publish(self, chatroom_id, payload):
+        await self.deliver(chatroom_id, payload)
+
+    async def publish_membership(self, chatroom_id, added_user_ids, removed_user_ids, deleted=False):
+        if self.deliver_membership is not None:
+            self.deliver_membership(chatroom_id, added_user_ids, removed_user_ids, deleted)
+
+
+class ChannelLayerBroadcast:
+    """
+    Рассылает сообщения между воркерами через channel layer (channels_redis).
+    Каждый воркер слушает общую группу и доставляет сообщения своим локальным очередям.
+    """
+
+    def __init__(self, deliver, deliver_membership=None, layer=None, alias='default', group='messenger.broadcast',
+                 refresh_interval=3600, retry_interval=1):
+        self.deliver = deliver
+        self.deliver_membership = deliver_membership
+        self.alias = alias
+        self.group = group
+        self.refresh_interval = refresh_interval
+        self.retry_interval = retry_interval
+        self._layer = layer
+        self._channel = None
+        self._reader = None
+        self._refresher = None
+        self._lock = None
+
+    @property
+    def layer(self):
+        if self._layer is None:
+            self._layer = get_channel_layer(self.alias)
+            if self._layer is None:
+                raise ImproperlyConfigured(f"Channel layer '{self.alias}' is not configured in CHANNEL_LAYERS")
+        return self._layer
+
+    async def start(self):
+        # Подписываемся на группу один раз на процесс, при первом подписчике.
+        # Подписки стартуют одновременно, поэтому канал создается под блокировкой
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self._reader is not None and not self._reader.done():
+                return
+            self._channel = await self.layer.new_channel()
+            await self.layer.group_add(self.group, self._channel)
+            self._reader = asyncio.create_task(self._read())
+            self._refresher = asyncio.create_task(self._refresh())
+
+    async def stop(self):
+        for task in (self._reader, self._refresher):
+            if task is not None:
+                task.cancel()
+        if self._channel is not None:
+            await self.layer.group_discard(self.group, self._channel)
+        self._reader = self._refresher = self._channel = None
+
+    async def publish(self, chatroom_id, payload):
+        # payload уже сериализован один раз, воркерам не нужно заново читать сообщение из базы
+        await self.layer.group_send(self.group, {
+            'type': 'chatroom.message',
+            'chatroom_id': chatroom_id,
+            'payload': payload,
+        })
+
+    async def publish_membership(self, chatroom_id, added_user_ids, removed_user_ids, deleted=False):
+        # Изменения участников тоже расходятся по всем воркерам: подписки пользователя могут быть на любом
+        await self.layer.group_send(self.group, {
+            'type': 'chatroom.membership',
+            'chatroom_id': chatroom_id,
+            'added_user_ids': list(added_user_ids),
+            'removed_user_ids': list(removed_user_ids),
+            'deleted': deleted,
+        })
+
+    async def _read(self):
+        while True:
+            try:
+                event = await self.layer.receive(self._channel)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # Брокер недоступен: ждем и заново входим в группу, чтобы не потерять подписчиков
+                print(f"Error receiving broadcast events: {e}")
+                await asyncio.sleep(self.retry_interval)
+                try:
+                    await self.layer.group_add(self.group, self._channel)
+                except Exception as e:
+                    print(f"Error rejoining broadcast group: {e}")
+                continue
+            try:
+                if event['type'] == 'chatroom.membership':
+                    if self.deliver_membership is not None:
+                        self.deliver_membership(event['chatroom_id'], event['added_user_ids'],
+                                                event['removed_user_ids'], event['deleted'])
+                    continue
+                await self.deliver(event['chatroom_id'], event['payload'])
+            except Exception as e:
+                print(f"Error delivering broadcast event {event}: {e}")
+
+    async def _refresh(self):
+        # Членство в группе у channels_redis истекает через group_expiry, продлеваем его
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await self.layer.group_add(self.group, self._channel)
+            except Exception as e:
+                print(f"Error refreshing broadcast group: {e}")
+
+
+def get_broadcast_backend(deliver, deliver_membership=None, group=None):
+    # group - отдельная группа для другого вида событий, чтобы воркеры не путали их с сообщениями
+    config = getattr(settings, 'MESSENGER_BROADCAST', {})
+    backend_class = import_string(config.get('BACKEND', 'messenger.broadcast.InMemoryBroadcast'))
+    options = dict(config.get('OPTIONS', {}))
+    if group is not None:
+        options['group'] = group
+    return backend_class(deliver, deliver_membership, **options)
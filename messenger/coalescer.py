@@ -0,0 +1,92 @@
+import asyncio
+
+
+class Coalescer:
+    """
+    Склеивает всплеск событий в одну отправку. События с одинаковым ключом внутри окна
+    сливаются через merge (по умолчанию остается последнее значение), по истечении окна
+    flush получает dict {ключ: значение}. Работает в цикле событий, add() вызывается из него же.
+    """
+
+    def __init__(self, flush, window, merge=None):
+        self.flush = flush
+        self.window = window
+        self.merge = merge
+        self.pending = {}
+        self._timer = None
+
+    def add(self, key, value):
+        if key in self.pending and self.merge is not None:
+            value = self.merge(self.pending[key], value)
+        self.pending[key] = value
+        if self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.window, self._flush)
+
+    def _flush(self):
+        items, self.pending, self._timer = self.pending, {}, None
+        if items:
+            asyncio.get_running_loop().create_task(self._send(items))
+
+    async def _send(self, items):
+        try:
+            await self.flush(items)
+        except Exception as e:
+            print(f"Error flushing {len(items)} coalesced events: {e}")
+
+    async def drain(self):
+        """Отправляет накопленное сразу, не дожидаясь окна"""
+        if self._timer is not None:
+            self._timer.cancel()
+        items, self.pending, self._timer = self.pending, {}, None
+        if items:
+            await self._send(items)
+
+
+class WriteBatcher:
+    """
+    Собирает одновременные записи в одну пачку. submit() ждет результата своей записи,
+    flush получает список записей окна и возвращает результаты в том же порядке;
+    исключение на месте результата достается только отправителю этой записи.
+    Пачка уходит по истечении окна или сразу, когда набралось max_size записей.
+    """
+
+    def __init__(self, flush, window, max_size=None):
+        self.flush = flush
+        self.window = window
+        self.max_size = max_size
+        self.pending = []
+        self._timer = None
+
+    async def submit(self, item):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self.pending.append((item, future))
+        if self.max_size and len(self.pending) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+        batch, self.pending, self._timer = self.pending, [], None
+        if batch:
+            asyncio.get_running_loop().create_task(self._write(batch))
+
+    async def _write(self, batch):
+        try:
+            results = await self.flush([item for item, _ in batch])
+        except Exception as e:
+            # flush не разобрал ошибку по записям: она общая для всей пачки
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
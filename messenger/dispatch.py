@@ -0,0 +1,76 @@
+import asyncio
+from collections import defaultdict
+
+
+class EventDispatcher:
+    """
+    Очередь событий для подписок. dispatch() не блокирует и вызывается как из синхронных
+    резолверов (в потоке запроса), так и из асинхронных. Рассылку подписчикам выполняет
+    фоновая задача в цикле событий, к которому подключены подписки.
+    """
+
+    def __init__(self):
+        self._handlers = defaultdict(list)
+        self._loop = None
+        self._pending = None
+        self._worker = None
+
+    def register(self, kind, handler):
+        self._handlers[kind].append(handler)
+
+    def start(self):
+        # Вызывается из подписки, то есть внутри цикла событий, которому принадлежат очереди
+        loop = asyncio.get_running_loop()
+        if self._loop is loop and self._worker is not None and not self._worker.done():
+            return
+        self._loop = loop
+        self._pending = asyncio.Queue()
+        self._worker = loop.create_task(self._drain())
+
+    def dispatch(self, kind, payload):
+        """Возвращает False, если событие некуда доставить: в процессе нет цикла подписок"""
+        loop, pending = self._loop, self._pending
+        if loop is None or loop.is_closed():
+            # В этом процессе еще нет подписчиков, доставлять некому
+            return False
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if running_loop is loop:
+            pending.put_nowait((kind, payload))
+        else:
+            try:
+                loop.call_soon_threadsafe(pending.put_nowait, (kind, payload))
+            except RuntimeError:
+                return False  # цикл событий остановлен
+        return True
+
+    async def stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+        self._loop = self._pending = self._worker = None
+
+    async def join(self):
+        """Ждет, пока все поставленные события будут разосланы"""
+        if self._pending is not None:
+            await self._pending.join()
+
+    async def _drain(self):
+        while True:
+            kind, payload = await self._pending.get()
+            try:
+                for handler in self._handlers[kind]:
+                    try:
+                        handler(payload)
+                    except Exception as e:
+                        print(f"Error dispatching {kind} event: {e}")
+            finally:
+                self._pending.task_done()
+
+
+event_dispatcher = EventDispatcher()
@@ -6,15 +6,17 @@ from graphene_django.types import DjangoObjectType
 from graphene_file_upload.scalars import Upload
 
 from myproject.context import get_context
+from .loaders import get_loaders
 from .models import User, Chat, Chatroom, Favorite, Message
+from .thumbnails import thumbnail_urls
 from .resolvers.message_resolver import resolve_send_message
 
 from .resolvers.user_resolver import resolve_users, resolve_user_by_id, resolve_user_register, resolve_user_login, \
     resolve_update_user, resolve_re_login, resolve_get_users_per_query
-from .resolvers.chatroom_resolver import resolve_user_chatrooms, \
+from .resolvers.chatroom_resolver import resolve_user_chatrooms, resolve_user_chatrooms_by_activity, \
     resolve_chatroom_create, resolve_favorite_create, resolve_chat_create, \
     resolve_filter_chatroom, resolve_filter_not_created_chats, resolve_chatroom_delete, resolve_chatroom_update, \
-    resolve_chatroom_by_name
+    resolve_chatroom_by_name, resolve_mark_read
 
 
 class UserType(DjangoObjectType):
@@ -22,16 +24,39 @@ class UserType(DjangoObjectType):
         model = User
         fields = ('id', 'name', 'email', 'avatar', 'chatroom', 'password', 'created_at', 'updated_at')
 
+    chatroom = graphene.List(lambda: ChatroomType)
+    avatar_thumbnails = graphene.List(lambda: AvatarThumbnailType)
+
+    def resolve_chatroom(self, info):
+        return get_loaders(info).user_chatrooms.load(self.pk)
+
+    def resolve_avatar_thumbnails(self, info):
+        return [AvatarThumbnailType(size=size, url=url) for size, url in thumbnail_urls(self.avatar)]
+
 
 class ChatroomType(DjangoObjectType):
     class Meta:
         model = Chatroom
-        fields = ('id', 'name', 'participants', 'avatar', 'max_participants', 'created_at', 'updated_at')
+        fields = ('id', 'name', 'participants', 'avatar', 'max_participants', 'last_message', 'last_activity_at',
+                  'created_at', 'updated_at')
 
     participants = graphene.List(lambda: UserType)
+    unread_messages = graphene.Field(lambda: MessagesCountType)
+    last_message = graphene.Field(lambda: MessageType)
+    avatar_thumbnails = graphene.List(lambda: AvatarThumbnailType)
 
     def resolve_participants(self, info):
-        return self.participants.all()
+        return get_loaders(info).participants.load(self.pk)
+
+    def resolve_avatar_thumbnails(self, info):
+        return [AvatarThumbnailType(size=size, url=url) for size, url in thumbnail_urls(self.avatar)]
+
+    def resolve_last_message(self, info):
+        return get_loaders(info).messages.load(self.last_message_id) if self.last_message_id else None
+
+    def resolve_unread_messages(self, info):
+        # Счетчик добавляется к чатам подзапросом в резолвере списка
+        return MessagesCountType(count=getattr(self, 'unread_count', 0))
 
 
 class ChatType(DjangoObjectType):
@@ -42,7 +67,7 @@ class ChatType(DjangoObjectType):
     participants = graphene.List(lambda: UserType)
 
     def resolve_participants(self, info):
-        return self.participants.all()
+        return get_loaders(info).participants.load(self.pk)
 
 
 class FavoriteType(DjangoObjectType):
@@ -53,7 +78,7 @@ class FavoriteType(DjangoObjectType):
     participants = graphene.List(lambda: UserType)
 
     def resolve_participants(self, info):
-        return self.participants.all()
+        return get_loaders(info).participants.load(self.pk)
 
 
 class MessageType(DjangoObjectType):
@@ -65,14 +90,16 @@ class MessageType(DjangoObjectType):
     chatroom = graphene.Field(ChatroomType)
 
     def resolve_user(self, info):
-        if not self.user:
+        user = get_loaders(info).users.load(self.user_id)
+        if not user:
             raise Exception("User is not assigned")
-        return self.user
+        return user
 
     def resolve_chatroom(self, info):
-        if not self.chatroom:
+        chatroom = get_loaders(info).chatrooms.load(self.chatroom_id) if self.chatroom_id else None
+        if not chatroom:
             raise Exception("Chatroom does not exist")
-        return self.chatroom
+        return chatroom
 
 
 class UserRegisterType(graphene.InputObjectType):
@@ -121,6 +148,11 @@ class MessagesCountType(graphene.ObjectType):
     count = graphene.Int()
 
 
+class AvatarThumbnailType(graphene.ObjectType):
+    size = graphene.Int()
+    url = graphene.String()
+
+
 class Query(graphene.ObjectType):
     users = graphene.List(UserType, resolver=resolve_users)
     user = graphene.Field(UserType, id=graphene.Int(), resolver=resolve_user_by_id)
@@ -129,6 +161,8 @@ class Query(graphene.ObjectType):
                                                       resolver=resolve_filter_not_created_chats)
 
     user_chatrooms = graphene.List(ChatroomType, resolver=resolve_user_chatrooms)
+    user_chatrooms_by_activity = graphene.List(ChatroomType, before_id=graphene.Int(), limit=graphene.Int(),
+                                               resolver=resolve_user_chatrooms_by_activity)
     chatroom = graphene.Field(ChatroomType, name=graphene.String(), resolver=resolve_chatroom_by_name)
     filtered_chatrooms = graphene.List(ChatroomType, total=graphene.Int(),
                                        search_query=graphene.String(),
@@ -161,6 +195,9 @@ class Mutation(graphene.ObjectType):
     chatroom_delete = graphene.Field(ChatroomType, id=graphene.Int(),
                                      required=True,
                                      resolver=resolve_chatroom_delete)
+    mark_read = graphene.Field(MessagesCountType, chatroom_id=graphene.Int(), up_to=graphene.Int(),
+                               required=True,
+                               resolver=resolve_mark_read)
 
 
 graphene_schema = graphene.Schema(query=Query, mutation=Mutation)
\ No newline at end of file
@@ -0,0 +1,90 @@
+from collections import defaultdict
+
+from messenger.models import User, Chatroom, Message
+
+
+class BatchLoader:
+    """
+    Синхронный загрузчик на время одного запроса.
+    Graphene выполняет запрос синхронно и обходит элементы списка по очереди, поэтому ключи
+    заранее регистрируются через prime(), а первый load() загружает их все одним запросом.
+    """
+
+    def __init__(self, batch_load, default=None):
+        self.batch_load = batch_load
+        self.default = default
+        self.cache = {}
+        self.pending = set()
+
+    def prime(self, keys):
+        self.pending.update(key for key in keys if key is not None and key not in self.cache)
+
+    def load(self, key):
+        if key not in self.cache:
+            self.pending.add(key)
+            keys = list(self.pending)
+            self.pending.clear()
+            loaded = self.batch_load(keys)
+            for loaded_key in keys:
+                self.cache[loaded_key] = loaded.get(loaded_key, self.default() if self.default else None)
+        return self.cache[key]
+
+
+def load_users(user_ids):
+    return User.objects.in_bulk(user_ids)
+
+
+def load_chatrooms(chatroom_ids):
+    return Chatroom.objects.in_bulk(chatroom_ids)
+
+
+def load_participants(chatroom_ids):
+    participants = defaultdict(list)
+    links = Chatroom.participants.through.objects.filter(chatroom_id__in=chatroom_ids).select_related('user')
+    for link in links:
+        participants[link.chatroom_id].append(link.user)
+    return participants
+
+
+def load_user_chatrooms(user_ids):
+    chatrooms = defaultdict(list)
+    links = User.chatroom.through.objects.filter(user_id__in=user_ids).select_related('chatroom')
+    for link in links:
+        chatrooms[link.user_id].append(link.chatroom)
+    return chatrooms
+
+
+class Loaders:
+    def __init__(self):
+        self.users = BatchLoader(load_users)
+        self.chatrooms = BatchLoader(load_chatrooms)
+        self.participants = BatchLoader(load_participants, default=list)
+        self.user_chatrooms = BatchLoader(load_user_chatrooms, default=list)
+        self.messages = BatchLoader(self.load_messages)
+
+    def load_messages(self, message_ids):
+        messages = Message.objects.in_bulk(message_ids)
+        # Авторы и чаты превью загружаются следующей пачкой, а не по одному на сообщение
+        self.prime(messages.values())
+        return messages
+
+    def prime(self, objects):
+        """Регистрирует связи всех объектов списка до того, как graphene начнет их обходить"""
+        for obj in objects:
+            if isinstance(obj, Chatroom):
+                self.participants.prime([obj.pk])
+                # Отложенную колонку не читаем, иначе Django догрузит ее запросом на каждый чат
+                self.messages.prime([obj.__dict__.get('last_message_id')])
+            elif isinstance(obj, User):
+                self.user_chatrooms.prime([obj.pk])
+            elif isinstance(obj, Message):
+                self.users.prime([obj.user_id])
+                self.chatrooms.prime([obj.chatroom_id])
+
+
+def get_loaders(info):
+    # Загрузчики живут на объекте запроса, кэш не переживает запрос
+    request = info.context
+    if not hasattr(request, '_loaders'):
+        request._loaders = Loaders()
+    return request._loaders
@@ -0,0 +1,82 @@
+import asyncio
+import logging
+import time
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+from strawberry.extensions import SchemaExtension
+
+logger = logging.getLogger(__name__)
+
+
+def get_loop_monitor_setting(name, default):
+    return getattr(settings, 'MESSENGER_LOOP_MONITOR', {}).get(name, default)
+
+
+class LoopLagMonitor:
+    """
+    Измеряет, насколько event loop опаздывает с пробуждением.
+    Опоздание - это время, пока loop был занят синхронным кодом и не обслуживал другие запросы.
+    """
+
+    def __init__(self, interval=None, threshold=None, hook=None):
+        self.interval = interval if interval is not None else get_loop_monitor_setting('INTERVAL', 0.1)
+        self.threshold = threshold if threshold is not None else get_loop_monitor_setting('THRESHOLD', 0.05)
+        self.hook = hook if hook is not None else get_loop_monitor_setting('HOOK', None)
+        self.samples = 0
+        self.blocked = 0.0
+        self.max_lag = 0.0
+        self._task = None
+        self._loop = None
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        if self._task is not None and not self._task.done() and self._loop is loop:
+            return
+        self._loop = loop
+        self._task = loop.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._task = self._loop = None
+
+    def reset(self):
+        self.samples = 0
+        self.blocked = 0.0
+        self.max_lag = 0.0
+
+    def stats(self):
+        return {'samples': self.samples, 'blocked': self.blocked, 'max_lag': self.max_lag}
+
+    def record(self, lag):
+        self.samples += 1
+        self.blocked += lag
+        self.max_lag = max(self.max_lag, lag)
+        if lag >= self.threshold:
+            logger.warning("Event loop blocked for %.1f ms", lag * 1000)
+            if self.hook:
+                hook = import_string(self.hook) if isinstance(self.hook, str) else self.hook
+                hook(lag)
+
+    async def _run(self):
+        while True:
+            started = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            self.record(max(time.perf_counter() - started - self.interval, 0.0))
+
+
+loop_monitor = LoopLagMonitor()
+
+
+class LoopMonitorExtension(SchemaExtension):
+    """Запускает замер блокировок event loop при первой операции, если монитор включен"""
+
+    def on_operation(self):
+        if get_loop_monitor_setting('ENABLED', settings.DEBUG):
+            loop_monitor.start()
+        yield
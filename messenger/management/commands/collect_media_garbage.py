@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from messenger.media import collect_media_garbage
+
+
+class Command(BaseCommand):
+    help = 'Delete content-addressed media blobs that no User or Chatroom row references'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--grace', type=int, default=3600,
+                            help='Keep unreferenced blobs younger than this many seconds')
+        parser.add_argument('--dry-run', action='store_true')
+
+    def handle(self, *args, **options):
+        removed, references = collect_media_garbage(grace=options['grace'], dry_run=options['dry_run'])
+        action = 'Would delete' if options['dry_run'] else 'Deleted'
+        for name in removed:
+            self.stdout.write(f'{action} {name}')
+        self.stdout.write(self.style.SUCCESS(
+            f'{action} {len(removed)} blobs, {len(references)} files are referenced'))
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from messenger.media import generate_missing_thumbnails
+
+
+class Command(BaseCommand):
+    help = 'Generate avatar thumbnails for User and Chatroom avatars that do not have them yet'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--force', action='store_true', help='Regenerate existing thumbnails too')
+
+    def handle(self, *args, **options):
+        generated, failed = generate_missing_thumbnails(force=options['force'])
+        for name in generated:
+            self.stdout.write(f'Generated thumbnails for {name}')
+        self.stdout.write(self.style.SUCCESS(
+            f'Generated thumbnails for {len(generated)} avatars, {len(failed)} failed'))
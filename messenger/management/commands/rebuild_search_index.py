@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from messenger.search import install_search_index
+
+
+class Command(BaseCommand):
+    help = 'Recreate the name search index (FTS5 triggers are dropped when SQLite rebuilds a table)'
+
+    def handle(self, *args, **options):
+        install_search_index(connection, rebuild=True)
+        self.stdout.write(self.style.SUCCESS('Successfully rebuilt search index'))
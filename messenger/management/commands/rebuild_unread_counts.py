@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from messenger.unread import rebuild_unread_counts
+
+
+class Command(BaseCommand):
+    help = 'Recalculate per-user unread message counters from messages'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        count = rebuild_unread_counts(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Successfully rebuilt {count} unread counters'))
@@ -0,0 +1,55 @@
+from collections import Counter
+
+from django.core.files.storage import default_storage
+
+from messenger.models import Chatroom, User
+from messenger.thumbnails import get_thumbnail_sizes, save_thumbnails, thumbnail_name
+
+
+def avatar_references():
+    """Число строк User и Chatroom (с Chat и Favorite), ссылающихся на каждый файл"""
+    references = Counter()
+    for model in (User, Chatroom):
+        references.update(model.objects.exclude(avatar__isnull=True).exclude(avatar='')
+                          .values_list('avatar', flat=True).iterator(chunk_size=2000))
+    return references
+
+
+def collect_media_garbage(storage=None, grace=3600, dry_run=False):
+    """
+    Удаляет блобы, на которые не ссылается ни одна строка, вместе с их превью.
+    Ссылки считаются по колонкам avatar при каждом запуске, поэтому счетчики не расходятся с базой
+    """
+    storage = storage or default_storage
+    references = avatar_references()
+    removed = []
+    for name in storage.orphans(references, grace):
+        removed.append(name)
+        if dry_run:
+            continue
+        storage.remove_blob(name)
+        for size in get_thumbnail_sizes():
+            storage.derived.delete(thumbnail_name(name, size))
+    return removed, references
+
+
+def generate_missing_thumbnails(storage=None, force=False):
+    """
+    Строит превью аватаров, загруженных до появления превью: без них avatarThumbnails ведут на 404.
+    Файл, общий для нескольких строк, обрабатывается один раз; force - перестроить и существующие
+    """
+    storage = storage or default_storage
+    derived = getattr(storage, 'derived', storage)
+    generated, failed = [], []
+    for name in avatar_references():
+        if not force and all(derived.exists(thumbnail_name(name, size)) for size in get_thumbnail_sizes()):
+            continue
+        try:
+            with storage.open(name, 'rb') as file:
+                save_thumbnails(storage, name, file.read())
+        except Exception as e:
+            print(f"Error generating thumbnails for {name}: {e}")
+            failed.append(name)
+            continue
+        generated.append(name)
+    return generated, failed
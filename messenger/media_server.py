@@ -0,0 +1,199 @@
+import asyncio
+import mimetypes
+import os
+import re
+from dataclasses import dataclass, field
+
+from django.conf import settings
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseNotAllowed, StreamingHttpResponse
+from django.utils.http import http_date, parse_http_date_safe
+
+from messenger.storage import BLOB_DIR
+
+CHUNK_SIZE = 64 * 1024
+
+# Имена блобов содержат sha256 содержимого: файл под таким именем никогда не меняется
+IMMUTABLE_CACHE = 'public, max-age=31536000, immutable'
+# Остальные файлы кэшируются, но перед использованием сверяются по ETag
+REVALIDATE_CACHE = 'public, no-cache'
+
+_BLOB_NAME = re.compile(rf'^{BLOB_DIR}/[0-9a-f]{{2}}/([0-9a-f]{{64}})(\.[a-z0-9]+)?$')
+_RANGE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+@dataclass
+class MediaResponse:
+    status: int
+    headers: dict = field(default_factory=dict)
+    path: str = None  # файл, из которого отдается тело; None - ответ без тела
+    start: int = 0
+    length: int = 0
+
+
+def parse_range(header, size):
+    """
+    (start, length) для одного диапазона bytes=a-b, bytes=a-, bytes=-n.
+    None - заголовок не поддерживается (несколько диапазонов), тогда отдается весь файл.
+    ValueError - диапазон за пределами файла
+    """
+    match = _RANGE.match(header.strip())
+    if not match or not any(match.groups()):
+        return None
+    first, last = match.groups()
+    if not first:
+        length = min(int(last), size)
+        if length == 0:
+            raise ValueError("Unsatisfiable range")
+        return size - length, length
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or end < start:
+        raise ValueError("Unsatisfiable range")
+    return start, end - start + 1
+
+
+def resolve_media(root, name, request_headers):
+    """
+    Ответ на GET/HEAD файла из root без чтения тела: заголовки, условные запросы и Range.
+    request_headers - dict с именами заголовков в нижнем регистре
+    """
+    root = os.path.realpath(root)
+    path = os.path.realpath(os.path.join(root, name))
+    if not path.startswith(root + os.sep) or any(part.startswith('.') for part in name.split('/')):
+        return MediaResponse(404)
+    try:
+        stat = os.stat(path)
+    except (FileNotFoundError, NotADirectoryError):
+        return MediaResponse(404)
+    if not os.path.isfile(path):
+        return MediaResponse(404)
+
+    blob = _BLOB_NAME.match(name)
+    etag = f'"{blob.group(1)}"' if blob else f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"'
+    headers = {
+        'ETag': etag,
+        'Last-Modified': http_date(stat.st_mtime),
+        'Cache-Control': IMMUTABLE_CACHE if blob else REVALIDATE_CACHE,
+        'Accept-Ranges': 'bytes',
+    }
+
+    # Условный запрос решается по метаданным, файл не открывается
+    if_none_match = request_headers.get('if-none-match')
+    if if_none_match is not None:
+        if if_none_match.strip() == '*' or etag in [tag.strip() for tag in if_none_match.split(',')]:
+            return MediaResponse(304, headers)
+    else:
+        if_modified_since = parse_http_date_safe(request_headers.get('if-modified-since', ''))
+        if if_modified_since is not None and int(stat.st_mtime) <= if_modified_since:
+            return MediaResponse(304, headers)
+
+    content_type, encoding = mimetypes.guess_type(path)
+    headers['Content-Type'] = content_type or 'application/octet-stream'
+    if encoding:
+        headers['Content-Encoding'] = encoding
+
+    start, length, status = 0, stat.st_size, 200
+    range_header = request_headers.get('range')
+    # If-Range: диапазон только для той же версии файла, иначе весь файл
+    if range_header and request_headers.get('if-range', etag) == etag:
+        try:
+            requested = parse_range(range_header, stat.st_size)
+        except ValueError:
+            headers['Content-Range'] = f'bytes */{stat.st_size}'
+            headers['Content-Length'] = '0'
+            return MediaResponse(416, headers)
+        if requested is not None:
+            start, length = requested
+            status = 206
+            headers['Content-Range'] = f'bytes {start}-{start + length - 1}/{stat.st_size}'
+    headers['Content-Length'] = str(length)
+    return MediaResponse(status, headers, path, start, length)
+
+
+class MediaApp:
+    """
+    ASGI-приложение для MEDIA_URL перед Django: файлы отдаются без middleware и view.
+    Если сервер поддерживает расширение http.response.zerocopysend, тело уходит через sendfile,
+    иначе кусками по CHUNK_SIZE, чтение в пуле потоков не блокирует event loop
+    """
+
+    def __init__(self, app, root, prefix):
+        self.app = app
+        self.root = root
+        self.prefix = prefix
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not scope['path'].startswith(self.prefix):
+            return await self.app(scope, receive, send)
+
+        method = scope['method']
+        if method not in ('GET', 'HEAD'):
+            await send({'type': 'http.response.start', 'status': 405,
+                        'headers': [(b'allow', b'GET, HEAD'), (b'content-length', b'0')]})
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+
+        request_headers = {key.decode('latin-1').lower(): value.decode('latin-1') for key, value in scope['headers']}
+        response = resolve_media(self.root, scope['path'][len(self.prefix):], request_headers)
+        headers = response.headers if response.status != 404 else {'Content-Length': '0'}
+        await send({
+            'type': 'http.response.start',
+            'status': response.status,
+            'headers': [(key.lower().encode('latin-1'), value.encode('latin-1')) for key, value in headers.items()],
+        })
+        if method == 'HEAD' or response.path is None or response.length == 0:
+            await send({'type': 'http.response.body', 'body': b''})
+            return
+
+        with open(response.path, 'rb') as file:
+            if 'http.response.zerocopysend' in scope.get('extensions', {}):
+                await send({'type': 'http.response.zerocopysend', 'file': file,
+                            'offset': response.start, 'count': response.length})
+                return
+            await self.send_chunks(file, response.start, response.length, send)
+
+    @staticmethod
+    async def send_chunks(file, start, length, send):
+        loop = asyncio.get_running_loop()
+        file.seek(start)
+        remaining = length
+        while remaining > 0:
+            chunk = await loop.run_in_executor(None, file.read, min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            await send({'type': 'http.response.body', 'body': chunk, 'more_body': remaining > 0})
+        if remaining > 0:
+            # Файл укоротился во время отдачи: закрываем ответ
+            await send({'type': 'http.response.body', 'body': b''})
+
+
+def iter_range(path, start, length):
+    with open(path, 'rb') as file:
+        file.seek(start)
+        while length > 0:
+            chunk = file.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def serve_media(request, path, document_root=None):
+    """Та же отдача для WSGI и runserver: полный файл через FileResponse (wsgi.file_wrapper/sendfile)"""
+    if request.method not in ('GET', 'HEAD'):
+        return HttpResponseNotAllowed(['GET', 'HEAD'])
+    response = resolve_media(document_root or settings.MEDIA_ROOT, path,
+                             {key.lower(): value for key, value in request.headers.items()})
+    if response.status == 404:
+        raise Http404(path)
+    if response.path is None or request.method == 'HEAD':
+        result = HttpResponse(status=response.status)
+    elif response.status == 200:
+        result = FileResponse(open(response.path, 'rb'))
+    else:
+        result = StreamingHttpResponse(iter_range(response.path, response.start, response.length),
+                                       status=response.status)
+    for key, value in response.headers.items():
+        result[key] = value
+    return result
@@ -1,33 +1,136 @@
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime, UTC
 
 import jwt
-from graphql import GraphQLError
+from django.conf import settings
+from django.db.models import QuerySet
+from graphql import GraphQLError, OperationType
 from jwt import InvalidTokenError
 
+from messenger.loaders import get_loaders
 from messenger.models import User
 from messenger.resolvers.user_resolver import refresh_access_token
 from myproject.settings import SECRET_KEY
 
 
-def get_user_from_token(token):
+def get_auth_setting(name, default):
+    return getattr(settings, 'MESSENGER_AUTH', {}).get(name, default)
+
+
+class UserCache:
+    """LRU-кэш пользователей с ограниченным временем жизни записи"""
+
+    def __init__(self, ttl=None, size=None):
+        self.ttl = ttl
+        self.size = size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        ttl = self.ttl if self.ttl is not None else get_auth_setting('USER_CACHE_TTL', 30)
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            expires_at, values = entry
+            if expires_at < time.monotonic() or ttl <= 0:
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+        # Храним только значения полей и каждый раз собираем новый объект,
+        # чтобы запросы не меняли общий экземпляр
+        return User.from_db('default', [field.attname for field in User._meta.concrete_fields], values)
+
+    def set(self, user):
+        ttl = self.ttl if self.ttl is not None else get_auth_setting('USER_CACHE_TTL', 30)
+        size = self.size if self.size is not None else get_auth_setting('USER_CACHE_SIZE', 1024)
+        if ttl <= 0 or size <= 0:
+            return
+        values = [getattr(user, field.attname) for field in User._meta.concrete_fields]
+        with self._lock:
+            self._entries[user.id] = (time.monotonic() + ttl, values)
+            self._entries.move_to_end(user.id)
+            while len(self._entries) > size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+user_cache = UserCache()
+
+
+def user_from_claims(payload):
+    # Пользователь без обращения к базе, только с полями из подписанного токена
+    avatar = payload.get("avatar")
+    if avatar and avatar.startswith(settings.MEDIA_URL):
+        avatar = avatar[len(settings.MEDIA_URL):]
+    user = User(id=payload["id"], name=payload.get("name"), email=payload.get("email"), avatar=avatar)
+    user._state.adding = False
+    return user
+
+
+def get_user(user_id):
+    """Полный пользователь из кэша или из базы данных"""
+    user = user_cache.get(user_id)
+    if user is None:
+        user = User.objects.get(id=user_id)
+        user_cache.set(user)
+    return user
+
+
+async def aget_user(user_id):
+    user = user_cache.get(user_id)
+    if user is None:
+        user = await User.objects.aget(id=user_id)
+        user_cache.set(user)
+    return user
+
+
+def decode_access_token(token):
     try:
         # Раскодируем токен
         payload = jwt.decode(token, SECRET_KEY, algorithms=["HS256"])
-        user_id = payload.get("id")
-        if not user_id:
-            raise InvalidTokenError("Token does not contain a user ID")
-
-        # Получаем пользователя из базы данных
-        try:
-            user = User.objects.get(id=user_id)
-            exp = payload.get("exp")
-            if exp < datetime.now(UTC).timestamp():
-                raise InvalidTokenError("Token expired")
-            return user
-        except User.DoesNotExist:
-            raise InvalidTokenError("User not found")
     except jwt.InvalidTokenError:
         raise InvalidTokenError("Invalid token")
+    if not payload.get("id"):
+        raise InvalidTokenError("Invalid token")
+    exp = payload.get("exp")
+    if exp < datetime.now(UTC).timestamp():
+        raise InvalidTokenError("Invalid token")
+    return payload
+
+
+def get_user_from_token(token, trust_claims=False):
+    """
+    trust_claims=True - для операций только на чтение: пользователь собирается из claims токена.
+    Иначе пользователь берется из кэша или из базы данных.
+    """
+    payload = decode_access_token(token)
+    if trust_claims and get_auth_setting('STATELESS_READS', True):
+        return user_from_claims(payload)
+    try:
+        return get_user(payload["id"])
+    except User.DoesNotExist:
+        raise InvalidTokenError("Invalid token")
+
+
+async def aget_user_from_token(token, trust_claims=False):
+    """То же, что get_user_from_token, но без блокировки event loop: база через async ORM"""
+    payload = decode_access_token(token)
+    if trust_claims and get_auth_setting('STATELESS_READS', True):
+        return user_from_claims(payload)
+    try:
+        return await aget_user(payload["id"])
+    except User.DoesNotExist:
+        raise InvalidTokenError("Invalid token")
 
 
 class GrapheneAuthMiddleware:
@@ -40,10 +143,24 @@ class GrapheneAuthMiddleware:
         ]
 
     def resolve(self, next, root, info, **kwargs):
-        if info.field_name in self.excluded_resolvers:
+        # Проверяем только поля верхнего уровня, вложенные поля наследуют результат
+        if info.field_name in self.excluded_resolvers or info.path.prev is not None:
             return next(root, info, **kwargs)
 
-        request = info.context
+        # Для запросов на чтение достаточно данных из токена, мутации получают пользователя из базы
+        trust_claims = info.operation.operation == OperationType.QUERY
+        error = self.authenticate(info.context, trust_claims)
+        if error:
+            raise GraphQLError(error)
+        return next(root, info, **kwargs)
+
+    def authenticate(self, request, trust_claims=False):
+        """Аутентифицирует запрос один раз, результат запоминается на самом запросе"""
+        if not hasattr(request, "_auth_error"):
+            request._auth_error = self._authenticate(request, trust_claims)
+        return request._auth_error
+
+    def _authenticate(self, request, trust_claims):
         cookies = request.headers.get("cookie", "")
         access_token = None
         refresh_token = None
@@ -55,37 +172,45 @@ class GrapheneAuthMiddleware:
                 refresh_token = cookie.split("=")[1]
         if access_token:
             try:
-                user = get_user_from_token(access_token)
+                user = get_user_from_token(access_token, trust_claims)
                 request.user = user
             except InvalidTokenError as e:
                 # Если access_token истек, пытаемся обновить его с помощью refresh_token
                 if refresh_token:
                     try:
                         new_access_token = refresh_access_token(refresh_token)
-                        request.user = get_user_from_token(new_access_token)
+                        request.user = get_user_from_token(new_access_token, trust_claims)
                         request._access_token = new_access_token
                         request._refresh_token = refresh_token
                     except InvalidTokenError:
                         request.user = None
-                        raise GraphQLError("Unauthorized: Both access token and refresh token are invalid.")
+                        return "Unauthorized: Both access token and refresh token are invalid."
                 else:
                     request.user = None
-                    raise GraphQLError("Unauthorized: Access token expired and no refresh token provided.")
+                    return "Unauthorized: Access token expired and no refresh token provided."
         else:
             if refresh_token:
                 try:
                     new_access_token = refresh_access_token(refresh_token)
-                    print(new_access_token)
-                    request.user = get_user_from_token(new_access_token)
-                    print(request.user)
+                    request.user = get_user_from_token(new_access_token, trust_claims)
                     request._access_token = new_access_token
-                    print(request._access_token)
                     request._refresh_token = refresh_token
-                    print(request._refresh_token)
 
                 except ValueError:
                     request.user = None
             else:
                 request.user = None
-                raise GraphQLError("Unauthorized")
-        return next(root, info, **kwargs)
\ No newline at end of file
+                return "Unauthorized"
+        return None
+
+
+class DataLoaderMiddleware:
+    """Передает списки объектов в загрузчики запроса, чтобы связи грузились пачкой, а не по одной"""
+
+    def resolve(self, next, root, info, **kwargs):
+        result = next(root, info, **kwargs)
+        if isinstance(result, QuerySet):
+            result = list(result)
+        if isinstance(result, list):
+            get_loaders(info).prime(result)
+        return result
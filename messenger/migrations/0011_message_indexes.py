@@ -0,0 +1,21 @@
+# Generated by Django 5.1.4 on 2026-10-17 18:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messenger', '0010_message_is_read'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['chatroom', 'created_at', 'id'], name='message_chatroom_history_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(condition=models.Q(('is_read', False)), fields=['chatroom', 'user'], name='message_unread_idx'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+from django.db import migrations
+
+from messenger.migrations._search_index import install_search_index, uninstall_search_index
+
+
+def create_search_index(apps, schema_editor):
+    # Postgres: pg_trgm и GIN-индексы по UPPER(name); SQLite: таблицы FTS5 с триггерами
+    install_search_index(schema_editor.connection, rebuild=True)
+
+
+def drop_search_index(apps, schema_editor):
+    uninstall_search_index(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messenger', '0011_message_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
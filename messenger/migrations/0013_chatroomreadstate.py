@@ -0,0 +1,49 @@
+# Generated by Django 5.1.4 on 2026-10-17 19:09
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def create_read_states(apps, schema_editor):
+    # Строка счетчика на каждого участника существующих чатов: чужие сообщения с is_read=False
+    Chatroom = apps.get_model('messenger', 'Chatroom')
+    ChatroomReadState = apps.get_model('messenger', 'ChatroomReadState')
+    Message = apps.get_model('messenger', 'Message')
+    Participant = Chatroom.participants.through
+    unread = Message.objects.filter(chatroom_id=OuterRef('chatroom_id'), is_read=False) \
+        .exclude(user_id=OuterRef('user_id')) \
+        .order_by().values('chatroom_id').annotate(count=Count('id')).values('count')
+    rows = Participant.objects \
+        .annotate(unread_count=Coalesce(Subquery(unread, output_field=IntegerField()), Value(0))) \
+        .values_list('user_id', 'chatroom_id', 'unread_count')
+    ChatroomReadState.objects.bulk_create(
+        [ChatroomReadState(user_id=user_id, chatroom_id=chatroom_id, unread_count=unread_count)
+         for user_id, chatroom_id, unread_count in rows.iterator(chunk_size=1000)],
+        batch_size=1000, ignore_conflicts=True,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messenger', '0012_name_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChatroomReadState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('unread_count', models.PositiveIntegerField(default=0)),
+                ('chatroom', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_states', to='messenger.chatroom')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_states', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('user', 'chatroom'), name='unique_chatroom_read_state')],
+            },
+        ),
+        migrations.RunPython(create_read_states, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 5.1.4 on 2026-10-17 19:15
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, IntegerField, Max, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+
+def backfill_read_cursors(apps, schema_editor):
+    Chatroom = apps.get_model('messenger', 'Chatroom')
+    ChatroomReadState = apps.get_model('messenger', 'ChatroomReadState')
+    Message = apps.get_model('messenger', 'Message')
+    # Строки для участников, которых нет в счетчиках (база могла пройти 0013 без шага с данными)
+    Participant = Chatroom.participants.through
+    ChatroomReadState.objects.bulk_create(
+        [ChatroomReadState(user_id=user_id, chatroom_id=chatroom_id)
+         for user_id, chatroom_id in Participant.objects.values_list('user_id', 'chatroom_id').iterator(chunk_size=1000)],
+        batch_size=1000, ignore_conflicts=True,
+    )
+    # Курсор - последнее прочитанное чужое сообщение по старому флагу is_read
+    last_read = Message.objects.filter(chatroom_id=OuterRef('chatroom_id'), is_read=True) \
+        .exclude(user_id=OuterRef('user_id')) \
+        .order_by().values('chatroom_id').annotate(last_id=Max('id')).values('last_id')
+    ChatroomReadState.objects.update(last_read_message_id=Subquery(last_read))
+    # Счетчик - чужие сообщения после курсора, как в rebuild_unread_counts
+    unread = Message.objects.filter(chatroom_id=OuterRef('chatroom_id'),
+                                    id__gt=Coalesce(OuterRef('last_read_message_id'), Value(0))) \
+        .exclude(user_id=OuterRef('user_id')) \
+        .order_by().values('chatroom_id').annotate(count=Count('id')).values('count')
+    ChatroomReadState.objects.update(unread_count=Coalesce(Subquery(unread, output_field=IntegerField()), Value(0)))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messenger', '0013_chatroomreadstate'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatroomreadstate',
+            name='last_read_message',
+            field=models.ForeignKey(blank=True, db_constraint=False, default=None, null=True, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='messenger.message'),
+        ),
+        migrations.RunPython(backfill_read_cursors, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name='message',
+            name='message_unread_idx',
+        ),
+        migrations.RemoveField(
+            model_name='message',
+            name='is_read',
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['chatroom', 'id'], name='message_chatroom_id_idx'),
+        ),
+    ]
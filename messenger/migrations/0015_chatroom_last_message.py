@@ -0,0 +1,52 @@
+# Generated by Django 5.1.4 on 2026-10-17 19:17
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from messenger.migrations._search_index import install_search_index
+
+
+def backfill_last_message(apps, schema_editor):
+    # То же, что messenger.activity.refresh_last_message, на исторических моделях
+    Chatroom = apps.get_model('messenger', 'Chatroom')
+    Message = apps.get_model('messenger', 'Message')
+    latest = Message.objects.filter(chatroom_id=OuterRef('pk')).order_by('-created_at', '-id')
+    Chatroom.objects.update(
+        last_message=Subquery(latest.values('id')[:1]),
+        last_activity_at=Coalesce(Subquery(latest.values('created_at')[:1]), F('created_at')),
+    )
+
+
+def restore_search_index(apps, schema_editor):
+    # SQLite пересоздает таблицу чатов при добавлении FK и теряет триггеры поиска
+    install_search_index(schema_editor.connection)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('messenger', '0014_read_cursors'),
+    ]
+
+    operations = [
+        migrations.RunPython(migrations.RunPython.noop, restore_search_index),
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_activity_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='chatroom',
+            name='last_message',
+            field=models.ForeignKey(blank=True, default=None, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='messenger.message'),
+        ),
+        migrations.RunPython(backfill_last_message, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='chatroom',
+            index=models.Index(fields=['last_activity_at', 'id'], name='chatroom_activity_idx'),
+        ),
+        migrations.RunPython(restore_search_index, migrations.RunPython.noop),
+    ]
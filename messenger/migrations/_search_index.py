@@ -0,0 +1,54 @@
+# Копия SQL индексов поиска на момент миграций 0012 и 0015: изменения messenger.search не должны
+# менять уже примененные миграции. Модуль не редактируется, новая схема поиска - новая миграция
+
+SEARCH_TABLES = ('messenger_user', 'messenger_chatroom')
+
+
+def install_search_index(connection, rebuild=False):
+    """Создает индексы поиска; повторный вызов безопасен. rebuild=True заново наполняет FTS5 на SQLite"""
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            for table in SEARCH_TABLES:
+                cursor.execute(f'CREATE INDEX IF NOT EXISTS {table}_name_trgm_idx '
+                               f'ON {table} USING gin (UPPER(name) gin_trgm_ops)')
+        return
+
+    if connection.vendor != 'sqlite':
+        return
+
+    with connection.cursor() as cursor:
+        for table in SEARCH_TABLES:
+            search = f'{table}_search'
+            cursor.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {search} USING fts5("
+                           f"name, content='{table}', content_rowid='id', tokenize='trigram')")
+            # Перестройка таблицы в миграциях SQLite удаляет триггеры, поэтому создаем их без ошибок при повторе
+            cursor.execute(f"SELECT count(*) FROM sqlite_master WHERE type = 'trigger' AND tbl_name = %s "
+                           f"AND name LIKE %s", [table, f'{search}_%'])
+            missing = cursor.fetchone()[0] < 3
+            cursor.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS {search}_insert AFTER INSERT ON {table} BEGIN
+                    INSERT INTO {search}(rowid, name) VALUES (new.id, new.name);
+                END""")
+            cursor.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS {search}_delete AFTER DELETE ON {table} BEGIN
+                    INSERT INTO {search}({search}, rowid, name) VALUES ('delete', old.id, old.name);
+                END""")
+            cursor.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS {search}_update AFTER UPDATE OF name ON {table} BEGIN
+                    INSERT INTO {search}({search}, rowid, name) VALUES ('delete', old.id, old.name);
+                    INSERT INTO {search}(rowid, name) VALUES (new.id, new.name);
+                END""")
+            if missing or rebuild:
+                cursor.execute(f"INSERT INTO {search}({search}) VALUES ('rebuild')")
+
+
+def uninstall_search_index(connection):
+    with connection.cursor() as cursor:
+        for table in SEARCH_TABLES:
+            if connection.vendor == 'postgresql':
+                cursor.execute(f'DROP INDEX IF EXISTS {table}_name_trgm_idx')
+            elif connection.vendor == 'sqlite':
+                for suffix in ('insert', 'delete', 'update'):
+                    cursor.execute(f'DROP TRIGGER IF EXISTS {table}_search_{suffix}')
+                cursor.execute(f'DROP TABLE IF EXISTS {table}_search')
@@ -1,5 +1,6 @@
 from django.core.exceptions import ValidationError
 from django.db import models
+from django.utils import timezone
 
 
 class User(models.Model):
@@ -33,14 +34,24 @@ class Chatroom(models.Model):
     avatar = models.ImageField(upload_to='avatars/chat/', null=True, blank=True, default=None)
     participants = models.ManyToManyField('User', null=True, related_name='chatrooms')
     max_participants = models.PositiveIntegerField(default=8, editable=False)
+    # Последнее сообщение и время активности для списка чатов, обновляются при отправке сообщения
+    last_message = models.ForeignKey('Message', on_delete=models.SET_NULL, null=True, blank=True, default=None,
+                                     related_name='+')
+    last_activity_at = models.DateTimeField(default=timezone.now)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    class Meta:
+        indexes = [
+            # Список чатов по последней активности, курсор (last_activity_at, id)
+            models.Index(fields=['last_activity_at', 'id'], name='chatroom_activity_idx'),
+        ]
+
     def __str__(self):
         return self.name
 
     def get_messages(self):
-        return Message.objects.filter(chat=self).order_by('created_at')
+        return Message.objects.filter(chatroom=self).order_by('created_at', 'id')
 
     def get_max_participants(self):
         return self.max_participants
@@ -91,7 +102,14 @@ class Message(models.Model):
     updated_at = models.DateTimeField(auto_now=True)
     is_chat = models.BooleanField(default=False)
     is_favorite = models.BooleanField(default=False)
-    is_read = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = [
+            # История чата: фильтр по чату и сортировка по (created_at, id), как в курсорной пагинации
+            models.Index(fields=['chatroom', 'created_at', 'id'], name='message_chatroom_history_idx'),
+            # Непрочитанные - сообщения чата после курсора прочтения (id > last_read_message_id)
+            models.Index(fields=['chatroom', 'id'], name='message_chatroom_id_idx'),
+        ]
 
     def __str__(self):
         return f"Message: {self.user} to {self.chatroom} with text: {self.text}"
@@ -112,3 +130,22 @@ class Message(models.Model):
 
         super().save(*args, **kwargs)
 
+
+
+class ChatroomReadState(models.Model):
+    # Курсор прочтения пользователя в чате и счетчик сообщений после него,
+    # поддерживаются при отправке и прочтении
+    user = models.ForeignKey('User', on_delete=models.CASCADE, related_name='read_states')
+    chatroom = models.ForeignKey('Chatroom', on_delete=models.CASCADE, related_name='read_states')
+    # Без ограничения в базе: удаление прочитанного сообщения не должно сбрасывать курсор
+    last_read_message = models.ForeignKey('Message', on_delete=models.DO_NOTHING, db_constraint=False,
+                                          null=True, blank=True, default=None, related_name='+')
+    unread_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'chatroom'], name='unique_chatroom_read_state'),
+        ]
+
+    def __str__(self):
+        return f"{self.user} in {self.chatroom}: {self.unread_count} unread"
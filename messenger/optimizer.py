@@ -0,0 +1,109 @@
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Prefetch
+from graphene.utils.str_converters import to_snake_case
+from graphql.language import FieldNode, FragmentSpreadNode, InlineFragmentNode
+from strawberry.types.nodes import SelectedField
+
+# Вычисляемые поля схемы и колонки, из которых они берутся
+FIELD_SOURCES = {
+    'max_participants_count': 'max_participants',
+    'avatar_thumbnails': 'avatar',
+}
+
+
+def graphene_selection(info):
+    """Дерево запрошенных полей текущего graphene-поля: {имя_поля: {вложенные поля}}"""
+    selection = {}
+    for node in info.field_nodes:
+        if node.selection_set:
+            _merge(selection, _collect_graphene(node.selection_set.selections, info.fragments))
+    return selection
+
+
+def _collect_graphene(nodes, fragments):
+    selection = {}
+    for node in nodes:
+        if isinstance(node, FieldNode):
+            children = _collect_graphene(node.selection_set.selections, fragments) if node.selection_set else {}
+            _merge(selection, {to_snake_case(node.name.value): children})
+        elif isinstance(node, FragmentSpreadNode):
+            _merge(selection, _collect_graphene(fragments[node.name.value].selection_set.selections, fragments))
+        elif isinstance(node, InlineFragmentNode):
+            _merge(selection, _collect_graphene(node.selection_set.selections, fragments))
+    return selection
+
+
+def strawberry_selection(info):
+    """То же дерево для strawberry, по info.selected_fields (фрагменты уже раскрыты в selections)"""
+    selection = {}
+    for field in info.selected_fields:
+        _merge(selection, _collect_strawberry(field.selections))
+    return selection
+
+
+def _collect_strawberry(nodes):
+    selection = {}
+    for node in nodes:
+        if isinstance(node, SelectedField):
+            _merge(selection, {to_snake_case(node.name): _collect_strawberry(node.selections)})
+        else:
+            _merge(selection, _collect_strawberry(node.selections))
+    return selection
+
+
+def _merge(target, source):
+    for name, children in source.items():
+        _merge(target.setdefault(name, {}), children)
+
+
+def find(selection, *path):
+    for name in path:
+        selection = selection.get(name, {})
+    return selection
+
+
+def optimize(queryset, selection, prefetch=True, fields=()):
+    """
+    Применяет к queryset только нужные select_related, prefetch_related и колонки для only().
+    prefetch=False - связи грузятся загрузчиками (graphene), выбираются только колонки и ключи связей.
+    fields - колонки, которые нужны коду резолвера, даже если клиент их не запросил.
+    """
+    if not selection:
+        return queryset
+    only, select, prefetches = _plan(queryset.model, selection, prefetch)
+    if select:
+        queryset = queryset.select_related(*select)
+    if prefetches:
+        queryset = queryset.prefetch_related(*prefetches)
+    return queryset.only(*only, *fields)
+
+
+def _plan(model, selection, prefetch, prefix=''):
+    only = [prefix + model._meta.pk.name]
+    select = []
+    prefetches = []
+    for name, children in selection.items():
+        name = FIELD_SOURCES.get(name, name)
+        try:
+            field = model._meta.get_field(name)
+        except FieldDoesNotExist:
+            continue
+
+        if not field.is_relation:
+            only.append(prefix + name)
+        elif field.many_to_one or (field.one_to_one and field.concrete):
+            only.append(prefix + name)
+            if prefetch and children:
+                select.append(prefix + name)
+                related_only, related_select, related_prefetches = _plan(
+                    field.related_model, children, prefetch, prefix + name + '__')
+                only += related_only
+                select += related_select
+                prefetches += related_prefetches
+        elif prefetch and (field.many_to_many or field.one_to_many):
+            # Обратному FK нужна колонка связи, иначе Django догрузит ее отдельным запросом на объект
+            related_fields = (field.field.name,) if field.one_to_many else ()
+            related = optimize(field.related_model.objects.all(), children, prefetch, related_fields)
+            accessor = name if field.concrete else field.get_accessor_name()
+            prefetches.append(Prefetch(prefix + accessor, queryset=related))
+    return only, select, prefetches
@@ -0,0 +1,60 @@
+import base64
+from datetime import datetime
+
+from django.conf import settings
+from django.db.models import Q
+
+
+def get_max_page_size():
+    return getattr(settings, 'MESSENGER_PAGINATION', {}).get('MAX_PAGE_SIZE', 100)
+
+
+def encode_cursor(created_at, pk):
+    value = f"{created_at.isoformat()}|{pk}"
+    return base64.urlsafe_b64encode(value.encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        created_at, pk = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(created_at), int(pk)
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError("Invalid cursor")
+
+
+def after_key(created_at, pk, prefix=''):
+    # (created_at, id) > (created_at, pk): одинаковое время разрешается по id, сообщения не теряются
+    return Q(**{f'{prefix}created_at__gt': created_at}) | Q(**{f'{prefix}created_at': created_at, f'{prefix}id__gt': pk})
+
+
+def before_key(created_at, pk, prefix=''):
+    return Q(**{f'{prefix}created_at__lt': created_at}) | Q(**{f'{prefix}created_at': created_at, f'{prefix}id__lt': pk})
+
+
+def keyset_page(queryset, first=None, after=None, last=None, before=None):
+    """
+    Страница по ключу (created_at, id) в хронологическом порядке, одним запросом.
+    Возвращает (items, has_next_page, has_previous_page).
+    """
+    max_page_size = get_max_page_size()
+    if first is not None and last is not None:
+        raise ValueError("Pass either first or last, not both")
+    if (first is not None and first < 0) or (last is not None and last < 0):
+        raise ValueError("Page size cannot be negative")
+
+    if after is not None:
+        queryset = queryset.filter(after_key(*decode_cursor(after)))
+    if before is not None:
+        queryset = queryset.filter(before_key(*decode_cursor(before)))
+
+    if last is not None:
+        size = min(last, max_page_size)
+        items = list(queryset.order_by('-created_at', '-id')[:size + 1])
+        has_previous_page = len(items) > size
+        items = items[:size][::-1]
+        return items, before is not None, has_previous_page
+
+    size = min(first if first is not None else max_page_size, max_page_size)
+    items = list(queryset.order_by('created_at', 'id')[:size + 1])
+    has_next_page = len(items) > size
+    return items[:size], has_next_page, after is not None
@@ -1,81 +1,116 @@
 import asyncio
 
-from asgiref.sync import sync_to_async, async_to_sync
+from asgiref.sync import sync_to_async
+from django.db import transaction
+from django.db.models import Exists, OuterRef, Q, Subquery
 from graphql import GraphQLError
-from messenger.models import Chatroom, User, Chat, Favorite
+from messenger.models import Chatroom, User, Chat, Favorite, ChatroomReadState
+from messenger.optimizer import optimize, graphene_selection
+from messenger.pagination import get_max_page_size
+from messenger.search import search_by_name
+from messenger.thumbnails import generate_thumbnails
+from messenger.uploads import validate_avatar
+from messenger.unread import create_read_states, latest_message_id, mark_read, with_unread_count
 from messenger.strawberry import notify_new_chatroom, ChatroomTypeStrawberry, notify_chatroom_delete, \
-    notify_chatroom_update
+    notify_chatroom_update, notify_read
+
+
+def chatrooms_for(info, queryset):
+    selection = graphene_selection(info)
+    queryset = optimize(queryset, selection, prefetch=False)
+    if 'unread_messages' in selection:
+        queryset = with_unread_count(queryset, info.context.user.id)
+    return queryset
 
 
 def resolve_user_chatrooms(self, info):
     this_user = info.context.user
-    return Chatroom.objects.filter(participants=this_user.id)
+    return chatrooms_for(info, Chatroom.objects.filter(participants=this_user.id))
+
+
+def resolve_user_chatrooms_by_activity(self, info, before_id=None, limit=None):
+    """Чаты пользователя с превью, сначала недавно активные. Следующая страница - before_id последнего чата"""
+    this_user = info.context.user
+    limit = min(limit or get_max_page_size(), get_max_page_size())
+    chatrooms = chatrooms_for(info, Chatroom.objects.filter(participants=this_user.id))
+    if before_id is not None:
+        # Ключ (last_activity_at, id) чата-курсора берется подзапросом, как в getMessages
+        before_activity = Subquery(Chatroom.objects.filter(id=before_id).values('last_activity_at')[:1])
+        chatrooms = chatrooms.filter(Q(last_activity_at__lt=before_activity) |
+                                     Q(last_activity_at=before_activity, id__lt=before_id))
+    return chatrooms.order_by('-last_activity_at', '-id')[:limit]
 
 
 def resolve_filter_chatroom(self, info, search_query=None, total=5):
-    chats = Chatroom.objects.filter(name__icontains=search_query)[:total]
+    chats = chatrooms_for(info, search_by_name(Chatroom.objects.all(), search_query))[:total]
     return chats
 
 
 def resolve_filter_not_created_chats(self, info, search_query=None, total=5):
     this_user = info.context.user
 
-    chat_participants = Chat.objects.filter(name__icontains=search_query, participants=this_user) \
-        .values_list('name', flat=True) \
-        .distinct()
+    # Пользователи, с которыми уже есть чат 1:1: участники чатов текущего пользователя
+    this_user_chats = Chat.objects.filter(participants=this_user.id).values('pk')
+    has_chat = Chatroom.participants.through.objects.filter(user_id=OuterRef('pk'), chatroom_id__in=this_user_chats)
 
-    # Получаем всех пользователей, чьи имена соответствуют фильтру
-    filtered_users = User.objects.filter(name__icontains=search_query).exclude(name=this_user.name)
+    # Анти-join и LIMIT выполняются в базе одним запросом
+    users = search_by_name(User.objects.exclude(id=this_user.id), search_query).filter(~Exists(has_chat))
+    return optimize(users, graphene_selection(info), prefetch=False)[:total]
 
-    # Фильтруем пользователей, чьи имена уже есть среди участников чатов
-    available_users = []
-    for user in filtered_users:
-        # Для каждого пользователя проверяем, встречается ли его имя в именах чатов
-        if not any(user.name in chat_name for chat_name in chat_participants):
-            available_users.append(user)
 
-    # Ограничиваем выборку до total пользователей
-    users_to_return = available_users[:total]
+def resolve_chatroom_by_name(self, info, name):
+    return chatrooms_for(info, Chatroom.objects.all()).get(name=name)
 
-    return users_to_return
 
+def get_users_in_bulk(user_ids):
+    """Пользователи одним запросом, в порядке user_ids; все неизвестные id сообщаются одной ошибкой"""
+    user_ids = list(dict.fromkeys(user_ids))
+    users = User.objects.in_bulk(user_ids)
+    missing = [str(user_id) for user_id in user_ids if user_id not in users]
+    if missing:
+        raise GraphQLError(f"Invalid user id: {', '.join(missing)}")
+    return [users[user_id] for user_id in user_ids]
 
-def resolve_chatroom_by_name(self, info, name):
-    return Chatroom.objects.get(name=name)
+
+def add_participants(chatroom, user_ids, last_read_message_id=None):
+    # Одна вставка в промежуточную таблицу вместо participants.set с предварительной выборкой
+    Participant = Chatroom.participants.through
+    Participant.objects.bulk_create([Participant(chatroom_id=chatroom.id, user_id=user_id) for user_id in user_ids])
+    create_read_states(chatroom.id, user_ids, last_read_message_id)
 
 
 def resolve_chatroom_create(self, info, name, users, avatar=None):
     this_user_id = info.context.user.id
     try:
-        user_ids = list(users.values())
-
-        user_objects = [User.objects.get(id=user_id) for user_id in user_ids]
-        user_objects += [this_user_id]
-        if name:
-            chatroomCheck = Chatroom.objects.filter(name=name)
-            if chatroomCheck:
-                raise GraphQLError("Chatroom with this name already exists")
-            chatroom = Chatroom.objects.create(name=name)
-        chatroom.participants.set(user_objects)
-        if avatar: chatroom.avatar = avatar
-        chatroom.save()
-
-        chatroom_strawberry = ChatroomTypeStrawberry(
-            id=chatroom.id,
-            name=chatroom.name,
-            avatar=chatroom.avatar,
-            participants=chatroom.participants.all(),
-            max_participants=chatroom.max_participants,
-            updated_at=chatroom.updated_at,
-            created_at=chatroom.created_at
-        )
-
-        async_to_sync(notify_new_chatroom)(chatroom_strawberry)
+        with transaction.atomic():
+            participants = get_users_in_bulk(list(users.values()) + [this_user_id])
+            if name:
+                if Chatroom.objects.filter(name=name).exists():
+                    raise GraphQLError("Chatroom with this name already exists")
+                chatroom = Chatroom(name=name)
+            if avatar: chatroom.avatar = validate_avatar(avatar)
+            chatroom.save()
+            add_participants(chatroom, [user.id for user in participants])
+
+            chatroom_strawberry = ChatroomTypeStrawberry(
+                id=chatroom.id,
+                name=chatroom.name,
+                avatar=chatroom.avatar,
+                participants=participants,
+                max_participants=chatroom.max_participants,
+                updated_at=chatroom.updated_at,
+                created_at=chatroom.created_at
+            )
+
+            # Подписчики узнают о чате только после фиксации транзакции
+            transaction.on_commit(lambda: notify_new_chatroom(chatroom_strawberry))
+            if avatar:
+                transaction.on_commit(lambda: generate_thumbnails(chatroom.avatar))
 
         return chatroom
 
-    except User.DoesNotExist:
-        raise GraphQLError("Invalid user id")
+    except GraphQLError:
+        raise
 
     except Chatroom.DoesNotExist:
         raise GraphQLError("Invalid chatroom type")
@@ -101,6 +136,7 @@ def resolve_chat_create(self, info, user_name):
         user_objects = [this_user_id, other_user_id]
         chat = Chat.objects.create()
         chat.participants.add(*user_objects)
+        create_read_states(chat.id, user_objects)
         chat.name = f"{chat.participants.first().name} & {chat.participants.last().name}"
         chat.save()
         return chat
@@ -123,6 +159,7 @@ def resolve_favorite_create(self, info):
 
         favorite = Favorite.objects.create()
         favorite.participants.set([this_user_id])
+        create_read_states(favorite.id, [this_user_id])
         favorite.name = "Избранные"
         if (info.context.user.avatar): favorite.avatar = info.context.user.avatar
         favorite.save()
@@ -131,13 +168,13 @@ def resolve_favorite_create(self, info):
             id=favorite.id,
             name=favorite.name,
             avatar=favorite.avatar,
-            participants=favorite.participants.all(),
+            participants=list(favorite.participants.all()),
             max_participants=favorite.max_participants,
             updated_at=favorite.updated_at,
             created_at=favorite.created_at
         )
 
-        async_to_sync(notify_new_chatroom)(chatroom_strawberry)
+        notify_new_chatroom(chatroom_strawberry)
 
         return favorite
 
@@ -153,48 +190,63 @@ def resolve_favorite_create(self, info):
 
 def resolve_chatroom_update(self, info, id, users=None, name=None, avatar=None):
     try:
-        # Проверяем существование чата
-        chatroom = Chatroom.objects.get(id=id)
-        if not chatroom:
-            raise GraphQLError("Chatroom does not exist")
-
-        # Добавляем участников
-        if users:
-            user_ids = list(users.values())
-
-            if len(user_ids) > 8:
-                raise GraphQLError("Invalid number of users")
-
-            user_objects = [User.objects.get(id=user_id) for user_id in user_ids]
-            user_objects.append(info.context.user)
-            chatroom.participants.set(user_objects)
+        with transaction.atomic():
+            # Проверяем существование чата
+            chatroom = Chatroom.objects.get(id=id)
+
+            removed_user_ids = set()
+
+            # Меняем участников: удаляем и добавляем только разницу
+            if users:
+                user_ids = list(users.values())
+
+                if len(user_ids) > 8:
+                    raise GraphQLError("Invalid number of users")
+
+                participants = get_users_in_bulk(user_ids + [info.context.user.id])
+                current_ids = set(chatroom.participants.values_list('id', flat=True))
+                new_ids = {user.id for user in participants}
+                removed_user_ids = current_ids - new_ids
+                if removed_user_ids:
+                    Chatroom.participants.through.objects.filter(chatroom_id=chatroom.id,
+                                                                 user_id__in=removed_user_ids).delete()
+                    ChatroomReadState.objects.filter(chatroom_id=chatroom.id, user_id__in=removed_user_ids).delete()
+                added_user_ids = [user.id for user in participants if user.id not in current_ids]
+                if added_user_ids:
+                    # История до входа в чат новым участникам не считается непрочитанной
+                    add_participants(chatroom, added_user_ids, latest_message_id(chatroom.id))
+            else:
+                participants = list(chatroom.participants.all())
+
+            # Обновляем имя чата
+            if name:
+                if Chatroom.objects.filter(name=name).exclude(id=id).exists():
+                    raise GraphQLError("Chatroom already exists")
+                chatroom.name = name
+
+            if avatar:
+                chatroom.avatar = validate_avatar(avatar)
+
+            chatroom.save()
+
+            chatroom_strawberry = ChatroomTypeStrawberry(
+                id=chatroom.id,
+                name=chatroom.name,
+                avatar=chatroom.avatar,
+                participants=participants,
+                max_participants=chatroom.max_participants,
+                updated_at=chatroom.updated_at,
+                created_at=chatroom.created_at
+            )
+
+            transaction.on_commit(lambda: notify_chatroom_update(chatroom_strawberry, removed_user_ids))
+            if avatar:
+                transaction.on_commit(lambda: generate_thumbnails(chatroom.avatar))
 
-        # Обновляем имя чата
-        if name:
-            if Chatroom.objects.filter(name=name).exclude(id=id).exists():
-                raise GraphQLError("Chatroom already exists")
-            chatroom.name = name
-
-        if avatar:
-            chatroom.avatar = avatar
-
-        chatroom_strawberry = ChatroomTypeStrawberry(
-            id=chatroom.id,
-            name=chatroom.name,
-            avatar=chatroom.avatar,
-            participants=chatroom.participants.all(),
-            max_participants=chatroom.max_participants,
-            updated_at=chatroom.updated_at,
-            created_at=chatroom.created_at
-        )
-
-        async_to_sync(notify_chatroom_update)(chatroom_strawberry)
-
-        chatroom.save()
         return chatroom
 
-    except User.DoesNotExist:
-        raise GraphQLError("Invalid user id")
+    except GraphQLError:
+        raise
 
     except Chatroom.DoesNotExist:
         raise GraphQLError("Invalid chatroom type")
@@ -205,24 +257,25 @@ def resolve_chatroom_update(self, info, id, users=None, name=None, avatar=None):
 
 def resolve_chatroom_delete(self, info, id):
     try:
-        # Получаем объект чата по ID (если он существует)
-        chatroom = Chatroom.objects.get(id=id)
-
-        chatroom_strawberry = ChatroomTypeStrawberry(
-            id=chatroom.id,
-            name=chatroom.name,
-            avatar=chatroom.avatar,
-            participants=chatroom.participants.all(),
-            max_participants=chatroom.max_participants,
-            updated_at=chatroom.updated_at,
-            created_at=chatroom.created_at
-        )
-
-        async_to_sync(notify_chatroom_delete)(chatroom_strawberry)
-
-        # Удаляем объект
-        chatroom.delete()
-        chatroom.save()
+        with transaction.atomic():
+            # Получаем объект чата по ID (если он существует)
+            chatroom = Chatroom.objects.get(id=id)
+
+            chatroom_strawberry = ChatroomTypeStrawberry(
+                id=chatroom.id,
+                name=chatroom.name,
+                avatar=chatroom.avatar,
+                participants=list(chatroom.participants.all()),
+                max_participants=chatroom.max_participants,
+                updated_at=chatroom.updated_at,
+                created_at=chatroom.created_at
+            )
+
+            # Удаляем объект; подписчики узнают об удалении только после фиксации транзакции
+            chatroom.delete()
+            # delete() обнуляет id, а в ответе клиент получает удаленный чат
+            chatroom.id = chatroom_strawberry.id
+            transaction.on_commit(lambda: notify_chatroom_delete(chatroom_strawberry))
 
         return chatroom
 
@@ -230,4 +283,23 @@ def resolve_chatroom_delete(self, info, id):
         raise GraphQLError("Chatroom not found")  # Ошибка, если чат не существует
 
     except Exception as e:
-        raise GraphQLError(f"An error occurred: {str(e)}")  # Обработка других ошибок
\ No newline at end of file
+        raise GraphQLError(f"An error occurred: {str(e)}")  # Обработка других ошибок
+
+
+def resolve_mark_read(self, info, chatroom_id, up_to=None):
+    """
+    Отмечает прочитанными сообщения чата до up_to включительно (без up_to - до последнего).
+    Клиент присылает одну отметку на пачку просмотренных сообщений, а не запрос на каждое
+    """
+    from messenger.graphene import MessagesCountType
+    this_user_id = info.context.user.id
+    if up_to is None:
+        up_to = latest_message_id(chatroom_id)
+    if up_to is not None and mark_read(chatroom_id, this_user_id, up_to):
+        notify_read(chatroom_id, this_user_id, up_to)
+    # Строки нет - пользователь не участник чата
+    count = ChatroomReadState.objects.filter(chatroom_id=chatroom_id, user_id=this_user_id) \
+        .values_list('unread_count', flat=True).first()
+    if count is None:
+        raise GraphQLError("Chatroom does not exist")
+    return MessagesCountType(count=count)
@@ -1,43 +1,122 @@
+from collections import Counter
 from datetime import datetime, UTC
+
 from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
 
-from messenger.middlewares import get_user_from_token
+from messenger.activity import touch_chatroom
+from messenger.coalescer import WriteBatcher
+from messenger.middlewares import aget_user_from_token
 from messenger.models import User, Chatroom, Message
-from messenger.strawberry import notify_new_message, notify_new_chatroom
+from messenger.strawberry import notify_new_messages, notify_new_chatroom
+from messenger.unread import increment_unread
 
 
-@sync_to_async
-def get_chat_by_name(chatroom_name):
-    chatroom = Chatroom.objects.filter(name=chatroom_name).first()
+async def get_chat_by_name(chatroom_name):
+    chatroom = await Chatroom.objects.filter(name=chatroom_name).afirst()
     if not chatroom:
         raise ValueError(f"Chatroom with name {chatroom_name} not found")  # Или другое исключение
     return chatroom
 
 
+def get_message_setting(name, default):
+    return getattr(settings, 'MESSENGER_MESSAGES', {}).get(name, default)
+
+
+def save_messages(entries):
+    """
+    Сохраняет пачку (chatroom, user, text) одной транзакцией: одна вставка сообщений,
+    превью - по запросу на чат, счетчики непрочитанных - по запросу на пару чат-отправитель
+    """
+    created_at = datetime.now(UTC)
+    messages = [Message(chatroom=chatroom, user=user, text=text, created_at=created_at)
+                for chatroom, user, text in entries]
+    last_messages = {}
+    sent = Counter()
+    for message in messages:
+        last_messages[message.chatroom_id] = message
+        sent[(message.chatroom_id, message.user_id)] += 1
+
+    with transaction.atomic():
+        Message.objects.bulk_create(messages)
+        for message in last_messages.values():
+            touch_chatroom(message)
+        for (chatroom_id, sender_id), count in sent.items():
+            increment_unread(chatroom_id, sender_id, count)
+    return messages
+
+
 @sync_to_async
 def create_message(chatroom, user, text):
-    message = Message.objects.create(
-        chatroom=chatroom,
-        user=user,
-        text=text,
-        created_at=datetime.now(UTC),
-    )
-    return message
+    # Сообщение, превью чата и счетчики непрочитанных меняются вместе
+    return save_messages([(chatroom, user, text)])[0]
+
+
+def save_each(entries):
+    # Каждая запись своей транзакцией: ошибка остается у отправителя записи, а не у всей пачки
+    results = []
+    for entry in entries:
+        try:
+            results.append(save_messages([entry])[0])
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+async def publish_messages(messages):
+    try:
+        # Рассылка после фиксации транзакции, в порядке отправки
+        await notify_new_messages(messages)
+    except Exception as e:
+        # Сообщения уже сохранены: отправитель получает их, даже если рассылка не удалась
+        print(f"Error publishing {len(messages)} messages: {e}")
+
+
+async def write_messages(entries):
+    messages = await sync_to_async(save_messages)(entries)
+    await publish_messages(messages)
+    return messages
+
+
+async def write_batch(entries):
+    """Пишет пачку одной вставкой, а если она не прошла - каждую запись отдельно"""
+    try:
+        return await write_messages(entries)
+    except Exception as e:
+        if len(entries) == 1:
+            raise
+        print(f"Error saving batch of {len(entries)} messages, saving one by one: {e}")
+    results = await sync_to_async(save_each)(entries)
+    await publish_messages([result for result in results if not isinstance(result, Exception)])
+    return results
+
+
+# Одновременные отправки за окно пишутся одной вставкой
+message_writer = WriteBatcher(write_batch, get_message_setting('BATCH_WINDOW', 0.005),
+                              get_message_setting('MAX_BATCH_SIZE', 500))
 
 
 async def resolve_send_message(self, info, access_token, chatroom_name, text):
-    user = await sync_to_async(get_user_from_token)(access_token)
+    user = await aget_user_from_token(access_token)
     if not user:
         raise ValueError("Invalid access token")
 
     # Получаем чат
     chatroom = await get_chat_by_name(chatroom_name)
 
-    # Создаем сообщение
-    message = await create_message(chatroom, user, text)
+    # Сообщение сохраняется вместе с другими отправками окна, уведомление уходит после записи
+    return await message_writer.submit((chatroom, user, text))
 
-    # Уведомляем всех участников чата о новом сообщении
-    await notify_new_message(chatroom_name, message)
 
-    # Возвращаем новое сообщение
-    return message
+async def resolve_send_messages(self, info, access_token, chatroom_name, texts):
+    user = await aget_user_from_token(access_token)
+    if not user:
+        raise ValueError("Invalid access token")
+    if len(texts) > get_message_setting('MAX_BATCH_SIZE', 500):
+        raise ValueError("Too many messages in one request")
+
+    chatroom = await get_chat_by_name(chatroom_name)
+
+    # Токен и чат проверяются один раз на всю пачку
+    return await write_messages([(chatroom, user, text) for text in texts])
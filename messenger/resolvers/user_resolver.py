@@ -4,10 +4,15 @@ import jwt
 from django.contrib.auth.hashers import check_password, make_password
 from django.core.exceptions import ValidationError
 from django.core.validators import validate_email
+from django.db import transaction
 from graphql import GraphQLError
 from starlette.responses import JSONResponse
 
 from messenger.models import User
+from messenger.optimizer import optimize, graphene_selection
+from messenger.search import search_by_name
+from messenger.thumbnails import generate_thumbnails
+from messenger.uploads import validate_avatar
 
 from myproject.settings import SECRET_KEY
 
@@ -55,11 +60,11 @@ def refresh_access_token(refresh_token):
 
 
 def resolve_users(self, info):
-    return User.objects.all()
+    return optimize(User.objects.all(), graphene_selection(info), prefetch=False)
 
 
 def resolve_user_by_id(self, info, id):
-    return User.objects.get(id=id)
+    return optimize(User.objects.all(), graphene_selection(info), prefetch=False).get(id=id)
 
 
 def resolve_user_register(self, info, user):
@@ -90,6 +95,9 @@ def resolve_user_register(self, info, user):
     if User.objects.filter(name=name).exists():
         raise GraphQLError("User with this name already exists")
 
+    if avatar:
+        validate_avatar(avatar)
+
     hashed_password = make_password(password)
 
     user = User.objects.create(
@@ -98,6 +106,8 @@ def resolve_user_register(self, info, user):
         password=hashed_password,
         avatar=avatar
     )
+    # Превью аватара строятся в фоне, регистрация их не ждет
+    generate_thumbnails(user.avatar)
 
     access_token = create_access_token(user)
 
@@ -145,46 +155,57 @@ def resolve_access_token(self, info, refresh_token):
 
 
 def resolve_update_user(self, info, new_user):
-    user = info.context.user
-    if user is None:
+    if info.context.user is None:
         raise GraphQLError("Invalid access token")
 
     request = info.context
 
-    if new_user.get('name'):
-        if len(new_user.get('name')) > 4:
-            if User.objects.filter(name=new_user['name']).exclude(id=user.id):
-                raise GraphQLError("User with this name already exists")
-            user.name = new_user['name']
-        else:
-            raise GraphQLError("Name must be more than 4 characters")
-
-    if new_user.get('email'):
-        try:
-            validate_email(new_user.get('email'))
-        except ValidationError:
-            raise GraphQLError("Invalid email")
-        if User.objects.filter(email=new_user['email']).exclude(id=user.id):
-            raise GraphQLError("User with this email already exists")
-        user.email = new_user['email']
-
-    if new_user.get('password'):
-        if len(new_user.get('password')) > 7:
-            user.set_password(new_user['password'])
-        else:
-            raise GraphQLError("Password must be more than 7 characters")
-
-    if new_user.get('avatar'):
-        user.avatar = new_user['avatar']
+    with transaction.atomic():
+        # Пользователь из кэша может отставать от базы (кэш у каждого процесса свой),
+        # поэтому меняем свежую строку под блокировкой и пишем только измененные поля
+        user = User.objects.select_for_update().get(id=info.context.user.id)
+        changed_fields = []
+
+        if new_user.get('name'):
+            if len(new_user.get('name')) > 4:
+                if User.objects.filter(name=new_user['name']).exclude(id=user.id):
+                    raise GraphQLError("User with this name already exists")
+                user.name = new_user['name']
+                changed_fields.append('name')
+            else:
+                raise GraphQLError("Name must be more than 4 characters")
+
+        if new_user.get('email'):
+            try:
+                validate_email(new_user.get('email'))
+            except ValidationError:
+                raise GraphQLError("Invalid email")
+            if User.objects.filter(email=new_user['email']).exclude(id=user.id):
+                raise GraphQLError("User with this email already exists")
+            user.email = new_user['email']
+            changed_fields.append('email')
+
+        if new_user.get('password'):
+            if len(new_user.get('password')) > 7:
+                user.set_password(new_user['password'])
+                changed_fields.append('password')
+            else:
+                raise GraphQLError("Password must be more than 7 characters")
+
+        if new_user.get('avatar'):
+            user.avatar = validate_avatar(new_user['avatar'])
+            changed_fields.append('avatar')
+            transaction.on_commit(lambda: generate_thumbnails(user.avatar))
+
+        if changed_fields:
+            user.save(update_fields=changed_fields + ['updated_at'])
+
+    from messenger.middlewares import user_cache
+    user_cache.invalidate(user.id)
 
-    user.save()
-
-    # Получаем обновленного пользователя
-    updated_user = User.objects.get(id=user.id)
-
-    access_token = create_access_token(updated_user)
+    access_token = create_access_token(user)
 
-    refresh_token = create_refresh_token(updated_user)
+    refresh_token = create_refresh_token(user)
 
     request._access_token = access_token
     request._refresh_token = refresh_token
@@ -195,8 +216,11 @@ def resolve_update_user(self, info, new_user):
 
 def resolve_re_login(self, info):
     from messenger.graphene import ReLoginResponseType
+    from messenger.middlewares import get_user
     user = info.context.user
     if user:
+        # В запросах пользователь собран из токена, а здесь он возвращается целиком
+        user = get_user(user.id)
         temp_token = create_access_token(user)
         return ReLoginResponseType(message="User logged in successfully", temp_token=temp_token, user=user)
 
@@ -207,7 +231,8 @@ def resolve_get_users_per_query(self, info, search_query, excludes=None):
     this_user = info.context.user
     if not this_user:
         raise GraphQLError("Invalid access token")
-    users = User.objects.filter(name__icontains=search_query).exclude(id=this_user.id)
+    users = optimize(search_by_name(User.objects.exclude(id=this_user.id), search_query),
+                     graphene_selection(info), prefetch=False)
 
     if excludes:
         users = users.exclude(id__in=excludes)
@@ -0,0 +1,94 @@
+from django.contrib.postgres.lookups import TrigramSimilar
+from django.contrib.postgres.search import TrigramSimilarity
+from django.db import connections
+from django.db.models import Case, Q, Value, When
+from django.db.models.expressions import RawSQL
+from django.db.models.functions import Length, Upper
+
+# Таблицы, по имени которых идет поиск
+SEARCH_TABLES = ('messenger_user', 'messenger_chatroom')
+
+# Триграммный индекс FTS5 не ищет строки короче трех символов
+FTS_MIN_LENGTH = 3
+
+
+def search_by_name(queryset, query):
+    """
+    Поиск по началу имени и по вхождению, с ранжированием и стабильным порядком для LIMIT:
+    сначала совпадения с начала имени, затем более похожие, затем по имени и id.
+    Postgres - индекс pg_trgm, SQLite - виртуальная таблица FTS5 с триграммами.
+    """
+    query = (query or '').strip()
+    if not query:
+        return queryset.order_by('name', 'id')
+
+    prefix = Case(When(name__istartswith=query, then=Value(0)), default=Value(1))
+    vendor = connections[queryset.db].vendor
+
+    if vendor == 'postgresql':
+        # Индекс построен по UPPER(name), тем же выражением, что использует icontains.
+        # Оператор % добавляет нечеткие совпадения (опечатки)
+        return queryset.filter(Q(name__icontains=query) | Q(TrigramSimilar(Upper('name'), Value(query.upper())))) \
+            .annotate(search_prefix=prefix, search_similarity=TrigramSimilarity(Upper('name'), Value(query.upper()))) \
+            .order_by('search_prefix', '-search_similarity', 'name', 'id')
+
+    if vendor == 'sqlite' and len(query) >= FTS_MIN_LENGTH:
+        table = f'{queryset.model._meta.db_table}_search'
+        phrase = '"' + query.replace('"', '""') + '"'
+        queryset = queryset.filter(id__in=RawSQL(f'SELECT rowid FROM {table} WHERE {table} MATCH %s', [phrase]))
+    else:
+        queryset = queryset.filter(name__icontains=query)
+
+    # Без pg_trgm похожесть оцениваем длиной: короткое имя ближе к запросу
+    return queryset.annotate(search_prefix=prefix, search_length=Length('name')) \
+        .order_by('search_prefix', 'search_length', 'name', 'id')
+
+
+def install_search_index(connection, rebuild=False):
+    """Создает индексы поиска; повторный вызов безопасен. rebuild=True заново наполняет FTS5 на SQLite"""
+    if connection.vendor == 'postgresql':
+        with connection.cursor() as cursor:
+            cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            for table in SEARCH_TABLES:
+                cursor.execute(f'CREATE INDEX IF NOT EXISTS {table}_name_trgm_idx '
+                               f'ON {table} USING gin (UPPER(name) gin_trgm_ops)')
+        return
+
+    if connection.vendor != 'sqlite':
+        return
+
+    with connection.cursor() as cursor:
+        for table in SEARCH_TABLES:
+            search = f'{table}_search'
+            cursor.execute(f"CREATE VIRTUAL TABLE IF NOT EXISTS {search} USING fts5("
+                           f"name, content='{table}', content_rowid='id', tokenize='trigram')")
+            # Перестройка таблицы в миграциях SQLite удаляет триггеры, поэтому создаем их без ошибок при повторе
+            cursor.execute(f"SELECT count(*) FROM sqlite_master WHERE type = 'trigger' AND tbl_name = %s "
+                           f"AND name LIKE %s", [table, f'{search}_%'])
+            missing = cursor.fetchone()[0] < 3
+            cursor.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS {search}_insert AFTER INSERT ON {table} BEGIN
+                    INSERT INTO {search}(rowid, name) VALUES (new.id, new.name);
+                END""")
+            cursor.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS {search}_delete AFTER DELETE ON {table} BEGIN
+                    INSERT INTO {search}({search}, rowid, name) VALUES ('delete', old.id, old.name);
+                END""")
+            cursor.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS {search}_update AFTER UPDATE OF name ON {table} BEGIN
+                    INSERT INTO {search}({search}, rowid, name) VALUES ('delete', old.id, old.name);
+                    INSERT INTO {search}(rowid, name) VALUES (new.id, new.name);
+                END""")
+            if missing or rebuild:
+                cursor.execute(f"INSERT INTO {search}({search}) VALUES ('rebuild')")
+
+
+def uninstall_search_index(connection):
+    with connection.cursor() as cursor:
+        for table in SEARCH_TABLES:
+            if connection.vendor == 'postgresql':
+                cursor.execute(f'DROP INDEX IF EXISTS {table}_name_trgm_idx')
+            elif connection.vendor == 'sqlite':
+                for suffix in ('insert', 'delete', 'update'):
+                    cursor.execute(f'DROP TRIGGER IF EXISTS {table}_search_{suffix}')
+                cursor.execute(f'DROP TABLE IF EXISTS {table}_search')
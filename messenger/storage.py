@@ -0,0 +1,117 @@
+import hashlib
+import os
+import re
+import tempfile
+import time
+
+from django.core.files.storage import FileSystemStorage
+
+BLOB_DIR = 'blobs'
+
+_EXTENSION = re.compile(r'^\.[a-z0-9]{1,5}$')
+
+
+class AtomicFileSystemStorage(FileSystemStorage):
+    """
+    Файл пишется кусками во временный файл в том же каталоге и появляется под своим именем
+    одной операцией link: читатели никогда не видят недописанный аватар
+    """
+
+    def _write_temp(self, directory, content, digest=None):
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.upload-')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                for chunk in content.chunks():
+                    if digest is not None:
+                        digest.update(chunk)
+                    file.write(chunk)
+            if self.file_permissions_mode is not None:
+                os.chmod(temp_path, self.file_permissions_mode)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+        return temp_path
+
+    def _save(self, name, content):
+        full_path = self.path(name)
+        temp_path = self._write_temp(os.path.dirname(full_path), content)
+        try:
+            while True:
+                try:
+                    # link, в отличие от rename, не перезаписывает существующий файл
+                    os.link(temp_path, full_path)
+                    break
+                except FileExistsError:
+                    name = self.get_available_name(name)
+                    full_path = self.path(name)
+        finally:
+            os.unlink(temp_path)
+        return str(name).replace('\\', '/')
+
+
+class ContentAddressedStorage(AtomicFileSystemStorage):
+    """
+    Хранит файлы под sha256 содержимого (blobs/ab/<sha256>.png): одинаковые загрузки
+    становятся одним файлом. Файл может быть общим для нескольких строк, поэтому delete()
+    ничего не удаляет - файлы без ссылок убирает команда collect_media_garbage.
+    Производные файлы (превью) пишутся через derived под точными именами
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.derived = AtomicFileSystemStorage(*args, **kwargs)
+
+    @staticmethod
+    def blob_name(digest, extension=''):
+        return f'{BLOB_DIR}/{digest[:2]}/{digest}{extension}'
+
+    def get_available_name(self, name, max_length=None):
+        # Имя все равно заменяется хэшем, проверять занятость исходного имени незачем
+        return name
+
+    def _save(self, name, content):
+        digest = hashlib.sha256()
+        temp_path = self._write_temp(self.path(BLOB_DIR), content, digest)
+        try:
+            extension = os.path.splitext(name)[1].lower()
+            name = self.blob_name(digest.hexdigest(), extension if _EXTENSION.match(extension) else '')
+            full_path = self.path(name)
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            try:
+                os.link(temp_path, full_path)
+            except FileExistsError:
+                # Такой файл уже загружали. Обновляем время, чтобы сборщик не удалил его до сохранения строки
+                os.utime(full_path)
+        finally:
+            os.unlink(temp_path)
+        return name
+
+    def delete(self, name):
+        pass
+
+    def blobs(self, older_than=None):
+        """Имена всех файлов-блобов; older_than - только измененные раньше этого времени"""
+        root = self.path(BLOB_DIR)
+        for directory, _, filenames in os.walk(root):
+            if os.path.basename(directory) == 'thumbs':
+                continue
+            for filename in filenames:
+                if filename.startswith('.upload-'):
+                    continue
+                path = os.path.join(directory, filename)
+                if older_than is not None and os.path.getmtime(path) >= older_than:
+                    continue
+                yield os.path.relpath(path, self.location).replace(os.sep, '/')
+
+    def remove_blob(self, name):
+        super().delete(name)
+
+    def orphans(self, references, grace=3600):
+        """
+        Блобы без ссылок. Свежие файлы пропускаются: строка, которая на них сошлется,
+        может быть еще не зафиксирована
+        """
+        for name in self.blobs(older_than=time.time() - grace):
+            if not references.get(name):
+                yield name
@@ -1,5 +1,6 @@
 import asyncio
 from collections import defaultdict
+from contextlib import aclosing
 from datetime import datetime
 from typing import Optional, List, AsyncGenerator, Dict, Set
 from asyncio import Queue, create_task
@@ -7,11 +8,35 @@ from venv import logger
 
 import jwt
 import strawberry
-from asgiref.sync import sync_to_async
+from asgiref.sync import sync_to_async, async_to_sync
+from django.db import transaction
+from django.db.models import Q, Subquery
 from strawberry.types import Info
 
-from messenger.middlewares import get_user_from_token
-from messenger.models import Message
+from messenger.activity import refresh_after_delete
+from messenger.broadcast import get_broadcast_backend
+from messenger.coalescer import Coalescer
+from messenger.dispatch import event_dispatcher
+from messenger.loop_monitor import LoopMonitorExtension
+from messenger.middlewares import aget_user_from_token
+from messenger.models import Message, Chatroom
+from messenger.optimizer import optimize, strawberry_selection, find
+from messenger.pagination import keyset_page, encode_cursor
+from messenger.subscriptions import SubscriberQueue, SubscriberDisconnected, start_stats_reporter, \
+    get_subscription_setting
+from messenger.thumbnails import thumbnail_urls
+from messenger.unread import decrement_unread
+
+
+@strawberry.type
+class AvatarThumbnailTypeStrawberry:
+    size: int
+    url: str
+
+
+def thumbnail_list(avatar) -> List[AvatarThumbnailTypeStrawberry]:
+    # Ссылки выводятся из имени аватара, поэтому работают и для моделей, и для данных из рассылки
+    return [AvatarThumbnailTypeStrawberry(size=size, url=url) for size, url in thumbnail_urls(avatar)]
 
 
 @strawberry.type
@@ -25,6 +50,10 @@ class UserTypeStrawberry:
     created_at: datetime
     updated_at: datetime
 
+    @strawberry.field
+    def avatar_thumbnails(self) -> List[AvatarThumbnailTypeStrawberry]:
+        return thumbnail_list(self.avatar)
+
 
 @strawberry.type
 class ChatroomTypeStrawberry:
@@ -37,14 +66,19 @@ class ChatroomTypeStrawberry:
     updated_at: datetime
 
     @strawberry.field
-    def messages(self, info) -> List['MessageTypeStrawberry']:
-        # Получение сообщений для чата
-        return Message.objects.filter(chatroom_id=self.id).order_by('created_at')
+    async def messages(self, info: Info, first: Optional[int] = None, after: Optional[str] = None,
+                       last: Optional[int] = None, before: Optional[str] = None) -> 'MessageConnectionTypeStrawberry':
+        # История чата страницами по курсору, размер страницы ограничен MAX_PAGE_SIZE
+        return await message_page(info, Message.objects.filter(chatroom_id=self.id), first, after, last, before)
 
     @strawberry.field
     def max_participants_count(self) -> int:
         return self.max_participants
 
+    @strawberry.field
+    def avatar_thumbnails(self) -> List[AvatarThumbnailTypeStrawberry]:
+        return thumbnail_list(self.avatar)
+
 
 @strawberry.type
 class MessageTypeStrawberry:
@@ -58,6 +92,200 @@ class MessageTypeStrawberry:
     updated_at: datetime
 
 
+def serialize_user(user):
+    # Событие уходит через брокер всем воркерам: хэш пароля и список чатов пользователя в него не попадают
+    return {
+        'id': user.id,
+        'name': user.name,
+        'email': user.email,
+        'avatar': str(user.avatar) if user.avatar else None,
+        'created_at': user.created_at.isoformat(),
+        'updated_at': user.updated_at.isoformat(),
+    }
+
+
+def serialize_chatroom(chatroom, participants=()):
+    return {
+        'id': chatroom.id,
+        'name': chatroom.name,
+        'avatar': str(chatroom.avatar) if chatroom.avatar else None,
+        'participants': [serialize_user(user) for user in participants],
+        'max_participants': chatroom.max_participants,
+        'created_at': chatroom.created_at.isoformat(),
+        'updated_at': chatroom.updated_at.isoformat(),
+    }
+
+
+def serialize_message(message):
+    """
+    Собирает данные сообщения для рассылки один раз на событие. Результат - простой dict,
+    его можно передать через брокер и отдать всем подписчикам без повторных запросов к базе.
+    """
+    return serialize_messages([message])[0]
+
+
+def serialize_messages(messages):
+    # Пачка сообщений сериализуется теми же запросами, что и одно, в исходном порядке
+    loaded_messages = Message.objects.select_related('user', 'chatroom') \
+        .prefetch_related('chatroom__participants') \
+        .in_bulk([message.id for message in messages])
+    return [serialize_loaded_message(loaded_messages[message.id]) for message in messages]
+
+
+def serialize_loaded_message(message):
+    return {
+        'id': message.id,
+        'chatroom': serialize_chatroom(message.chatroom, message.chatroom.participants.all()),
+        'user': serialize_user(message.user),
+        'text': message.text,
+        'is_chat': message.is_chat,
+        'is_favorite': message.is_favorite,
+        'created_at': message.created_at.isoformat(),
+        'updated_at': message.updated_at.isoformat(),
+    }
+
+
+def user_from_payload(payload) -> UserTypeStrawberry:
+    return UserTypeStrawberry(
+        id=payload['id'],
+        name=payload['name'],
+        email=payload['email'],
+        password='',
+        avatar=payload['avatar'],
+        chatroom=(),
+        created_at=datetime.fromisoformat(payload['created_at']),
+        updated_at=datetime.fromisoformat(payload['updated_at']),
+    )
+
+
+def chatroom_from_payload(payload) -> ChatroomTypeStrawberry:
+    return ChatroomTypeStrawberry(
+        id=payload['id'],
+        name=payload['name'],
+        avatar=payload['avatar'],
+        participants=tuple(user_from_payload(user) for user in payload['participants']),
+        max_participants=payload['max_participants'],
+        created_at=datetime.fromisoformat(payload['created_at']),
+        updated_at=datetime.fromisoformat(payload['updated_at']),
+    )
+
+
+def message_from_payload(payload) -> MessageTypeStrawberry:
+    return MessageTypeStrawberry(
+        id=payload['id'],
+        chatroom=chatroom_from_payload(payload['chatroom']),
+        user=user_from_payload(payload['user']),
+        text=payload['text'],
+        is_chat=payload['is_chat'],
+        is_favorite=payload['is_favorite'],
+        created_at=datetime.fromisoformat(payload['created_at']),
+        updated_at=datetime.fromisoformat(payload['updated_at']),
+    )
+
+
+def loaded(obj, name):
+    """
+    Значение поля, только если оно уже загружено: колонки вне only() и связи без
+    select_related/prefetch_related не запрашиваются (клиент их и не выбирал).
+    """
+    if name in obj.get_deferred_fields():
+        return None
+    field = obj._meta.get_field(name)
+    if field.many_to_many or field.one_to_many:
+        if name not in getattr(obj, '_prefetched_objects_cache', {}):
+            return []
+        return list(getattr(obj, name).all())
+    if field.is_relation and not field.is_cached(obj):
+        return None
+    return getattr(obj, name)
+
+
+def user_to_strawberry(user) -> UserTypeStrawberry:
+    return UserTypeStrawberry(
+        id=user.id,
+        name=loaded(user, 'name'),
+        email=loaded(user, 'email'),
+        password=loaded(user, 'password'),
+        avatar=loaded(user, 'avatar'),
+        chatroom=[chatroom_to_strawberry(chatroom) for chatroom in loaded(user, 'chatroom')],
+        created_at=loaded(user, 'created_at'),
+        updated_at=loaded(user, 'updated_at'),
+    )
+
+
+def chatroom_to_strawberry(chatroom) -> ChatroomTypeStrawberry:
+    return ChatroomTypeStrawberry(
+        id=chatroom.id,
+        name=loaded(chatroom, 'name'),
+        avatar=loaded(chatroom, 'avatar'),
+        participants=[user_to_strawberry(user) for user in loaded(chatroom, 'participants')],
+        max_participants=loaded(chatroom, 'max_participants'),
+        created_at=loaded(chatroom, 'created_at'),
+        updated_at=loaded(chatroom, 'updated_at'),
+    )
+
+
+def message_to_strawberry(message) -> MessageTypeStrawberry:
+    # Собираются только поля, загруженные оптимизатором по запросу клиента
+    chatroom = loaded(message, 'chatroom')
+    user = loaded(message, 'user')
+    return MessageTypeStrawberry(
+        id=message.id,
+        chatroom=chatroom_to_strawberry(chatroom) if chatroom else None,
+        user=user_to_strawberry(user) if user else None,
+        text=loaded(message, 'text'),
+        is_chat=loaded(message, 'is_chat'),
+        is_favorite=loaded(message, 'is_favorite'),
+        created_at=loaded(message, 'created_at'),
+        updated_at=loaded(message, 'updated_at'),
+    )
+
+
+@strawberry.type
+class PageInfoTypeStrawberry:
+    has_next_page: bool
+    has_previous_page: bool
+    start_cursor: Optional[str] = None
+    end_cursor: Optional[str] = None
+
+
+@strawberry.type
+class MessageEdgeTypeStrawberry:
+    cursor: str
+    node: MessageTypeStrawberry
+
+
+@strawberry.type
+class MessageConnectionTypeStrawberry:
+    edges: List[MessageEdgeTypeStrawberry]
+    page_info: PageInfoTypeStrawberry
+
+
+def message_connection(messages, has_next_page, has_previous_page) -> MessageConnectionTypeStrawberry:
+    edges = [
+        MessageEdgeTypeStrawberry(cursor=encode_cursor(message.created_at, message.id),
+                                  node=message_to_strawberry(message))
+        for message in messages
+    ]
+    return MessageConnectionTypeStrawberry(
+        edges=edges,
+        page_info=PageInfoTypeStrawberry(
+            has_next_page=has_next_page,
+            has_previous_page=has_previous_page,
+            start_cursor=edges[0].cursor if edges else None,
+            end_cursor=edges[-1].cursor if edges else None,
+        ),
+    )
+
+
+async def message_page(info, queryset, first=None, after=None, last=None, before=None) -> MessageConnectionTypeStrawberry:
+    # created_at нужен для курсоров, даже если клиент его не запросил
+    queryset = optimize(queryset, find(strawberry_selection(info), 'edges', 'node'), fields=('created_at',))
+    messages, has_next_page, has_previous_page = await sync_to_async(keyset_page)(
+        queryset, first=first, after=after, last=last, before=before)
+    return message_connection(messages, has_next_page, has_previous_page)
+
+
 @strawberry.type
 class ResponseTypeStrawberry:
     message: str
@@ -68,119 +296,232 @@ class MessagesCountType:
     count: int
 
 
-class ChatroomMessagesSubscription:
-    def __init__(self):
-        self.queues: Dict[str, Set[Queue]] = defaultdict(set)
+@strawberry.type
+class ReadReceiptTypeStrawberry:
+    chatroom_id: int
+    user_id: int
+    last_read_message_id: int
+
 
-    def add_subscriber(self, chatroom_name: str, queue: Queue):
-        self.queues[chatroom_name].add(queue)
+class ChatroomMessagesSubscription:
+    """
+    Реестр подписок на сообщения по id чата. Для каждой очереди хранится набор ее чатов,
+    поэтому при отключении удаляются все ее регистрации, а чаты можно добавлять и убирать на лету.
+    """
 
-    def remove_subscriber(self, chatroom_name: str, queue: Queue):
-        if chatroom_name in self.queues:
-            self.queues[chatroom_name].discard(queue)
-            if not self.queues[chatroom_name]:
-                del self.queues[chatroom_name]
+    def __init__(self):
+        self.queues: Dict[int, Set[SubscriberQueue]] = defaultdict(set)  # chatroom_id -> очереди
+        self.chatrooms: Dict[SubscriberQueue, Set[int]] = {}  # очередь -> chatroom_id
+        self.users: Dict[int, Set[SubscriberQueue]] = defaultdict(set)  # user_id -> очереди
+        self.owners: Dict[SubscriberQueue, int] = {}  # очередь -> user_id
+
+    def add_subscriber(self, chatroom_id: int, queue: SubscriberQueue):
+        self.queues[chatroom_id].add(queue)
+        self.chatrooms.setdefault(queue, set()).add(chatroom_id)
+
+    def remove_subscriber(self, chatroom_id: int, queue: SubscriberQueue):
+        if chatroom_id in self.queues:
+            self.queues[chatroom_id].discard(queue)
+            if not self.queues[chatroom_id]:
+                del self.queues[chatroom_id]
+        if queue in self.chatrooms:
+            self.chatrooms[queue].discard(chatroom_id)
+
+    def bind_user(self, user_id: int, queue: SubscriberQueue):
+        # Подписка пользователя следует за его участием в чатах
+        self.users[user_id].add(queue)
+        self.owners[queue] = user_id
+        self.chatrooms.setdefault(queue, set())
+
+    def unsubscribe(self, queue: SubscriberQueue):
+        """Удаляет все регистрации очереди"""
+        for chatroom_id in self.chatrooms.pop(queue, ()):
+            self.queues[chatroom_id].discard(queue)
+            if not self.queues[chatroom_id]:
+                del self.queues[chatroom_id]
+        user_id = self.owners.pop(queue, None)
+        if user_id is not None:
+            self.users[user_id].discard(queue)
+            if not self.users[user_id]:
+                del self.users[user_id]
+
+    def add_user_chatroom(self, user_ids, chatroom_id: int):
+        for user_id in user_ids:
+            for queue in self.users.get(user_id, ()):
+                self.add_subscriber(chatroom_id, queue)
+
+    def remove_user_chatroom(self, user_ids, chatroom_id: int):
+        for user_id in user_ids:
+            for queue in self.users.get(user_id, ()):
+                self.remove_subscriber(chatroom_id, queue)
+
+    def remove_chatroom(self, chatroom_id: int):
+        for queue in self.queues.pop(chatroom_id, ()):
+            self.chatrooms[queue].discard(chatroom_id)
+
+    def apply_membership(self, chatroom_id: int, added_user_ids, removed_user_ids, deleted=False):
+        if deleted:
+            self.remove_chatroom(chatroom_id)
+            return
+        self.add_user_chatroom(added_user_ids, chatroom_id)
+        self.remove_user_chatroom(removed_user_ids, chatroom_id)
+
+    async def listen(self, chatroom_ids, user_id: int):
+        """Регистрирует очередь на время жизни генератора и отдает приходящие сообщения"""
+        queue = SubscriberQueue()
+        self.bind_user(user_id, queue)
+        for chatroom_id in chatroom_ids:
+            self.add_subscriber(chatroom_id, queue)
+        try:
+            while True:
+                yield await queue.next()
+        except SubscriberDisconnected:
+            return
+        finally:
+            self.unsubscribe(queue)
 
-    async def notify_subscribers(self, chatroom_name: str, message: MessageTypeStrawberry):
-        if chatroom_name in self.queues:
+    async def notify_subscribers(self, chatroom_id: int, message: MessageTypeStrawberry):
+        # Не ждем медленных подписчиков: очередь сама применяет политику переполнения
+        if chatroom_id in self.queues:
             dead_queues = set()
-            for queue in self.queues[chatroom_name]:
-                try:
-                    await queue.put(message)
-                except asyncio.QueueFull:
+            for queue in self.queues[chatroom_id]:
+                if not queue.offer(message):
                     dead_queues.add(queue)
             for queue in dead_queues:
-                self.remove_subscriber(chatroom_name, queue)
+                self.unsubscribe(queue)
 
 
+CHATROOM_MEMBERSHIP = 'chatroom_membership'
+
 chatroom_messages_subscriptions = ChatroomMessagesSubscription()
+read_receipt_subscriptions = ChatroomMessagesSubscription()
+event_dispatcher.register(CHATROOM_MEMBERSHIP, lambda event: chatroom_messages_subscriptions.apply_membership(*event))
+event_dispatcher.register(CHATROOM_MEMBERSHIP, lambda event: read_receipt_subscriptions.apply_membership(*event))
+
+
+def deliver_membership(chatroom_id, added_user_ids, removed_user_ids, deleted):
+    # Реестр меняется только в цикле событий подписок, поэтому идем через диспетчер
+    event_dispatcher.dispatch(CHATROOM_MEMBERSHIP, (chatroom_id, added_user_ids, removed_user_ids, deleted))
+
+
+async def deliver_message(chatroom_id, payload):
+    # Объект для GraphQL строится один раз и общий для всех подписчиков воркера, менять его нельзя
+    await chatroom_messages_subscriptions.notify_subscribers(chatroom_id, message_from_payload(payload))
+
+
+broadcast = get_broadcast_backend(deliver_message, deliver_membership)
+
+
+async def deliver_read_receipts(chatroom_id, receipts):
+    # Пачка отметок чата уходит подписчикам одним событием
+    await read_receipt_subscriptions.notify_subscribers(chatroom_id, [
+        ReadReceiptTypeStrawberry(chatroom_id=chatroom_id, user_id=user_id, last_read_message_id=message_id)
+        for user_id, message_id in receipts
+    ])
+
+
+read_broadcast = get_broadcast_backend(deliver_read_receipts, group='messenger.read_receipts')
+
+
+async def publish_read_receipts(cursors):
+    # Одна публикация на чат за окно, вместо события на каждое прочтение
+    receipts = defaultdict(list)
+    for (chatroom_id, user_id), message_id in cursors.items():
+        receipts[chatroom_id].append([user_id, message_id])
+    for chatroom_id, chatroom_receipts in receipts.items():
+        await read_broadcast.publish(chatroom_id, chatroom_receipts)
+
+
+# Курсор только растет, поэтому из нескольких прочтений за окно остается самое дальнее
+read_receipts = Coalescer(publish_read_receipts, get_subscription_setting('READ_RECEIPT_WINDOW', 0.5), merge=max)
 
 
 class ChatroomSubscriptions:
     def __init__(self):
-        self._subscribers: Dict[int, Queue] = {}  # user_id -> Queue
+        self._subscribers: Dict[int, Set[SubscriberQueue]] = defaultdict(set)  # user_id -> очереди
 
-    async def subscribe(self, user_id: int) -> Queue:
+    def subscribe(self, user_id: int) -> SubscriberQueue:
         """Создает новую подписку для пользователя"""
-        if user_id not in self._subscribers:
-            self._subscribers[user_id] = Queue()
-        return self._subscribers[user_id]
+        queue = SubscriberQueue()
+        self._subscribers[user_id].add(queue)
+        return queue
 
-    async def unsubscribe(self, user_id: int):
+    def unsubscribe(self, user_id: int, queue: SubscriberQueue):
         """Удаляет подписку пользователя"""
         if user_id in self._subscribers:
-            del self._subscribers[user_id]
-
-    async def notify_subscribers(self, chatroom):
-        """Уведомляет всех подписчиков о новом чате"""
-        for user_id, queue in self._subscribers.items():
-            try:
-                await queue.put(chatroom)
-            except Exception as e:
-                print(f"Error notifying user {user_id} about new chatroom: {e}")
+            self._subscribers[user_id].discard(queue)
+            if not self._subscribers[user_id]:
+                del self._subscribers[user_id]
+
+    def notify_subscribers(self, user_ids, chatroom):
+        """Уведомляет только перечисленных пользователей, без запросов к базе"""
+        for user_id in user_ids:
+            for queue in list(self._subscribers.get(user_id, ())):
+                try:
+                    if not queue.offer(chatroom):
+                        self.unsubscribe(user_id, queue)
+                except Exception as e:
+                    print(f"Error notifying user {user_id} about chatroom: {e}")
 
 
 chatroom_subscribers = ChatroomSubscriptions()
+chatroom_update_subscribers = ChatroomSubscriptions()
+chatroom_delete_subscribers = ChatroomSubscriptions()
+
+
+@sync_to_async
+def get_subscription_chatroom_ids(chatroom_ids, chatroom_names, user):
+    # Подписаться можно только на свои чаты, без списка - на все
+    user_chatroom_ids = set(Chatroom.objects.filter(participants=user.id).values_list('id', flat=True))
+    if not chatroom_ids and not chatroom_names:
+        return user_chatroom_ids
+    ids = set(chatroom_ids or ())
+    if chatroom_names:
+        # Имена поддерживаются для старых клиентов, дальше подписка работает только с id
+        ids |= set(Chatroom.objects.filter(name__in=chatroom_names).values_list('id', flat=True))
+    return ids & user_chatroom_ids
 
 
 @strawberry.type
 class Query:
     @strawberry.field
     async def get_messages(self, info: Info, chatroom_name: str, before_id: Optional[int] = None, limit: Optional[int] = 100) -> List[MessageTypeStrawberry]:
-        # Используем select_related для user и chatroom, и prefetch_related для связанных полей
-        query = Message.objects.filter(chatroom__name=chatroom_name)
+        # Связи и колонки подбираются по полям, которые запросил клиент
+        query = optimize(Message.objects.filter(chatroom__name=chatroom_name), strawberry_selection(info))
 
-        # Добавляем фильтрацию по before_id в SQL запрос
+        # Фильтр по before_id подзапросом, без отдельного запроса за самим сообщением
         if before_id is not None:
-            message = await sync_to_async(Message.objects.get)(id=before_id)
-            query = query.filter(created_at__lt=message.created_at)
+            before_created_at = Subquery(Message.objects.filter(id=before_id).values('created_at')[:1])
+            query = query.filter(Q(created_at__lt=before_created_at) | Q(created_at=before_created_at, id__lt=before_id))
 
         # Применяем сортировку и лимит
         messages = await sync_to_async(list)(
             query
-            .select_related('user', 'chatroom')
-            .prefetch_related('chatroom__participants', 'user__chatroom')
-            .order_by('-created_at')
+            .order_by('-created_at', '-id')
             [:limit]  # Применяем лимит здесь
         )
 
-        result = []
-
-        for message in messages:
-            # Теперь эти данные уже предзагружены
-            participants = list(message.chatroom.participants.all())
-            user_chatrooms = list(message.user.chatroom.all())
-
-            message_obj = MessageTypeStrawberry(
-                id=message.id,
-                chatroom=ChatroomTypeStrawberry(
-                    id=message.chatroom.id,
-                    name=message.chatroom.name,
-                    avatar=message.chatroom.avatar,
-                    participants=participants,
-                    max_participants=message.chatroom.max_participants,
-                    updated_at=message.chatroom.updated_at,
-                    created_at=message.chatroom.created_at
-                ),
-                user=UserTypeStrawberry(
-                    id=message.user.id,
-                    name=message.user.name,
-                    email=message.user.email,
-                    password=message.user.password,
-                    avatar=message.user.avatar,
-                    chatroom=user_chatrooms,
-                    created_at=message.user.created_at,
-                    updated_at=message.user.updated_at
-                ),
-                text=message.text,
-                is_chat=message.is_chat,
-                is_favorite=message.is_favorite,
-                created_at=message.created_at,
-                updated_at=message.updated_at,
-            )
-            result.append(message_obj)
-
-        return result
+        return [message_to_strawberry(message) for message in messages]
+
+    @strawberry.field
+    async def messages_connection(self, info: Info, chatroom_name: str, first: Optional[int] = None,
+                                  after: Optional[str] = None, last: Optional[int] = None,
+                                  before: Optional[str] = None) -> MessageConnectionTypeStrawberry:
+        return await message_page(info, Message.objects.filter(chatroom__name=chatroom_name),
+                                  first, after, last, before)
+
+
+def sent_message_to_strawberry(message) -> MessageTypeStrawberry:
+    return MessageTypeStrawberry(
+        id=message.id,
+        chatroom=message.chatroom,
+        user=message.user,
+        text=message.text,
+        is_chat=message.is_chat,
+        is_favorite=message.is_favorite,
+        created_at=message.created_at,
+        updated_at=message.updated_at,
+    )
 
 
 @strawberry.type
@@ -189,243 +530,269 @@ class Mutation:
     async def send_message(self, info: Info, access_token: str, chatroom_name: str, text: str) -> MessageTypeStrawberry:
         from messenger.resolvers.message_resolver import resolve_send_message
         message = await resolve_send_message(self, info, access_token, chatroom_name, text)
-        return MessageTypeStrawberry(
-            id=message.id,
-            chatroom=message.chatroom,
-            user=message.user,
-            text=message.text,
-            is_chat=message.is_chat,
-            is_favorite=message.is_favorite,
-            created_at=message.created_at,
-            updated_at=message.updated_at,
-        )
+        return sent_message_to_strawberry(message)
+
+    @strawberry.mutation
+    async def send_messages(self, info: Info, access_token: str, chatroom_name: str,
+                            texts: List[str]) -> List[MessageTypeStrawberry]:
+        from messenger.resolvers.message_resolver import resolve_send_messages
+        messages = await resolve_send_messages(self, info, access_token, chatroom_name, texts)
+        return [sent_message_to_strawberry(message) for message in messages]
 
     @strawberry.mutation
     async def change_message(self, info: Info, access_token: str, chatroom_name: str, message_id: strawberry.ID,
                        new_text: Optional[str] = None) -> ResponseTypeStrawberry:
-        user = sync_to_async(get_user_from_token)(access_token)
-        message = sync_to_async(Message.objects.filter(id=message_id).first())
-
-        if user == message.user:
-            message.is_read = True
-            message.save()
+        user = await aget_user_from_token(access_token)
+        message = await Message.objects.filter(id=message_id).afirst()
+        if message is None:
+            return ResponseTypeStrawberry(message="Сообщение не найдено")
 
+        if user.id == message.user_id:
             if new_text:
                 message.text = new_text
-                message.save()
+            await message.asave()
 
-            await notify_new_message(chatroom_name, message)
+            await notify_new_message(message.chatroom_id, message)
 
-            return ResponseTypeStrawberry("Сообщение успешно обновлено")
+            return ResponseTypeStrawberry(message="Сообщение успешно обновлено")
         else:
-            return ResponseTypeStrawberry("У вас нет прав для изменения этого сообщения")
+            return ResponseTypeStrawberry(message="У вас нет прав для изменения этого сообщения")
 
     @strawberry.mutation
     async def delete_message(self, info: Info, access_token: str, chatroom_name: str, message_id: strawberry.ID) -> ResponseTypeStrawberry:
-        user = sync_to_async(get_user_from_token)(access_token)
-        message = Message.objects.filter(id=message_id).first()
-        await notify_new_message(chatroom_name, message)
-        if user == message.user:
-            message.delete()
-            return ResponseTypeStrawberry("Сообщение успешно удалено")
+        user = await aget_user_from_token(access_token)
+        message = await Message.objects.filter(id=message_id).afirst()
+        if message is None:
+            return ResponseTypeStrawberry(message="Сообщение не найдено")
+
+        if user.id == message.user_id:
+            # Уведомление собирается из базы, поэтому отправляем его до удаления
+            await notify_new_message(message.chatroom_id, message)
+            await remove_message(message)
+            return ResponseTypeStrawberry(message="Сообщение успешно удалено")
         else:
-            return ResponseTypeStrawberry("У вас нет прав для удаления этого сообщения")
+            return ResponseTypeStrawberry(message="У вас нет прав для удаления этого сообщения")
 
 
 @strawberry.type
 class Subscription:
     @strawberry.subscription
-    async def chatroom_message(self, info: Info, chatroom_names: List[str]) -> AsyncGenerator[MessageTypeStrawberry, None]:
-        queue = Queue()
+    async def chatroom_message(self, info: Info, access_token: str, chatroom_ids: Optional[List[int]] = None,
+                               chatroom_names: Optional[List[str]] = None) -> AsyncGenerator[MessageTypeStrawberry, None]:
+        user = await aget_user_from_token(access_token, trust_claims=True)
+        if not user:
+            raise ValueError("Invalid access token")
+        ids = await get_subscription_chatroom_ids(chatroom_ids, chatroom_names, user)
 
-        for chatroom_name in chatroom_names:
-            chatroom_messages_subscriptions.add_subscriber(chatroom_name, queue)
+        await broadcast.start()
+        event_dispatcher.start()
+        start_stats_reporter()
 
-        try:
-            while True:
-                message = await queue.get()
-                print(message)
-                yield MessageTypeStrawberry(
-                    id=message.id,
-                    chatroom=ChatroomTypeStrawberry(
-                        id=message.chatroom.id,
-                        name=message.chatroom.name,
-                        avatar=message.chatroom.avatar,
-                        participants=message.chatroom.participants.all(),
-                        max_participants=message.chatroom.max_participants,
-                        updated_at=message.chatroom.updated_at,
-                        created_at=message.chatroom.created_at
-                    ),
-                    user=UserTypeStrawberry(
-                        id=message.user.id,
-                        name=message.user.name,
-                        email=message.user.email,
-                        password=message.user.password,
-                        avatar=message.user.avatar,
-                        chatroom=message.user.chatroom.all(),
-                        created_at=message.user.created_at,
-                        updated_at=message.user.updated_at
-                    ),
-                    text=message.text,
-                    is_chat=message.is_chat,
-                    is_favorite=message.is_favorite,
-                    created_at=message.created_at,
-                    updated_at=message.updated_at,
-                )
-        except asyncio.CancelledError:
-            chatroom_messages_subscriptions.remove_subscriber(chatroom_name, queue)
-            raise
-        finally:
-            chatroom_messages_subscriptions.remove_subscriber(chatroom_name, queue)
+        async with aclosing(chatroom_messages_subscriptions.listen(ids, user.id)) as messages:
+            async for message in messages:
+                yield message
+
+    @strawberry.subscription
+    async def read_receipts(self, info: Info, access_token: str, chatroom_ids: Optional[List[int]] = None
+                            ) -> AsyncGenerator[List[ReadReceiptTypeStrawberry], None]:
+        user = await aget_user_from_token(access_token, trust_claims=True)
+        if not user:
+            raise ValueError("Invalid access token")
+        ids = await get_subscription_chatroom_ids(chatroom_ids, None, user)
+
+        await read_broadcast.start()
+        event_dispatcher.start()
+
+        async with aclosing(read_receipt_subscriptions.listen(ids, user.id)) as receipts:
+            async for batch in receipts:
+                yield batch
 
     @strawberry.subscription
     async def new_chatroom(self, info: Info, access_token: str) -> AsyncGenerator[ChatroomTypeStrawberry, None]:
         try:
-            user = await sync_to_async(get_user_from_token)(access_token)
+            user = await aget_user_from_token(access_token, trust_claims=True)
             if not user:
                 raise ValueError("Invalid access token")
 
-            queue = asyncio.Queue()
-            chatroom_queues[user.id] = queue
+            await chatroom_broadcast.start()
+            event_dispatcher.start()
+            queue = chatroom_subscribers.subscribe(user.id)
 
             try:
                 while True:
-                    chatroom = await queue.get()
+                    # Получатели выбираются при отправке события, фильтровать здесь не нужно
+                    yield await queue.next()
 
-                    # Проверяем, является ли пользователь участником
-                    participants = await sync_to_async(list)(chatroom.participants)
-                    if user in participants:
-                        yield chatroom
+            except SubscriberDisconnected:
+                return
 
             except asyncio.CancelledError:
                 print(f"[User {user.id}] Subscription cancelled")
                 raise
 
+            finally:
+                chatroom_subscribers.unsubscribe(user.id, queue)
+
         except Exception as e:
             print(f"Error in subscription: {e}")
             raise
 
-        finally:
-            if user and user.id in chatroom_queues:
-                del chatroom_queues[user.id]
-
     @strawberry.subscription
     async def updated_chatroom(self, info: Info, access_token: str) -> AsyncGenerator[ChatroomTypeStrawberry, None]:
         try:
-            user = await sync_to_async(get_user_from_token)(access_token)
+            user = await aget_user_from_token(access_token, trust_claims=True)
             if not user:
                 raise ValueError("Invalid access token")
 
-            queue = asyncio.Queue()
-            chatroom_update_queues[user.id] = queue
+            await chatroom_broadcast.start()
+            event_dispatcher.start()
+            queue = chatroom_update_subscribers.subscribe(user.id)
 
             try:
                 while True:
-                    chatroom = await queue.get()
-                    # Проверяем, является ли пользователь участником
-                    participants = await sync_to_async(list)(chatroom.participants)
-                    yield chatroom
+                    # Получатели выбираются при отправке события, фильтровать здесь не нужно
+                    yield await queue.next()
+
+            except SubscriberDisconnected:
+                return
 
             except asyncio.CancelledError:
                 print(f"[User {user.id}] Update subscription cancelled")
                 raise
 
+            finally:
+                chatroom_update_subscribers.unsubscribe(user.id, queue)
+
         except Exception as e:
             print(f"Error in update subscription: {e}")
             raise
 
-        finally:
-            if user and user.id in chatroom_update_queues:
-                del chatroom_update_queues[user.id]
-
     @strawberry.subscription
     async def deleted_chatroom(self, info: Info, access_token: str) -> AsyncGenerator[ChatroomTypeStrawberry, None]:
         try:
-            user = await sync_to_async(get_user_from_token)(access_token)
+            user = await aget_user_from_token(access_token, trust_claims=True)
             if not user:
                 raise ValueError("Invalid access token")
 
-            queue = asyncio.Queue()
-            chatroom_delete_queues[user.id] = queue
+            await chatroom_broadcast.start()
+            event_dispatcher.start()
+            queue = chatroom_delete_subscribers.subscribe(user.id)
 
             try:
                 while True:
-                    chatroom = await queue.get()
-                    # Проверяем, является ли пользователь участником
-                    participants = await sync_to_async(list)(chatroom.participants)
-                    yield chatroom
+                    # Получатели выбираются при отправке события, фильтровать здесь не нужно
+                    yield await queue.next()
+
+            except SubscriberDisconnected:
+                return
 
             except asyncio.CancelledError:
                 print(f"[User {user.id}] Delete subscription cancelled")
                 raise
 
+            finally:
+                chatroom_delete_subscribers.unsubscribe(user.id, queue)
+
         except Exception as e:
             print(f"Error in delete subscription: {e}")
             raise
 
-        finally:
-            if user and user.id in chatroom_delete_queues:
-                del chatroom_delete_queues[user.id]
+
+@sync_to_async
+def remove_message(message):
+    # Сообщение, счетчики непрочитанных и превью чата меняются в одной транзакции
+    with transaction.atomic():
+        decrement_unread(message)
+        chatroom_id = message.chatroom_id
+        message.delete()
+        refresh_after_delete(chatroom_id)
 
 
 message_queues = {}
-chatroom_queues = {}
-chatroom_update_queues = {}
-chatroom_delete_queues = {}
 message_ready_event = asyncio.Event()
 
 
-async def notify_new_message(chatroom_name: str,  message: MessageTypeStrawberry):
-    await chatroom_messages_subscriptions.notify_subscribers(chatroom_name, message)
+async def notify_new_message(chatroom_id: int, message: Message):
+    # Сериализуем и публикуем один раз, каждый воркер сам доставит сообщение своим подписчикам
+    await broadcast.publish(chatroom_id, await sync_to_async(serialize_message)(message))
 
 
-async def notify_new_chatroom(chatroom: ChatroomTypeStrawberry):
-    try:
-        subscriber_ids = list(chatroom_queues.keys())
+async def notify_new_messages(messages):
+    # Пачка сериализуется одним набором запросов и публикуется в порядке отправки
+    payloads = await sync_to_async(serialize_messages)(messages)
+    for message, payload in zip(messages, payloads):
+        await broadcast.publish(message.chatroom_id, payload)
 
-        for user_id in subscriber_ids:
-            try:
-                queue = chatroom_queues.get(user_id)
-                if queue:
-                    await queue.put(chatroom)
-            except Exception as e:
-                print(f"Error notifying user {user_id}: {e}")
 
-    except Exception as e:
-        raise
+CHATROOM_CREATED = 'chatroom_created'
+CHATROOM_UPDATED = 'chatroom_updated'
+CHATROOM_DELETED = 'chatroom_deleted'
+READ_RECEIPT = 'read_receipt'
 
 
-async def notify_chatroom_update(chatroom: ChatroomTypeStrawberry):
-    try:
-        subscriber_ids = list(chatroom_update_queues.keys())
+def participant_ids(chatroom: ChatroomTypeStrawberry) -> Set[int]:
+    return {user.id for user in chatroom.participants}
+
+
+event_dispatcher.register(CHATROOM_CREATED, lambda event: chatroom_subscribers.notify_subscribers(*event))
+event_dispatcher.register(CHATROOM_UPDATED, lambda event: chatroom_update_subscribers.notify_subscribers(*event))
+event_dispatcher.register(CHATROOM_DELETED, lambda event: chatroom_delete_subscribers.notify_subscribers(*event))
+event_dispatcher.register(READ_RECEIPT, lambda event: read_receipts.add((event[0], event[1]), event[2]))
 
-        for user_id in subscriber_ids:
-            try:
-                queue = chatroom_update_queues.get(user_id)
-                if queue:
-                    await queue.put(chatroom)
-            except Exception as e:
-                print(f"Error notifying user {user_id}: {e}")
 
-    except Exception as e:
-        raise
+async def deliver_chatroom_event(chatroom_id, payload):
+    # Каждый воркер сам выбирает своих подписчиков из списка получателей события
+    event_dispatcher.dispatch(payload['kind'], (set(payload['user_ids']), chatroom_from_payload(payload['chatroom'])))
 
 
-async def notify_chatroom_delete(chatroom: ChatroomTypeStrawberry):
+chatroom_broadcast = get_broadcast_backend(deliver_chatroom_event, group='messenger.chatrooms')
+
+
+def run_publish(publish, *args):
+    # Публикация не ждет брокер в async коде и выполняется синхронно из потока резолвера
     try:
-        subscriber_ids = list(chatroom_delete_queues.keys())
-        for user_id in subscriber_ids:
-            try:
-                print('1')
-                queue = chatroom_delete_queues.get(user_id)
-                if queue:
-                    print('2')
-                    await queue.put(chatroom)
-            except Exception as e:
-                print(f"Error notifying user {user_id}: {e}")
+        asyncio.get_running_loop().create_task(publish(*args))
+    except RuntimeError:
+        async_to_sync(publish)(*args)
+
+
+def publish_membership(chatroom_id, added_user_ids, removed_user_ids=(), deleted=False):
+    # Подписки на сообщения, привязанные к пользователю, следуют за изменением участников на всех воркерах
+    run_publish(broadcast.publish_membership, chatroom_id, added_user_ids, removed_user_ids, deleted)
+
+
+def publish_chatroom_event(kind, user_ids, chatroom: ChatroomTypeStrawberry):
+    # Подписчики newChatroom/updatedChatroom/deletedChatroom могут быть на любом воркере
+    run_publish(chatroom_broadcast.publish, chatroom.id, {
+        'kind': kind,
+        'user_ids': list(user_ids),
+        'chatroom': serialize_chatroom(chatroom, chatroom.participants),
+    })
+
+
+# Уведомления о чатах не ждут рассылки и вызываются как из sync, так и из async кода.
+# participants у chatroom должен быть уже загруженным списком: по нему выбираются получатели
+def notify_new_chatroom(chatroom: ChatroomTypeStrawberry):
+    publish_chatroom_event(CHATROOM_CREATED, participant_ids(chatroom), chatroom)
+    publish_membership(chatroom.id, participant_ids(chatroom))
+
+
+def notify_chatroom_update(chatroom: ChatroomTypeStrawberry, removed_user_ids=()):
+    # Удаленные из чата пользователи тоже должны узнать об изменении
+    publish_chatroom_event(CHATROOM_UPDATED, participant_ids(chatroom) | set(removed_user_ids), chatroom)
+    publish_membership(chatroom.id, participant_ids(chatroom), set(removed_user_ids))
+
+
+def notify_chatroom_delete(chatroom: ChatroomTypeStrawberry):
+    publish_chatroom_event(CHATROOM_DELETED, participant_ids(chatroom), chatroom)
+    publish_membership(chatroom.id, (), deleted=True)
+
 
-    except Exception as e:
-        raise
+def notify_read(chatroom_id, user_id, message_id):
+    # Отметки копятся в цикле подписок; если его в процессе нет, публикуем сразу для других воркеров
+    if not event_dispatcher.dispatch(READ_RECEIPT, (chatroom_id, user_id, message_id)):
+        async_to_sync(publish_read_receipts)({(chatroom_id, user_id): message_id})
 
 
-schema = strawberry.Schema(query=Query, mutation=Mutation, subscription=Subscription)
\ No newline at end of file
+schema = strawberry.Schema(query=Query, mutation=Mutation, subscription=Subscription,
+                           extensions=[LoopMonitorExtension])
\ No newline at end of file
@@ -0,0 +1,119 @@
+import asyncio
+import logging
+from dataclasses import dataclass, asdict
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+DISCONNECT = 'disconnect'
+
+SLOW_CONSUMER_POLICIES = (DROP_OLDEST, DROP_NEWEST, DISCONNECT)
+
+_CLOSED = object()
+
+
+class SubscriberDisconnected(Exception):
+    pass
+
+
+@dataclass
+class SubscriptionStats:
+    delivered: int = 0
+    dropped: int = 0
+    evicted: int = 0
+
+    def as_dict(self):
+        return asdict(self)
+
+
+subscription_stats = SubscriptionStats()
+
+
+def get_subscription_setting(name, default):
+    return getattr(settings, 'MESSENGER_SUBSCRIPTIONS', {}).get(name, default)
+
+
+def report_subscription_stats(stats=None):
+    """Пишет счетчики в лог и передает их в STATS_HOOK (например, в экспорт метрик)"""
+    counters = (stats or subscription_stats).as_dict()
+    logger.info("Subscription queues: delivered=%(delivered)d dropped=%(dropped)d evicted=%(evicted)d", counters)
+    hook = get_subscription_setting('STATS_HOOK', None)
+    if hook:
+        import_string(hook)(counters)
+    return counters
+
+
+_stats_reporter = None
+
+
+def start_stats_reporter():
+    """Периодически сообщает счетчики, если с прошлого отчета они изменились"""
+    global _stats_reporter
+    if _stats_reporter is not None and not _stats_reporter.done():
+        return
+    _stats_reporter = asyncio.get_running_loop().create_task(_report_stats_periodically())
+
+
+async def _report_stats_periodically():
+    interval = get_subscription_setting('STATS_INTERVAL', 60)
+    last = None
+    while True:
+        await asyncio.sleep(interval)
+        if subscription_stats.as_dict() != last:
+            last = report_subscription_stats()
+
+
+class SubscriberQueue(asyncio.Queue):
+    """Ограниченная очередь подписчика, которая никогда не блокирует отправителя"""
+
+    def __init__(self, maxsize=None, policy=None, stats=None):
+        if maxsize is None:
+            maxsize = get_subscription_setting('QUEUE_SIZE', 100)
+        if policy is None:
+            policy = get_subscription_setting('SLOW_CONSUMER_POLICY', DROP_OLDEST)
+        if policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"Unknown slow consumer policy: {policy}")
+        super().__init__(maxsize=maxsize)
+        self.policy = policy
+        self.stats = stats or subscription_stats
+        self.closed = False
+
+    def offer(self, item):
+        """Кладет событие в очередь без ожидания. Возвращает False, если подписчика нужно отключить"""
+        if self.closed:
+            return False
+        try:
+            self.put_nowait(item)
+        except asyncio.QueueFull:
+            if self.policy == DROP_NEWEST:
+                self.stats.dropped += 1
+                return True
+            if self.policy == DROP_OLDEST:
+                self.get_nowait()
+                self.put_nowait(item)
+                self.stats.dropped += 1
+                self.stats.delivered += 1
+                return True
+            self.close()
+            self.stats.evicted += 1
+            logger.warning("Slow subscriber disconnected, queue size %d", self.maxsize)
+            return False
+        self.stats.delivered += 1
+        return True
+
+    def close(self):
+        # Выбрасываем накопленные события и будим читателя, чтобы он завершил подписку
+        self.closed = True
+        while not self.empty():
+            self.get_nowait()
+        self.put_nowait(_CLOSED)
+
+    async def next(self):
+        item = await self.get()
+        if item is _CLOSED:
+            raise SubscriberDisconnected()
+        return item
@@ -0,0 +1,37 @@
+import io
+
+import pytest
+from django.db import connection
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from PIL import Image
+
+from messenger.graphene import graphene_schema
+from messenger.middlewares import DataLoaderMiddleware, GrapheneAuthMiddleware
+from messenger.resolvers.user_resolver import create_access_token
+
+
+def execute_graphene(user, query, variables=None, loaders=True):
+    """
+    Запрос к graphene от имени пользователя, как через CustomGraphQLView: токен в cookie и те же middleware.
+    Возвращает результат и число запросов к базе; loaders=False - без DataLoaderMiddleware
+    """
+    request = RequestFactory().post('/graphql/graphene/', HTTP_COOKIE=f"access-token={create_access_token(user)}")
+    middleware = [GrapheneAuthMiddleware(), DataLoaderMiddleware()] if loaders else [GrapheneAuthMiddleware()]
+    with CaptureQueriesContext(connection) as queries:
+        result = graphene_schema.execute(query, variable_values=variables, context_value=request,
+                                         middleware=middleware)
+    return result, len(queries)
+
+
+def image_bytes(size=(100, 100), mode='RGB', format='PNG'):
+    output = io.BytesIO()
+    Image.new(mode, size, 'red').save(output, format)
+    return output.getvalue()
+
+
+@pytest.fixture
+def media_root(settings, tmp_path):
+    # Файлы теста пишутся во временный каталог, а не в настоящий media/
+    settings.MEDIA_ROOT = str(tmp_path)
+    return tmp_path
@@ -0,0 +1,82 @@
+import asyncio
+import time
+
+import pytest
+from asgiref.sync import sync_to_async
+
+from messenger.loop_monitor import LoopLagMonitor
+from messenger.models import Chatroom, Message, User
+from messenger.resolvers.user_resolver import create_access_token
+from messenger.strawberry import schema
+
+CHANGE_MESSAGE = """
+mutation($token: String!, $id: ID!, $text: String) {
+  changeMessage(accessToken: $token, chatroomName: "chatroom_1", messageId: $id, newText: $text) { message }
+}
+"""
+
+DELETE_MESSAGE = """
+mutation($token: String!, $id: ID!) {
+  deleteMessage(accessToken: $token, chatroomName: "chatroom_1", messageId: $id) { message }
+}
+"""
+
+
+@pytest.fixture(autouse=True)
+def disable_loop_monitor(settings):
+    # Каждый тест идет в своем event loop, глобальный монитор здесь не нужен
+    settings.MESSENGER_LOOP_MONITOR = {'ENABLED': False}
+
+
+@sync_to_async
+def create_message():
+    author = User.objects.create(name='author', email='author_email')
+    other = User.objects.create(name='other', email='other_email')
+    chatroom = Chatroom.objects.create(name='chatroom_1')
+    chatroom.participants.set([author, other])
+    message = Message.objects.create(chatroom=chatroom, user=author, text='hello')
+    return message, create_access_token(author), create_access_token(other)
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+async def test_change_message_only_by_author():
+    message, author_token, other_token = await create_message()
+
+    result = await schema.execute(CHANGE_MESSAGE, variable_values={'token': other_token, 'id': message.id, 'text': 'x'})
+    assert result.data['changeMessage']['message'] == "У вас нет прав для изменения этого сообщения"
+
+    result = await schema.execute(CHANGE_MESSAGE, variable_values={'token': author_token, 'id': message.id, 'text': 'edited'})
+    assert result.errors is None
+    assert (await Message.objects.aget(id=message.id)).text == 'edited'
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+async def test_delete_message_only_by_author():
+    message, author_token, other_token = await create_message()
+
+    await schema.execute(DELETE_MESSAGE, variable_values={'token': other_token, 'id': message.id})
+    assert await Message.objects.filter(id=message.id).aexists()
+
+    result = await schema.execute(DELETE_MESSAGE, variable_values={'token': author_token, 'id': message.id})
+    assert result.data['deleteMessage']['message'] == "Сообщение успешно удалено"
+    assert not await Message.objects.filter(id=message.id).aexists()
+
+
+@pytest.mark.asyncio
+async def test_loop_monitor_reports_blocking_code():
+    lags = []
+    monitor = LoopLagMonitor(interval=0.01, threshold=0.05, hook=lags.append)
+    monitor.start()
+    try:
+        await asyncio.sleep(0.05)
+
+        # Синхронный вызов внутри корутины держит loop, монитор это видит
+        time.sleep(0.1)
+        await asyncio.sleep(0.05)
+    finally:
+        await monitor.stop()
+
+    assert monitor.max_lag >= 0.08
+    assert max(lags) >= 0.08
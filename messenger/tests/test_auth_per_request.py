@@ -0,0 +1,40 @@
+import pytest
+from django.test import RequestFactory
+
+from conftest import execute_graphene
+from messenger.graphene import graphene_schema
+from messenger.middlewares import GrapheneAuthMiddleware
+from messenger.models import User
+
+QUERY = "{ users { id name email } }"
+
+
+def execute_as(user, query=QUERY):
+    result, queries = execute_graphene(user, query, loaders=False)
+    assert result.errors is None
+    return result, queries
+
+
+def create_users(start, count):
+    return [User.objects.create(name=f'user_{i}', email=f'email_{i}') for i in range(start, start + count)]
+
+
+@pytest.mark.django_db
+def test_query_count_does_not_grow_with_response_size():
+    users = create_users(0, 5)
+    result, small = execute_as(users[0])
+    assert len(result.data['users']) == 5
+
+    create_users(5, 45)
+    result, large = execute_as(users[0])
+    assert len(result.data['users']) == 50
+
+    # Только запрос за данными: пользователь берется из токена один раз, независимо от числа полей в ответе
+    assert small == large == 1
+
+
+@pytest.mark.django_db
+def test_unauthorized_request_fails_once_per_root_field():
+    request = RequestFactory().post('/graphql/graphene/')
+    result = graphene_schema.execute(QUERY, context_value=request, middleware=[GrapheneAuthMiddleware()])
+    assert [error.message for error in result.errors] == ["Unauthorized"]
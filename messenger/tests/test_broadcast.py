@@ -0,0 +1,138 @@
+import asyncio
+
+import pytest
+from asgiref.sync import sync_to_async
+from channels.layers import InMemoryChannelLayer
+
+from messenger.broadcast import ChannelLayerBroadcast, InMemoryBroadcast
+from messenger.models import Chatroom, Message, User
+from messenger.strawberry import ChatroomMessagesSubscription, serialize_message
+from messenger.subscriptions import SubscriberQueue
+
+
+@sync_to_async
+def create_message(text):
+    user = User.objects.create(name='test_user', email='test_email')
+    chatroom = Chatroom.objects.create(name='chatroom_1')
+    chatroom.participants.add(user)
+    return Message.objects.create(chatroom=chatroom, user=user, text=text)
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+async def test_in_memory_broadcast_delivers_locally():
+    subscriptions = ChatroomMessagesSubscription()
+    broadcast = InMemoryBroadcast(subscriptions.notify_subscribers)
+    message = await create_message('hello')
+    queue = SubscriberQueue()
+    subscriptions.add_subscriber(message.chatroom_id, queue)
+
+    payload = await sync_to_async(serialize_message)(message)
+    await broadcast.publish(message.chatroom_id, payload)
+
+    assert queue.get_nowait() is payload
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+async def test_channel_layer_broadcast_reaches_other_workers():
+    # Общий брокер и два "воркера" со своими локальными подписками
+    layer = InMemoryChannelLayer()
+    worker_a = ChatroomMessagesSubscription()
+    worker_b = ChatroomMessagesSubscription()
+    broadcast_a = ChannelLayerBroadcast(worker_a.notify_subscribers, layer=layer)
+    broadcast_b = ChannelLayerBroadcast(worker_b.notify_subscribers, layer=layer)
+    await broadcast_a.start()
+    await broadcast_b.start()
+
+    message = await create_message('hello')
+    queue_a = SubscriberQueue()
+    queue_b = SubscriberQueue()
+    worker_a.add_subscriber(message.chatroom_id, queue_a)
+    worker_b.add_subscriber(message.chatroom_id, queue_b)
+
+    try:
+        await broadcast_a.publish(message.chatroom_id, await sync_to_async(serialize_message)(message))
+
+        received_a = await asyncio.wait_for(queue_a.get(), timeout=1)
+        received_b = await asyncio.wait_for(queue_b.get(), timeout=1)
+
+        assert received_a['id'] == received_b['id'] == message.id
+        assert received_b['text'] == 'hello'
+    finally:
+        await broadcast_a.stop()
+        await broadcast_b.stop()
+
+
+@pytest.mark.asyncio
+async def test_membership_changes_reach_other_workers():
+    layer = InMemoryChannelLayer()
+    worker_a = ChatroomMessagesSubscription()
+    worker_b = ChatroomMessagesSubscription()
+    broadcast_a = ChannelLayerBroadcast(worker_a.notify_subscribers, worker_a.apply_membership, layer=layer)
+    broadcast_b = ChannelLayerBroadcast(worker_b.notify_subscribers, worker_b.apply_membership, layer=layer)
+    await broadcast_a.start()
+    await broadcast_b.start()
+
+    # Пользователь подключен ко второму воркеру, а мутация выполняется на первом
+    queue = SubscriberQueue()
+    worker_b.bind_user(1, queue)
+
+    try:
+        await broadcast_a.publish_membership(10, [1], [])
+        await asyncio.wait_for(wait_for(lambda: 10 in worker_b.queues), timeout=1)
+        assert worker_b.chatrooms[queue] == {10}
+
+        await broadcast_a.publish_membership(10, [], [1])
+        await asyncio.wait_for(wait_for(lambda: 10 not in worker_b.queues), timeout=1)
+        assert worker_b.chatrooms[queue] == set()
+    finally:
+        await broadcast_a.stop()
+        await broadcast_b.stop()
+
+
+async def wait_for(condition):
+    while not condition():
+        await asyncio.sleep(0.01)
+
+
+@pytest.mark.asyncio
+async def test_concurrent_start_joins_group_once():
+    layer = InMemoryChannelLayer()
+    broadcast = ChannelLayerBroadcast(ChatroomMessagesSubscription().notify_subscribers, layer=layer)
+
+    try:
+        await asyncio.gather(*(broadcast.start() for _ in range(5)))
+        assert len(layer.groups[broadcast.group]) == 1
+    finally:
+        await broadcast.stop()
+
+
+class FlakyLayer(InMemoryChannelLayer):
+    def __init__(self):
+        super().__init__()
+        self.failures = 1
+
+    async def receive(self, channel):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError("connection lost")
+        return await super().receive(channel)
+
+
+@pytest.mark.asyncio
+async def test_reader_survives_broker_errors():
+    layer = FlakyLayer()
+    worker = ChatroomMessagesSubscription()
+    broadcast = ChannelLayerBroadcast(worker.notify_subscribers, worker.apply_membership, layer=layer,
+                                      retry_interval=0)
+    await broadcast.start()
+    queue = SubscriberQueue()
+    worker.bind_user(1, queue)
+
+    try:
+        await broadcast.publish_membership(10, [1], [])
+        await asyncio.wait_for(wait_for(lambda: 10 in worker.queues), timeout=1)
+        assert not broadcast._reader.done()
+    finally:
+        await broadcast.stop()
@@ -0,0 +1,118 @@
+import pytest
+from asgiref.sync import async_to_sync
+
+from conftest import execute_graphene
+from messenger.models import Chatroom, Message, User
+from messenger.resolvers.message_resolver import create_message
+from messenger.resolvers.user_resolver import create_access_token
+from messenger.strawberry import schema
+
+QUERY = """
+query ($beforeId: Int, $limit: Int) {
+  userChatroomsByActivity(beforeId: $beforeId, limit: $limit) {
+    id
+    name
+    lastActivityAt
+    lastMessage { text user { name } }
+  }
+}
+"""
+
+
+def execute(user, **variables):
+    result, queries = execute_graphene(user, QUERY, variables)
+    assert result.errors is None, result.errors
+    return result.data['userChatroomsByActivity'], queries
+
+
+def create_chatrooms(count):
+    me = User.objects.create(name='me_user', email='me_email')
+    others = [User.objects.create(name=f'user_{i}', email=f'email_{i}') for i in range(3)]
+    chatrooms = []
+    for i in range(count):
+        chatroom = Chatroom.objects.create(name=f'chatroom_{i}')
+        chatroom.participants.set([me] + others)
+        chatrooms.append(chatroom)
+    return me, others, chatrooms
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('count', [5, 100])
+def test_chat_list_with_previews_is_constant_queries(count):
+    me, others, chatrooms = create_chatrooms(count)
+    # Сообщения приходят в чаты в обратном порядке, последний - снова в первый чат
+    for i, chatroom in enumerate(reversed(chatrooms)):
+        async_to_sync(create_message)(chatroom, others[i % 3], f'old_{chatroom.name}')
+        async_to_sync(create_message)(chatroom, others[(i + 1) % 3], f'last_{chatroom.name}')
+    async_to_sync(create_message)(chatrooms[-1], me, 'newest')
+
+    data, queries = execute(me, limit=count)
+
+    assert [chatroom['name'] for chatroom in data] == \
+        [chatrooms[-1].name] + [chatroom.name for chatroom in chatrooms[:-1]]
+    assert data[0]['lastMessage'] == {'text': 'newest', 'user': {'name': 'me_user'}}
+    assert data[1]['lastMessage']['text'] == f'last_{chatrooms[0].name}'
+    # Чаты, их последние сообщения, авторы сообщений
+    assert queries == 3
+
+
+@pytest.mark.django_db
+def test_pages_follow_activity_order():
+    me, others, chatrooms = create_chatrooms(7)
+    for chatroom in chatrooms[::2]:
+        async_to_sync(create_message)(chatroom, others[0], 'hello')
+
+    names = []
+    before_id = None
+    while True:
+        page, _ = execute(me, beforeId=before_id, limit=3)
+        if not page:
+            break
+        names += [chatroom['name'] for chatroom in page]
+        before_id = int(page[-1]['id'])
+
+    # Сначала чаты с сообщениями, затем пустые - по времени создания, новые выше
+    assert names == ['chatroom_6', 'chatroom_4', 'chatroom_2', 'chatroom_0',
+                     'chatroom_5', 'chatroom_3', 'chatroom_1']
+
+
+@pytest.mark.django_db
+def test_chat_without_messages_has_no_preview():
+    me, _, chatrooms = create_chatrooms(1)
+
+    data, _ = execute(me)
+
+    assert data[0]['lastMessage'] is None
+    assert data[0]['lastActivityAt'] is not None
+
+
+@pytest.mark.django_db(transaction=True)
+def test_deleting_last_message_restores_previous_preview():
+    me, others, chatrooms = create_chatrooms(1)
+    first = async_to_sync(create_message)(chatrooms[0], others[0], 'first')
+    last = async_to_sync(create_message)(chatrooms[0], me, 'last')
+
+    result = async_to_sync(schema.execute)(
+        'mutation ($id: ID!) { deleteMessage(accessToken: "%s", chatroomName: "chatroom_0", messageId: $id) '
+        '{ message } }' % create_access_token(me), variable_values={'id': last.id})
+    assert result.errors is None, result.errors
+
+    chatroom = Chatroom.objects.get(id=chatrooms[0].id)
+    assert not Message.objects.filter(id=last.id).exists()
+    assert chatroom.last_message_id == first.id
+    assert chatroom.last_activity_at == first.created_at
+
+
+@pytest.mark.django_db
+def test_chatroom_with_messages_is_deleted(django_capture_on_commit_callbacks):
+    me, others, chatrooms = create_chatrooms(1)
+    async_to_sync(create_message)(chatrooms[0], others[0], 'hello')
+
+    with django_capture_on_commit_callbacks() as callbacks:
+        result, _ = execute_graphene(me, 'mutation { chatroomDelete(id: %d) { id name } }' % chatrooms[0].id)
+
+    assert result.errors is None, result.errors
+    assert result.data['chatroomDelete'] == {'id': str(chatrooms[0].id), 'name': 'chatroom_0'}
+    assert not Chatroom.objects.exists() and not Message.objects.exists()
+    # Уведомление об удалении уходит после фиксации
+    assert len(callbacks) == 1
@@ -0,0 +1,71 @@
+import pytest
+
+from conftest import execute_graphene
+from messenger.middlewares import user_cache
+from messenger.models import Chatroom, ChatroomReadState, User
+from messenger.unread import create_read_states
+
+CREATE = 'mutation { chatroomCreate(name: "chatroom_1", users: {%s}) { id name } }'
+UPDATE = 'mutation { chatroomUpdate(id: %d, users: {%s}) { id name } }'
+
+
+def users_argument(users):
+    return ', '.join(f'user{i + 2}: {user.id}' for i, user in enumerate(users))
+
+
+def execute(user, query):
+    user_cache.clear()
+    return execute_graphene(user, query)
+
+
+def create_users(count):
+    return [User.objects.create(name=f'user_{i}', email=f'email_{i}') for i in range(count)]
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('invited', [1, 7])
+def test_create_round_trips_do_not_depend_on_participants(invited, django_capture_on_commit_callbacks):
+    me, *others = create_users(invited + 1)
+
+    with django_capture_on_commit_callbacks() as callbacks:
+        result, queries = execute(me, CREATE % users_argument(others))
+
+    assert result.errors is None, result.errors
+    chatroom = Chatroom.objects.get(name='chatroom_1')
+    assert set(chatroom.participants.values_list('id', flat=True)) == {user.id for user in [me] + others}
+    # Пользователь из токена, затем в одной транзакции (начало и фиксация):
+    # пользователи одним in_bulk, проверка имени, чат, одна вставка участников и одна - их счетчиков
+    assert queries == 1 + 7
+    # Уведомление ставится в очередь до фиксации транзакции
+    assert len(callbacks) == 1
+
+
+@pytest.mark.django_db
+def test_create_reports_all_missing_users_and_rolls_back():
+    me, other = create_users(2)
+
+    result, _ = execute(me, CREATE % f'user2: {other.id}, user3: 1000, user4: 1001')
+
+    assert result.errors[0].message == "Invalid user id: 1000, 1001"
+    assert not Chatroom.objects.exists()
+
+
+@pytest.mark.django_db
+def test_update_changes_only_difference(django_capture_on_commit_callbacks):
+    me, *others = create_users(6)
+    chatroom = Chatroom.objects.create(name='chatroom_1')
+    chatroom.participants.set([me] + others[:3])
+    create_read_states(chatroom.id, [user.id for user in [me] + others[:3]])
+
+    with django_capture_on_commit_callbacks() as callbacks:
+        result, queries = execute(me, UPDATE % (chatroom.id, users_argument(others[2:])))
+
+    assert result.errors is None, result.errors
+    assert set(chatroom.participants.values_list('id', flat=True)) == {user.id for user in [me] + others[2:]}
+    assert set(ChatroomReadState.objects.filter(chatroom=chatroom).values_list('user_id', flat=True)) == \
+        {user.id for user in [me] + others[2:]}
+    # Пользователь из токена, затем в одной транзакции (начало и фиксация):
+    # чат, пользователи, текущие участники, удаление участников и их счетчиков,
+    # последнее сообщение для курсора новых участников, вставка участников и их счетчиков, сохранение чата
+    assert queries == 1 + 11
+    assert len(callbacks) == 1
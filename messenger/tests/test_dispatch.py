@@ -0,0 +1,66 @@
+import asyncio
+import threading
+
+import pytest
+
+from messenger.dispatch import EventDispatcher
+from messenger.subscriptions import SubscriberQueue
+
+
+def test_dispatch_without_subscribers_is_noop():
+    dispatcher = EventDispatcher()
+    dispatcher.register('event', lambda payload: pytest.fail("Handler should not run"))
+
+    dispatcher.dispatch('event', 'payload')
+
+
+@pytest.mark.asyncio
+async def test_dispatch_from_sync_thread_does_not_run_fan_out_in_request_thread():
+    dispatcher = EventDispatcher()
+    queues = [SubscriberQueue(maxsize=1) for _ in range(1000)]
+    handler_threads = set()
+
+    def handler(payload):
+        handler_threads.add(threading.get_ident())
+        for queue in queues:
+            queue.offer(payload)
+
+    dispatcher.register('event', handler)
+    dispatcher.start()
+
+    def resolver():
+        # Синхронный резолвер в потоке запроса только ставит событие в очередь
+        dispatcher.dispatch('event', 'chatroom')
+        return threading.get_ident()
+
+    try:
+        request_thread = await asyncio.to_thread(resolver)
+        await asyncio.wait_for(dispatcher.join(), timeout=1)
+
+        assert handler_threads == {threading.get_ident()}
+        assert request_thread not in handler_threads
+        assert all(queue.get_nowait() == 'chatroom' for queue in queues)
+    finally:
+        await dispatcher.stop()
+
+
+@pytest.mark.asyncio
+async def test_failing_handler_does_not_stop_dispatcher():
+    dispatcher = EventDispatcher()
+    received = []
+
+    def failing_handler(payload):
+        raise RuntimeError("boom")
+
+    dispatcher.register('event', failing_handler)
+    dispatcher.register('event', received.append)
+    dispatcher.start()
+
+    try:
+        dispatcher.dispatch('event', 1)
+        dispatcher.dispatch('event', 2)
+        await asyncio.wait_for(dispatcher.join(), timeout=1)
+
+        assert received == [1, 2]
+    finally:
+        await dispatcher.stop()
@@ -0,0 +1,45 @@
+import pytest
+
+from conftest import execute_graphene
+from messenger.models import Chatroom, User
+
+QUERY = """
+{
+  userChatrooms {
+    id
+    name
+    participants { id name chatroom { id name } }
+  }
+}
+"""
+
+
+def create_chatrooms(user, count):
+    others = [User.objects.create(name=f'user_{count}_{i}', email=f'email_{count}_{i}') for i in range(3)]
+    for i in range(count):
+        chatroom = Chatroom.objects.create(name=f'chatroom_{count}_{i}')
+        chatroom.participants.set([user] + others)
+        for participant in [user] + others:
+            participant.chatroom.add(chatroom)
+
+
+def execute(user):
+    result, queries = execute_graphene(user, QUERY)
+    assert result.errors is None, result.errors
+    return result.data['userChatrooms'], queries
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('count', [5, 200])
+def test_query_count_is_constant(count):
+    user = User.objects.create(name='test_user', email='test_email')
+    create_chatrooms(user, count)
+
+    chatrooms, queries = execute(user)
+
+    assert len(chatrooms) == count
+    assert all(len(chatroom['participants']) == 4 for chatroom in chatrooms)
+    me = next(p for p in chatrooms[0]['participants'] if p['name'] == 'test_user')
+    assert len(me['chatroom']) == count
+    # Чаты, участники и чаты участников - по одному запросу на уровень
+    assert queries == 3
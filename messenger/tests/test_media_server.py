@@ -0,0 +1,140 @@
+import hashlib
+
+import pytest
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+
+from messenger.media_server import IMMUTABLE_CACHE, REVALIDATE_CACHE, MediaApp, parse_range
+
+CONTENT = bytes(range(256)) * 4
+
+
+@pytest.fixture
+def blob(media_root):
+    return default_storage.save('avatars/user/me.png', ContentFile(CONTENT))
+
+
+async def call_app(app, path, method='GET', headers=(), extensions=None):
+    scope = {'type': 'http', 'method': method, 'path': path,
+             'headers': [(key.encode(), value.encode()) for key, value in headers]}
+    if extensions is not None:
+        scope['extensions'] = extensions
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    await app(scope, receive, send)
+    return messages
+
+
+async def not_found_app(scope, receive, send):
+    raise AssertionError("Запрос к медиа дошел до Django")
+
+
+def test_parse_range():
+    assert parse_range('bytes=0-9', 100) == (0, 10)
+    assert parse_range('bytes=90-', 100) == (90, 10)
+    assert parse_range('bytes=-10', 100) == (90, 10)
+    assert parse_range('bytes=95-200', 100) == (95, 5)
+    # Несколько диапазонов не поддерживаются: отдается весь файл
+    assert parse_range('bytes=0-1,5-6', 100) is None
+    with pytest.raises(ValueError):
+        parse_range('bytes=100-', 100)
+
+
+def test_blob_is_served_with_hash_etag_and_immutable_cache(client, blob):
+    response = client.get(f'/media/{blob}')
+
+    assert response.status_code == 200
+    assert b''.join(response.streaming_content) == CONTENT
+    assert response['ETag'] == f'"{hashlib.sha256(CONTENT).hexdigest()}"'
+    assert response['Cache-Control'] == IMMUTABLE_CACHE
+    assert response['Content-Type'] == 'image/png'
+    assert response['Content-Length'] == str(len(CONTENT))
+
+
+def test_conditional_request_does_not_open_file(client, blob, monkeypatch):
+    etag = client.get(f'/media/{blob}')['ETag']
+    monkeypatch.setattr('builtins.open', lambda *args, **kwargs: pytest.fail("Файл открыт для 304"))
+
+    response = client.get(f'/media/{blob}', HTTP_IF_NONE_MATCH=etag)
+
+    assert response.status_code == 304
+    assert response.content == b''
+    assert response['ETag'] == etag
+
+
+def test_range_request(client, blob):
+    response = client.get(f'/media/{blob}', HTTP_RANGE='bytes=10-19')
+
+    assert response.status_code == 206
+    assert b''.join(response.streaming_content) == CONTENT[10:20]
+    assert response['Content-Range'] == f'bytes 10-19/{len(CONTENT)}'
+
+    response = client.get(f'/media/{blob}', HTTP_RANGE=f'bytes={len(CONTENT)}-')
+    assert response.status_code == 416
+    assert response['Content-Range'] == f'bytes */{len(CONTENT)}'
+
+    # If-Range со старым ETag: файл изменился, отдается целиком
+    response = client.get(f'/media/{blob}', HTTP_RANGE='bytes=10-19', HTTP_IF_RANGE='"stale"')
+    assert response.status_code == 200
+
+
+def test_non_hashed_files_are_revalidated(client, media_root):
+    (media_root / 'note.txt').write_bytes(b'text')
+
+    response = client.get('/media/note.txt')
+
+    assert response.status_code == 200
+    assert response['Cache-Control'] == REVALIDATE_CACHE
+    assert client.get('/media/note.txt', HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code == 304
+
+
+def test_paths_outside_media_root_and_temp_files_are_not_served(client, media_root):
+    (media_root.parent / 'secret.txt').write_bytes(b'secret')
+    (media_root / '.upload-abc').write_bytes(b'partial')
+
+    assert client.get('/media/../secret.txt').status_code == 404
+    assert client.get('/media/.upload-abc').status_code == 404
+    assert client.get('/media/blobs').status_code == 404
+
+
+@pytest.mark.asyncio
+async def test_asgi_app_serves_chunks_and_passes_other_paths(media_root, blob, monkeypatch):
+    monkeypatch.setattr('messenger.media_server.CHUNK_SIZE', 300)
+    passed = []
+
+    async def django_app(scope, receive, send):
+        passed.append(scope['path'])
+
+    app = MediaApp(django_app, str(media_root), '/media/')
+
+    messages = await call_app(app, f'/media/{blob}', headers=[('Range', 'bytes=100-899')])
+    start, *bodies = messages
+    assert start['status'] == 206
+    assert (b'content-range', f'bytes 100-899/{len(CONTENT)}'.encode()) in start['headers']
+    assert [len(body['body']) for body in bodies] == [300, 300, 200]
+    assert b''.join(body['body'] for body in bodies) == CONTENT[100:900]
+    assert [body['more_body'] for body in bodies] == [True, True, False]
+
+    etag = dict(start['headers'])[b'etag'].decode()
+    start, body = await call_app(app, f'/media/{blob}', headers=[('If-None-Match', etag)])
+    assert start['status'] == 304 and body['body'] == b''
+
+    await call_app(app, '/graphql/strawberry/')
+    assert passed == ['/graphql/strawberry/']
+
+
+@pytest.mark.asyncio
+async def test_asgi_app_uses_zerocopy_send_when_server_supports_it(media_root, blob):
+    messages = await call_app(MediaApp(not_found_app, str(media_root), '/media/'), f'/media/{blob}',
+                              extensions={'http.response.zerocopysend': {}})
+
+    start, body = messages
+    assert start['status'] == 200
+    assert body['type'] == 'http.response.zerocopysend'
+    assert (body['offset'], body['count']) == (0, len(CONTENT))
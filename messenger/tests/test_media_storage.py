@@ -0,0 +1,90 @@
+import hashlib
+import os
+import time
+
+import pytest
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import call_command
+
+from messenger.models import Chatroom, Favorite, User
+from messenger.storage import ContentAddressedStorage
+from messenger.thumbnails import thumbnail_name
+
+
+def blob_files(root):
+    return sorted(path.name for path in (root / 'blobs').rglob('*') if path.is_file())
+
+
+def make_old(name, age=7200):
+    path = default_storage.path(name)
+    os.utime(path, (time.time() - age, time.time() - age))
+
+
+@pytest.mark.django_db
+def test_identical_uploads_share_one_file(media_root):
+    first = User.objects.create(name='first_user', email='first_email')
+    second = User.objects.create(name='second_user', email='second_email')
+    chatroom = Chatroom.objects.create(name='chatroom_1')
+
+    first.avatar.save('me.png', ContentFile(b'same image'))
+    second.avatar.save('other-name.PNG', ContentFile(b'same image'))
+    chatroom.avatar.save('chat.png', ContentFile(b'another image'))
+
+    digest = hashlib.sha256(b'same image').hexdigest()
+    assert first.avatar.name == second.avatar.name == f'blobs/{digest[:2]}/{digest}.png'
+    assert chatroom.avatar.name != first.avatar.name
+    assert len(blob_files(media_root)) == 2
+
+
+@pytest.mark.django_db
+def test_deleting_shared_avatar_keeps_file(media_root):
+    first = User.objects.create(name='first_user', email='first_email')
+    second = User.objects.create(name='second_user', email='second_email')
+    first.avatar.save('me.png', ContentFile(b'same image'))
+    second.avatar.save('me.png', ContentFile(b'same image'))
+
+    first.avatar.delete()
+
+    assert default_storage.exists(second.avatar.name)
+
+
+@pytest.mark.django_db
+def test_garbage_collection_removes_only_old_orphans(media_root):
+    user = User.objects.create(name='test_user', email='test_email')
+    user.avatar.save('me.png', ContentFile(b'user image'))
+    favorite = Favorite.objects.create(name='favorite')
+    # Избранное копирует аватар пользователя: это вторая ссылка на тот же файл
+    favorite.avatar = user.avatar.name
+    favorite.save()
+    orphan = default_storage.save('old.png', ContentFile(b'replaced image'))
+    default_storage.derived.save(thumbnail_name(orphan, 64), ContentFile(b'thumbnail'))
+    fresh = default_storage.save('new.png', ContentFile(b'not saved to a row yet'))
+    for name in (user.avatar.name, orphan):
+        make_old(name)
+
+    call_command('collect_media_garbage', '--dry-run')
+    assert default_storage.exists(orphan)
+
+    call_command('collect_media_garbage')
+
+    assert not default_storage.exists(orphan)
+    assert not default_storage.exists(thumbnail_name(orphan, 64))
+    assert default_storage.exists(user.avatar.name)
+    assert default_storage.exists(fresh)
+
+    # После смены аватара у обоих владельцев файл становится мусором
+    User.objects.update(avatar='')
+    Favorite.objects.update(avatar='')
+    call_command('collect_media_garbage')
+    assert not default_storage.exists(user.avatar.name)
+
+
+def test_reupload_refreshes_orphan_age(tmp_path):
+    storage = ContentAddressedStorage(location=str(tmp_path))
+    name = storage.save('a.png', ContentFile(b'image'))
+    os.utime(storage.path(name), (0, 0))
+
+    assert list(storage.orphans({}, grace=60)) == [name]
+    storage.save('b.png', ContentFile(b'image'))
+    assert list(storage.orphans({}, grace=60)) == []
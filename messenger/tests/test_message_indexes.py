@@ -0,0 +1,66 @@
+import re
+
+import pytest
+from django.db import connection
+
+from messenger.models import Chatroom, Message, User
+from messenger.pagination import after_key
+
+pytestmark = pytest.mark.skipif(connection.vendor != 'sqlite', reason="EXPLAIN QUERY PLAN есть только в SQLite")
+
+ROWS = 1_000_000
+CHATROOMS = 1000
+
+
+def seed_messages():
+    user = User.objects.create(name='test_user', email='test_email')
+    chatrooms = Chatroom.objects.bulk_create([Chatroom(name=f'chatroom_{i}') for i in range(CHATROOMS)])
+    first_id = min(chatroom.id for chatroom in chatrooms)
+    with connection.cursor() as cursor:
+        # 1M сообщений одним запросом через рекурсивный CTE, ORM здесь слишком медленный
+        cursor.execute(f"""
+            WITH RECURSIVE seq(n) AS (SELECT 1 UNION ALL SELECT n + 1 FROM seq WHERE n < {ROWS})
+            INSERT INTO {Message._meta.db_table}
+                (chatroom_id, user_id, text, created_at, updated_at, is_chat, is_favorite)
+            SELECT {first_id} + n % {CHATROOMS}, %s, 'text',
+                   datetime('2025-01-01', '+' || n || ' seconds'), datetime('2025-01-01'), 0, 0
+            FROM seq
+        """, [user.id])
+        cursor.execute("ANALYZE")
+    return chatrooms[0]
+
+
+def query_plan(queryset):
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(f"EXPLAIN QUERY PLAN {sql}", params)
+        return ' '.join(row[-1] for row in cursor.fetchall())
+
+
+@pytest.mark.django_db
+def test_history_query_uses_index():
+    chatroom = seed_messages()
+    assert Message.objects.count() == ROWS
+
+    first_page = chatroom.get_messages()[:50]
+    plan = query_plan(first_page)
+    assert 'message_chatroom_history_idx' in plan
+    # Сортировка берется из индекса, без временного B-дерева
+    assert 'TEMP B-TREE' not in plan
+
+    last = list(first_page)[-1]
+    next_page = chatroom.get_messages().filter(after_key(last.created_at, last.id))[:50]
+    plan = query_plan(next_page)
+    assert 'message_chatroom_history_idx' in plan
+    assert 'TEMP B-TREE' not in plan
+
+
+@pytest.mark.django_db
+def test_unread_after_cursor_uses_index():
+    chatroom = seed_messages()
+    cursor = Message.objects.filter(chatroom=chatroom).order_by('-id').values_list('id', flat=True)[100]
+    unread = Message.objects.filter(chatroom=chatroom, id__gt=cursor).exclude(user_id=0)
+    # Сообщения после курсора - диапазон по (chatroom, id), без просмотра всей истории чата.
+    # В SQLite индекс по chatroom_id уже содержит rowid, в Postgres нужен message_chatroom_id_idx
+    assert re.search(r'chatroom_id=\? AND (rowid|id)>\?', query_plan(unread))
+    assert unread.count() == 100
@@ -0,0 +1,115 @@
+import time
+
+import pytest
+from asgiref.sync import async_to_sync
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from messenger.models import Chatroom, Message, User
+from messenger.strawberry import ChatroomMessagesSubscription, ChatroomTypeStrawberry, MessageTypeStrawberry, \
+    UserTypeStrawberry, deliver_message, chatroom_messages_subscriptions, serialize_message
+from messenger.subscriptions import SubscriberQueue
+
+SUBSCRIBERS = 8
+
+
+def create_chatroom_message():
+    users = [User.objects.create(name=f'user_{i}', email=f'email_{i}') for i in range(SUBSCRIBERS)]
+    chatroom = Chatroom.objects.create(name='chatroom_1')
+    chatroom.participants.set(users)
+    for user in users:
+        user.chatroom.add(chatroom)
+    return Message.objects.create(chatroom=chatroom, user=users[0], text='hello')
+
+
+def build_per_subscriber(message):
+    # Прежний путь: объект строится заново для каждого подписчика, с ленивыми запросами к базе
+    message = Message.objects.select_related('user', 'chatroom').get(id=message.id)
+    return [
+        MessageTypeStrawberry(
+            id=message.id,
+            chatroom=ChatroomTypeStrawberry(
+                id=message.chatroom.id,
+                name=message.chatroom.name,
+                avatar=message.chatroom.avatar,
+                participants=list(message.chatroom.participants.all()),
+                max_participants=message.chatroom.max_participants,
+                updated_at=message.chatroom.updated_at,
+                created_at=message.chatroom.created_at
+            ),
+            user=UserTypeStrawberry(
+                id=message.user.id,
+                name=message.user.name,
+                email=message.user.email,
+                password=message.user.password,
+                avatar=message.user.avatar,
+                chatroom=list(message.user.chatroom.all()),
+                created_at=message.user.created_at,
+                updated_at=message.user.updated_at
+            ),
+            text=message.text,
+            is_chat=message.is_chat,
+            is_favorite=message.is_favorite,
+            created_at=message.created_at,
+            updated_at=message.updated_at,
+        )
+        for _ in range(SUBSCRIBERS)
+    ]
+
+
+@pytest.mark.django_db
+def test_payload_is_built_once_and_shared():
+    message = create_chatroom_message()
+    queues = [SubscriberQueue() for _ in range(SUBSCRIBERS)]
+    for queue in queues:
+        chatroom_messages_subscriptions.add_subscriber(message.chatroom_id, queue)
+
+    try:
+        with CaptureQueriesContext(connection) as queries:
+            payload = serialize_message(message)
+        async_to_sync(deliver_message)(message.chatroom_id, payload)
+    finally:
+        for queue in queues:
+            chatroom_messages_subscriptions.unsubscribe(queue)
+
+    received = [queue.get_nowait() for queue in queues]
+    assert all(item is received[0] for item in received)
+    assert received[0].text == 'hello'
+    assert [user.name for user in received[0].chatroom.participants] == [f'user_{i}' for i in range(SUBSCRIBERS)]
+    # Хэши паролей и чаты автора не рассылаются
+    assert received[0].user.password == '' and received[0].user.chatroom == ()
+    assert 'password' not in payload['user'] and 'chatroom' not in payload['user']
+    # Сообщение и участники - независимо от числа подписчиков
+    assert len(queries) == 2
+
+
+@pytest.mark.django_db
+def test_payload_benchmark_against_per_subscriber_build(capsys):
+    message = create_chatroom_message()
+    subscriptions = ChatroomMessagesSubscription()
+    queues = [SubscriberQueue() for _ in range(SUBSCRIBERS)]
+    for queue in queues:
+        subscriptions.add_subscriber(message.chatroom_id, queue)
+    rounds = 50
+
+    with CaptureQueriesContext(connection) as old_queries:
+        started = time.perf_counter()
+        for _ in range(rounds):
+            build_per_subscriber(message)
+        old_time = time.perf_counter() - started
+
+    with CaptureQueriesContext(connection) as new_queries:
+        started = time.perf_counter()
+        for _ in range(rounds):
+            payload = serialize_message(message)
+            async_to_sync(subscriptions.notify_subscribers)(message.chatroom_id, payload)
+            for queue in queues:
+                queue.get_nowait()
+        new_time = time.perf_counter() - started
+
+    with capsys.disabled():
+        print(f"\n{SUBSCRIBERS} subscribers, {rounds} messages: per-subscriber build {old_time * 1000:.1f} ms, "
+              f"{len(old_queries)} queries; serialize once {new_time * 1000:.1f} ms, {len(new_queries)} queries")
+
+    assert len(new_queries) == 2 * rounds
+    assert len(old_queries) == (1 + 2 * SUBSCRIBERS) * rounds
@@ -0,0 +1,77 @@
+import time
+
+import pytest
+from django.db import connection
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+
+from messenger.graphene import graphene_schema
+from messenger.middlewares import DataLoaderMiddleware, GrapheneAuthMiddleware
+from messenger.models import Chat, User
+from messenger.resolvers.user_resolver import create_access_token
+
+QUERY = '{ usersWithoutChatWithThisUser(searchQuery: "%s", total: %d) { id name } }'
+
+
+def execute(user, search_query, total=5):
+    request = RequestFactory().post('/graphql/graphene/', HTTP_COOKIE=f"access-token={create_access_token(user)}")
+    with CaptureQueriesContext(connection) as queries:
+        result = graphene_schema.execute(QUERY % (search_query, total), context_value=request,
+                                         middleware=[GrapheneAuthMiddleware(), DataLoaderMiddleware()])
+    assert result.errors is None, result.errors
+    return [user['name'] for user in result.data['usersWithoutChatWithThisUser']], len(queries)
+
+
+def create_chat(*users):
+    chat = Chat.objects.create(name=' & '.join(user.name for user in users))
+    chat.participants.set(users)
+    return chat
+
+
+@pytest.mark.django_db
+def test_excludes_only_users_with_chat():
+    me, ann, anna, joanna = [User.objects.create(name=name, email=f'{name}_email')
+                             for name in ('me_user', 'ann', 'anna', 'joanna')]
+    create_chat(me, joanna)
+    # Чужой чат не влияет на результат
+    create_chat(ann, anna)
+
+    # Имя "ann" входит в название чата "me_user & joanna", раньше такой пользователь терялся
+    users, queries = execute(me, 'ann')
+
+    assert users == ['ann', 'anna']
+    assert queries == 1
+
+
+def seed_users(start, end):
+    with connection.cursor() as cursor:
+        cursor.execute(f"""
+            WITH RECURSIVE seq(n) AS (SELECT {start} UNION ALL SELECT n + 1 FROM seq WHERE n < {end})
+            INSERT INTO messenger_user (name, email, password, created_at, updated_at)
+            SELECT 'user_' || n, 'email_' || n, '', datetime(), datetime() FROM seq
+        """)
+
+
+@pytest.mark.skipif(connection.vendor != 'sqlite', reason="Данные заполняются SQL для SQLite")
+@pytest.mark.django_db
+def test_benchmark_latency_does_not_depend_on_user_count(capsys):
+    me = User.objects.create(name='me_user', email='me_email')
+    seed_users(1, 10_000)
+    for user in User.objects.filter(name__in=['user_42', 'user_420', 'user_4200']):
+        create_chat(me, user)
+
+    timings = []
+    for total_users in (10_000, 100_000):
+        seed_users(User.objects.count(), total_users)
+
+        started = time.perf_counter()
+        for _ in range(20):
+            users, queries = execute(me, 'user_42', total=5)
+        timings.append((time.perf_counter() - started) / 20 * 1000)
+
+        assert 'user_42' not in users and 'user_420' not in users
+        assert len(users) == 5
+        assert queries == 1
+
+    with capsys.disabled():
+        print(f"\nusersWithoutChatWithThisUser: 10000 users {timings[0]:.2f} ms, 100000 users {timings[1]:.2f} ms")
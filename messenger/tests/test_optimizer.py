@@ -0,0 +1,87 @@
+import pytest
+from asgiref.sync import async_to_sync
+from django.db import connection
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+
+from messenger.graphene import graphene_schema
+from messenger.middlewares import DataLoaderMiddleware, GrapheneAuthMiddleware
+from messenger.models import Chatroom, Message, User
+from messenger.resolvers.user_resolver import create_access_token
+from messenger.strawberry import schema
+
+
+def create_messages(count):
+    users = [User.objects.create(name=f'user_{i}', email=f'email_{i}') for i in range(3)]
+    chatroom = Chatroom.objects.create(name='chatroom_1')
+    chatroom.participants.set(users)
+    for i in range(count):
+        Message.objects.create(chatroom=chatroom, user=users[i % 3], text=f'text_{i}')
+    return users
+
+
+def execute_strawberry(query):
+    with CaptureQueriesContext(connection) as queries:
+        result = async_to_sync(schema.execute)(query)
+    assert result.errors is None, result.errors
+    return result.data, queries
+
+
+@pytest.mark.django_db
+def test_only_requested_columns_without_relations():
+    create_messages(5)
+    data, queries = execute_strawberry('{ getMessages(chatroomName: "chatroom_1") { id text } }')
+
+    assert [m['text'] for m in data['getMessages']] == [f'text_{i}' for i in reversed(range(5))]
+    assert len(queries) == 1
+    sql = queries[0]['sql']
+    assert 'is_read' not in sql
+    assert 'messenger_user' not in sql
+
+
+@pytest.mark.django_db
+def test_relations_are_loaded_only_when_selected():
+    create_messages(20)
+    query = """
+    {
+      getMessages(chatroomName: "chatroom_1") {
+        text
+        user { name }
+        ...Room
+      }
+    }
+    fragment Room on MessageTypeStrawberry { chatroom { name participants { name } } }
+    """
+    data, queries = execute_strawberry(query)
+
+    assert len(data['getMessages']) == 20
+    assert data['getMessages'][0]['user']['name'] == 'user_1'
+    assert [p['name'] for p in data['getMessages'][0]['chatroom']['participants']] == ['user_0', 'user_1', 'user_2']
+    # Сообщения вместе с автором и чатом, плюс один запрос за участниками
+    assert len(queries) == 2
+    assert 'password' not in queries[0]['sql']
+
+
+@pytest.mark.django_db
+def test_connection_keeps_cursor_columns():
+    create_messages(5)
+    data, queries = execute_strawberry(
+        '{ messagesConnection(chatroomName: "chatroom_1", first: 2) { edges { cursor node { text } } } }')
+
+    assert [edge['node']['text'] for edge in data['messagesConnection']['edges']] == ['text_0', 'text_1']
+    assert len(queries) == 1
+
+
+@pytest.mark.django_db
+def test_graphene_selects_requested_columns():
+    users = create_messages(0)
+    request = RequestFactory().post('/graphql/graphene/', HTTP_COOKIE=f"access-token={create_access_token(users[0])}")
+    query = "{ users { ... on UserType { name } } }"
+    with CaptureQueriesContext(connection) as queries:
+        result = graphene_schema.execute(query, context_value=request,
+                                         middleware=[GrapheneAuthMiddleware(), DataLoaderMiddleware()])
+
+    assert result.errors is None
+    assert [user['name'] for user in result.data['users']] == ['user_0', 'user_1', 'user_2']
+    assert len(queries) == 1
+    assert 'email' not in queries[0]['sql']
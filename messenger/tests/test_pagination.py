@@ -0,0 +1,113 @@
+import pytest
+from asgiref.sync import async_to_sync
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from messenger.models import Chatroom, Message, User
+from messenger.pagination import keyset_page, decode_cursor, encode_cursor
+from messenger.strawberry import schema
+
+
+def create_messages(count):
+    user = User.objects.create(name='test_user', email='test_email')
+    chatroom = Chatroom.objects.create(name='chatroom_1')
+    chatroom.participants.add(user)
+    messages = [Message.objects.create(chatroom=chatroom, user=user, text=str(i)) for i in range(count)]
+    # Половина сообщений с одинаковым временем, как при пакетной отправке
+    same_time = timezone.now()
+    Message.objects.filter(id__in=[m.id for m in messages[:count // 2]]).update(created_at=same_time)
+    return list(Message.objects.order_by('created_at', 'id'))
+
+
+@pytest.mark.django_db
+def test_forward_pages_do_not_skip_equal_timestamps():
+    messages = create_messages(10)
+    seen = []
+    after = None
+    while True:
+        items, has_next_page, _ = keyset_page(Message.objects.all(), first=3, after=after)
+        seen.extend(items)
+        if not has_next_page:
+            break
+        after = encode_cursor(items[-1].created_at, items[-1].id)
+
+    assert [m.id for m in seen] == [m.id for m in messages]
+
+
+@pytest.mark.django_db
+def test_backward_pages():
+    messages = create_messages(10)
+    items, _, has_previous_page = keyset_page(Message.objects.all(), last=4)
+    assert [m.id for m in items] == [m.id for m in messages[-4:]]
+    assert has_previous_page
+
+    before = encode_cursor(items[0].created_at, items[0].id)
+    items, has_next_page, has_previous_page = keyset_page(Message.objects.all(), last=10, before=before)
+    assert [m.id for m in items] == [m.id for m in messages[:6]]
+    assert has_next_page
+    assert not has_previous_page
+
+
+@pytest.mark.django_db
+def test_page_is_single_query():
+    messages = create_messages(10)
+    after = encode_cursor(messages[2].created_at, messages[2].id)
+    with CaptureQueriesContext(connection) as queries:
+        keyset_page(Message.objects.all(), first=3, after=after)
+    assert len(queries) == 1
+
+
+def test_invalid_cursor():
+    with pytest.raises(ValueError):
+        decode_cursor('not-a-cursor')
+
+
+@pytest.mark.django_db
+def test_get_messages_before_id_keeps_equal_timestamps():
+    messages = create_messages(10)
+    pivot = messages[3]
+    query = f'{{ getMessages(chatroomName: "chatroom_1", beforeId: {pivot.id}) {{ id }} }}'
+    with CaptureQueriesContext(connection) as queries:
+        result = async_to_sync(schema.execute)(query)
+    assert [int(m['id']) for m in result.data['getMessages']] == [m.id for m in reversed(messages[:3])]
+    # Один запрос, без отдельного запроса за before_id
+    assert len(queries) == 1
+
+
+CHATROOM_MESSAGES = """
+query ($first: Int, $after: String) {
+  getMessages(chatroomName: "chatroom_1", limit: 1) {
+    chatroom {
+      messages(first: $first, after: $after) {
+        edges { cursor node { id text } }
+        pageInfo { hasNextPage endCursor }
+      }
+    }
+  }
+}
+"""
+
+
+@pytest.mark.django_db
+def test_chatroom_messages_are_paginated_and_capped(settings):
+    settings.MESSENGER_PAGINATION = {'MAX_PAGE_SIZE': 4}
+    messages = create_messages(10)
+
+    seen = []
+    after = None
+    while True:
+        # Клиент просит больше, чем разрешено: сервер отдает не больше MAX_PAGE_SIZE
+        with CaptureQueriesContext(connection) as queries:
+            result = async_to_sync(schema.execute)(CHATROOM_MESSAGES, variable_values={'first': 50, 'after': after})
+        assert result.errors is None, result.errors
+        page = result.data['getMessages'][0]['chatroom']['messages']
+        assert len(page['edges']) <= 4
+        # Последнее сообщение с чатом, затем страница истории
+        assert len(queries) == 2
+        seen += [int(edge['node']['id']) for edge in page['edges']]
+        if not page['pageInfo']['hasNextPage']:
+            break
+        after = page['pageInfo']['endCursor']
+
+    assert seen == [m.id for m in messages]
@@ -0,0 +1,69 @@
+import asyncio
+
+import pytest
+
+from messenger.coalescer import Coalescer
+from messenger.dispatch import event_dispatcher
+from messenger.strawberry import notify_read, read_receipt_subscriptions, read_receipts
+from messenger.subscriptions import SubscriberQueue
+
+
+@pytest.mark.asyncio
+async def test_burst_is_flushed_once_with_merged_values():
+    flushed = []
+
+    async def flush(items):
+        flushed.append(items)
+
+    coalescer = Coalescer(flush, window=0.05, merge=max)
+    for message_id in (3, 7, 5):
+        coalescer.add((1, 10), message_id)
+    coalescer.add((2, 10), 4)
+
+    await asyncio.sleep(0.1)
+    assert flushed == [{(1, 10): 7, (2, 10): 4}]
+
+    coalescer.add((1, 10), 8)
+    await coalescer.drain()
+    assert flushed[-1] == {(1, 10): 8}
+
+
+@pytest.mark.asyncio
+async def test_failing_flush_does_not_lose_next_window():
+    flushed = []
+
+    async def flush(items):
+        if not flushed:
+            flushed.append(None)
+            raise RuntimeError("boom")
+        flushed.append(items)
+
+    coalescer = Coalescer(flush, window=0.01)
+    coalescer.add('a', 1)
+    await asyncio.sleep(0.05)
+    coalescer.add('a', 2)
+    await asyncio.sleep(0.05)
+
+    assert flushed == [None, {'a': 2}]
+
+
+@pytest.mark.asyncio
+async def test_read_receipts_from_request_threads_arrive_as_one_batch(monkeypatch):
+    monkeypatch.setattr(read_receipts, 'window', 0.05)
+    queue = SubscriberQueue()
+    read_receipt_subscriptions.add_subscriber(1, queue)
+    event_dispatcher.start()
+
+    try:
+        # Синхронные мутации в потоках запросов: курсоры двух пользователей, у одного три отметки подряд
+        for user_id, message_id in ((10, 3), (10, 5), (20, 4), (10, 4)):
+            await asyncio.to_thread(notify_read, 1, user_id, message_id)
+
+        batch = await asyncio.wait_for(queue.get(), timeout=1)
+        assert {(receipt.user_id, receipt.last_read_message_id) for receipt in batch} == {(10, 5), (20, 4)}
+        assert {receipt.chatroom_id for receipt in batch} == {1}
+        await asyncio.sleep(0.1)
+        assert queue.empty()
+    finally:
+        read_receipt_subscriptions.unsubscribe(queue)
+        await event_dispatcher.stop()
@@ -0,0 +1,95 @@
+import os
+import time
+
+import pytest
+from django.core.management import call_command
+from django.db import connection
+
+from messenger.models import Chatroom, User
+from messenger.search import search_by_name
+
+pytestmark = pytest.mark.skipif(connection.vendor != 'sqlite', reason="Проверяется индекс FTS5 для SQLite")
+
+BENCHMARK_USERS = 1_000_000
+
+
+def create_users(*names):
+    return [User.objects.create(name=name, email=f'{name}_email') for name in names]
+
+
+def names(queryset):
+    return [obj.name for obj in queryset]
+
+
+@pytest.mark.django_db
+def test_prefix_matches_first_with_stable_order():
+    create_users('joanna', 'hanna', 'annabel', 'anna', 'bob')
+
+    assert names(search_by_name(User.objects.all(), 'ann')) == ['anna', 'annabel', 'hanna', 'joanna']
+    assert names(search_by_name(User.objects.all(), 'ANN')[:2]) == ['anna', 'annabel']
+    # Короткий запрос не поддерживается триграммами и ищется обычным вхождением
+    assert names(search_by_name(User.objects.all(), 'an')) == ['anna', 'annabel', 'hanna', 'joanna']
+
+
+@pytest.mark.django_db
+def test_index_follows_changes():
+    user, = create_users('anna')
+    Chatroom.objects.create(name='annas chatroom')
+
+    user.name = 'maria'
+    user.save()
+    assert names(search_by_name(User.objects.all(), 'ann')) == []
+    assert names(search_by_name(User.objects.all(), 'mar')) == ['maria']
+    assert names(search_by_name(Chatroom.objects.all(), 'ann')) == ['annas chatroom']
+
+    user.delete()
+    assert names(search_by_name(User.objects.all(), 'mar')) == []
+
+
+@pytest.mark.django_db
+def test_rebuild_restores_dropped_triggers():
+    with connection.cursor() as cursor:
+        cursor.execute('DROP TRIGGER messenger_user_search_insert')
+    create_users('anna')
+    assert names(search_by_name(User.objects.all(), 'ann')) == []
+
+    call_command('rebuild_search_index')
+
+    assert names(search_by_name(User.objects.all(), 'ann')) == ['anna']
+    create_users('annabel')
+    assert names(search_by_name(User.objects.all(), 'ann')) == ['anna', 'annabel']
+
+
+@pytest.mark.django_db
+def test_search_uses_fts_index():
+    sql, params = search_by_name(User.objects.all(), 'ann')[:10].query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+        plan = ' '.join(row[-1] for row in cursor.fetchall())
+    assert 'VIRTUAL TABLE INDEX' in plan
+
+
+@pytest.mark.skipif(not os.environ.get('MESSENGER_BENCHMARK'), reason="Тяжелый бенчмарк, MESSENGER_BENCHMARK=1")
+@pytest.mark.django_db
+def test_search_benchmark(capsys):
+    with connection.cursor() as cursor:
+        cursor.execute(f"""
+            WITH RECURSIVE seq(n) AS (SELECT 1 UNION ALL SELECT n + 1 FROM seq WHERE n < {BENCHMARK_USERS})
+            INSERT INTO messenger_user (name, email, password, created_at, updated_at)
+            SELECT 'user_' || hex(randomblob(4)) || '_' || n, 'email_' || n, '', datetime(), datetime() FROM seq
+        """)
+
+    def measure(call, rounds=20):
+        started = time.perf_counter()
+        for _ in range(rounds):
+            call()
+        return (time.perf_counter() - started) / rounds * 1000
+
+    query = 'A1B2'
+    scan = measure(lambda: list(User.objects.filter(name__icontains=query).order_by('name', 'id')[:10]))
+    indexed = measure(lambda: list(search_by_name(User.objects.all(), query)[:10]))
+
+    with capsys.disabled():
+        print(f"\n{BENCHMARK_USERS} users, query '{query}': icontains scan {scan:.1f} ms, FTS5 trigram {indexed:.1f} ms")
+
+    assert indexed < scan
@@ -0,0 +1,172 @@
+import asyncio
+import os
+import time
+
+import pytest
+from asgiref.sync import sync_to_async
+from django.db import IntegrityError
+
+from messenger.models import Chatroom, ChatroomReadState, Message, User
+from messenger.resolvers.message_resolver import message_writer
+from messenger.resolvers.user_resolver import create_access_token
+from messenger.strawberry import chatroom_messages_subscriptions, schema
+from messenger.subscriptions import SubscriberQueue
+from messenger.unread import create_read_states
+
+SEND_MESSAGE = """
+mutation($token: String!, $text: String!) {
+  sendMessage(accessToken: $token, chatroomName: "chatroom_1", text: $text) { id text }
+}
+"""
+
+SEND_MESSAGES = """
+mutation($token: String!, $texts: [String!]!) {
+  sendMessages(accessToken: $token, chatroomName: "chatroom_1", texts: $texts) { id text }
+}
+"""
+
+
+@pytest.fixture(autouse=True)
+def disable_loop_monitor(settings):
+    settings.MESSENGER_LOOP_MONITOR = {'ENABLED': False}
+
+
+@sync_to_async
+def create_chatroom():
+    author = User.objects.create(name='author', email='author_email')
+    other = User.objects.create(name='other', email='other_email')
+    chatroom = Chatroom.objects.create(name='chatroom_1')
+    chatroom.participants.set([author, other])
+    create_read_states(chatroom.id, [author.id, other.id])
+    return chatroom, author, other
+
+
+@sync_to_async
+def chatroom_state(chatroom, user):
+    texts = list(Message.objects.filter(chatroom=chatroom).order_by('id').values_list('text', flat=True))
+    return (texts, Chatroom.objects.get(id=chatroom.id).last_message.text,
+            ChatroomReadState.objects.get(chatroom=chatroom, user=user).unread_count)
+
+
+def drain(queue):
+    items = []
+    while not queue.empty():
+        items.append(queue.get_nowait())
+    return items
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+async def test_send_messages_saves_batch_and_notifies_in_order():
+    chatroom, author, other = await create_chatroom()
+    queue = SubscriberQueue()
+    chatroom_messages_subscriptions.add_subscriber(chatroom.id, queue)
+
+    try:
+        result = await schema.execute(SEND_MESSAGES, variable_values={
+            'token': create_access_token(author), 'texts': ['a', 'b', 'c']})
+        assert result.errors is None, result.errors
+
+        assert [message['text'] for message in result.data['sendMessages']] == ['a', 'b', 'c']
+        assert await chatroom_state(chatroom, other) == (['a', 'b', 'c'], 'c', 3)
+        assert [message.text for message in drain(queue)] == ['a', 'b', 'c']
+    finally:
+        chatroom_messages_subscriptions.unsubscribe(queue)
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+async def test_concurrent_sends_are_written_as_one_batch(monkeypatch):
+    chatroom, author, other = await create_chatroom()
+    token = create_access_token(author)
+    batches = []
+    write_batch = message_writer.flush
+
+    async def record(entries):
+        batches.append([text for _, _, text in entries])
+        return await write_batch(entries)
+
+    monkeypatch.setattr(message_writer, 'flush', record)
+    monkeypatch.setattr(message_writer, 'window', 0.05)
+    queue = SubscriberQueue()
+    chatroom_messages_subscriptions.add_subscriber(chatroom.id, queue)
+
+    try:
+        texts = [str(i) for i in range(10)]
+        results = await asyncio.gather(*[
+            schema.execute(SEND_MESSAGE, variable_values={'token': token, 'text': text}) for text in texts])
+
+        assert all(result.errors is None for result in results), [result.errors for result in results]
+        # Каждый отправитель получает свое сообщение, а в базу ушла одна вставка
+        assert [result.data['sendMessage']['text'] for result in results] == texts
+        assert len(batches) == 1 and sorted(batches[0]) == sorted(texts)
+        saved, last_text, unread_count = await chatroom_state(chatroom, other)
+        assert saved == batches[0] and last_text == batches[0][-1] and unread_count == 10
+        # Уведомления в порядке сохранения
+        assert [message.text for message in drain(queue)] == batches[0]
+    finally:
+        chatroom_messages_subscriptions.unsubscribe(queue)
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+async def test_failed_entry_fails_only_its_sender(monkeypatch):
+    monkeypatch.setattr(message_writer, 'window', 0.05)
+    chatroom, author, other = await create_chatroom()
+
+    # Без текста вставка падает на NOT NULL и роняет всю пачку
+    results = await asyncio.gather(*[message_writer.submit((chatroom, author, text)) for text in ('a', None, 'b')],
+                                   return_exceptions=True)
+
+    assert results[0].text == 'a' and results[2].text == 'b'
+    assert isinstance(results[1], IntegrityError)
+    assert await chatroom_state(chatroom, other) == (['a', 'b'], 'b', 2)
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+async def test_publish_failure_still_returns_saved_messages(monkeypatch):
+    async def failing(messages):
+        raise RuntimeError("broker is down")
+
+    monkeypatch.setattr('messenger.resolvers.message_resolver.notify_new_messages', failing)
+    chatroom, author, other = await create_chatroom()
+
+    results = await asyncio.gather(*[message_writer.submit((chatroom, author, text)) for text in 'ab'])
+
+    assert [message.text for message in results] == ['a', 'b']
+    assert await chatroom_state(chatroom, other) == (['a', 'b'], 'b', 2)
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.skipif(not os.environ.get('MESSENGER_BENCHMARK'), reason="Бенчмарк: MESSENGER_BENCHMARK=1")
+async def test_send_throughput(monkeypatch):
+    chatroom, author, _ = await create_chatroom()
+    token = create_access_token(author)
+    count = 500
+
+    async def measure(send):
+        started = time.perf_counter()
+        await send()
+        return count / (time.perf_counter() - started)
+
+    async def one_by_one():
+        for i in range(count):
+            await schema.execute(SEND_MESSAGE, variable_values={'token': token, 'text': str(i)})
+
+    async def concurrent():
+        await asyncio.gather(*[schema.execute(SEND_MESSAGE, variable_values={'token': token, 'text': str(i)})
+                               for i in range(count)])
+
+    async def batched():
+        for start in range(0, count, 100):
+            await schema.execute(SEND_MESSAGES, variable_values={
+                'token': token, 'texts': [str(i) for i in range(start, start + 100)]})
+
+    sequential_rate = await measure(one_by_one)
+    concurrent_rate = await measure(concurrent)
+    batched_rate = await measure(batched)
+    print(f"\nsend {count} messages, one worker: sequential {sequential_rate:.0f} msg/s, "
+          f"concurrent {concurrent_rate:.0f} msg/s, sendMessages x100 {batched_rate:.0f} msg/s")
+    assert concurrent_rate > sequential_rate
@@ -0,0 +1,130 @@
+import statistics
+import time
+
+import pytest
+from asgiref.sync import async_to_sync
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from conftest import execute_graphene
+from messenger.middlewares import UserCache, aget_user_from_token, get_user_from_token, \
+    user_cache
+from messenger.models import User
+from messenger.resolvers.user_resolver import create_access_token
+
+ROUNDS = 200
+
+
+@pytest.fixture(autouse=True)
+def clear_user_cache():
+    user_cache.clear()
+    yield
+    user_cache.clear()
+
+
+def execute(query, user):
+    result, _ = execute_graphene(user, query, loaders=False)
+    assert result.errors is None, result.errors
+    return result
+
+
+@pytest.mark.django_db
+def test_claims_user_without_queries():
+    user = User.objects.create(name='test_user', email='test_email', avatar='avatars/user/a.png')
+    token = create_access_token(user)
+
+    with CaptureQueriesContext(connection) as queries:
+        claims_user = get_user_from_token(token, trust_claims=True)
+
+    assert len(queries) == 0
+    assert (claims_user.id, claims_user.name, claims_user.email) == (user.id, user.name, user.email)
+    assert claims_user.avatar.name == 'avatars/user/a.png'
+
+
+@pytest.mark.django_db
+def test_mutation_path_uses_cache_and_update_invalidates_it():
+    user = User.objects.create(name='test_user', email='test_email')
+    token = create_access_token(user)
+    get_user_from_token(token)
+
+    with CaptureQueriesContext(connection) as queries:
+        cached = get_user_from_token(token)
+    assert len(queries) == 0
+    # Каждый вызов получает свой экземпляр
+    assert cached is not get_user_from_token(token)
+
+    execute('mutation { userUpdate(newUser: {name: "renamed_user"}) { message } }', user)
+
+    assert get_user_from_token(token).name == 'renamed_user'
+
+
+@pytest.mark.django_db
+def test_update_does_not_restore_stale_cached_fields():
+    user = User.objects.create(name='test_user', email='test_email', password='old_hash')
+    token = create_access_token(user)
+    get_user_from_token(token)
+    # Пароль сменили на другом воркере: кэш этого процесса о нем не знает
+    User.objects.filter(id=user.id).update(password='new_hash', email='new_email')
+
+    execute('mutation { userUpdate(newUser: {name: "renamed_user"}) { message } }', user)
+
+    user.refresh_from_db()
+    assert (user.name, user.email, user.password) == ('renamed_user', 'new_email', 'new_hash')
+
+
+@pytest.mark.django_db
+def test_user_cache_ttl_and_size():
+    users = [User.objects.create(name=f'user_{i}', email=f'email_{i}') for i in range(3)]
+    cache = UserCache(ttl=30, size=2)
+    for user in users:
+        cache.set(user)
+    assert cache.get(users[0].id) is None
+    assert cache.get(users[2].id).name == 'user_2'
+
+    expired = UserCache(ttl=-1, size=2)
+    expired.set(users[0])
+    assert expired.get(users[0].id) is None
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    return statistics.median(samples) * 1000, samples[int(len(samples) * 0.99) - 1] * 1000
+
+
+def measure(call):
+    samples = []
+    for _ in range(ROUNDS):
+        started = time.perf_counter()
+        call()
+        samples.append(time.perf_counter() - started)
+    return percentiles(samples)
+
+
+@pytest.mark.django_db
+def test_stateless_auth_benchmark(settings, capsys):
+    user = User.objects.create(name='test_user', email='test_email')
+    for i in range(20):
+        User.objects.create(name=f'user_{i}', email=f'email_{i}')
+    token = create_access_token(user)
+    read = lambda: execute("{ users { id name email } }", user)
+    connect = lambda: async_to_sync(aget_user_from_token)(token, trust_claims=True)
+
+    settings.MESSENGER_AUTH = {'STATELESS_READS': False, 'USER_CACHE_TTL': 0}
+    with CaptureQueriesContext(connection) as db_queries:
+        db_read = measure(read)
+        db_connect = measure(connect)
+
+    settings.MESSENGER_AUTH = {'STATELESS_READS': True}
+    with CaptureQueriesContext(connection) as claims_queries:
+        claims_read = measure(read)
+        claims_connect = measure(connect)
+
+    with capsys.disabled():
+        print(f"\nquery: database p50 {db_read[0]:.3f} ms, p99 {db_read[1]:.3f} ms; "
+              f"claims p50 {claims_read[0]:.3f} ms, p99 {claims_read[1]:.3f} ms")
+        print(f"subscription connect: database p50 {db_connect[0]:.3f} ms, p99 {db_connect[1]:.3f} ms; "
+              f"claims p50 {claims_connect[0]:.3f} ms, p99 {claims_connect[1]:.3f} ms")
+
+    # Аутентификация больше не обращается к базе: остается только запрос за данными
+    assert len(db_queries) == 3 * ROUNDS
+    assert len(claims_queries) == ROUNDS
@@ -0,0 +1,212 @@
+import asyncio
+from datetime import datetime, UTC
+from types import SimpleNamespace
+
+import pytest
+from channels.layers import InMemoryChannelLayer
+
+from messenger.broadcast import ChannelLayerBroadcast
+from messenger.dispatch import event_dispatcher
+from messenger.models import Chatroom, User
+from messenger.strawberry import ChatroomMessagesSubscription, ChatroomTypeStrawberry, chatroom_subscribers, \
+    chatroom_update_subscribers, notify_new_chatroom, notify_chatroom_update, get_subscription_chatroom_ids, \
+    chatroom_delete_subscribers, notify_chatroom_delete, deliver_chatroom_event
+from messenger.subscriptions import SubscriberQueue, SubscriptionStats, SubscriberDisconnected, report_subscription_stats, \
+    DROP_OLDEST, DROP_NEWEST, DISCONNECT
+
+
+def test_drop_oldest_keeps_latest_events():
+    stats = SubscriptionStats()
+    queue = SubscriberQueue(maxsize=2, policy=DROP_OLDEST, stats=stats)
+
+    for event in range(5):
+        assert queue.offer(event)
+
+    assert [queue.get_nowait(), queue.get_nowait()] == [3, 4]
+    assert stats.dropped == 3
+    assert stats.evicted == 0
+
+
+def test_drop_newest_keeps_earliest_events():
+    stats = SubscriptionStats()
+    queue = SubscriberQueue(maxsize=2, policy=DROP_NEWEST, stats=stats)
+
+    for event in range(5):
+        assert queue.offer(event)
+
+    assert [queue.get_nowait(), queue.get_nowait()] == [0, 1]
+    assert stats.dropped == 3
+
+
+@pytest.mark.asyncio
+async def test_disconnect_policy_closes_slow_subscriber():
+    stats = SubscriptionStats()
+    queue = SubscriberQueue(maxsize=1, policy=DISCONNECT, stats=stats)
+
+    assert queue.offer('first')
+    assert not queue.offer('second')
+    assert not queue.offer('third')
+    assert stats.evicted == 1
+
+    with pytest.raises(SubscriberDisconnected):
+        await queue.next()
+
+
+@pytest.mark.asyncio
+async def test_notify_never_waits_for_slow_subscriber():
+    subscriptions = ChatroomMessagesSubscription()
+    slow = SubscriberQueue(maxsize=1, policy=DISCONNECT, stats=SubscriptionStats())
+    fast = SubscriberQueue(maxsize=10, policy=DROP_OLDEST, stats=SubscriptionStats())
+    subscriptions.add_subscriber(1, slow)
+    subscriptions.add_subscriber(1, fast)
+
+    for message in range(3):
+        await asyncio.wait_for(subscriptions.notify_subscribers(1, message), timeout=1)
+
+    # Медленный подписчик отключен и удален из реестра, быстрый получил все
+    assert subscriptions.queues[1] == {fast}
+    assert fast.qsize() == 3
+
+
+def make_chatroom():
+    now = datetime.now(UTC)
+    participant = SimpleNamespace(id=1, name='user_1', email='email_1', password='', avatar=None,
+                                  created_at=now, updated_at=now)
+    return ChatroomTypeStrawberry(id=1, name='chatroom_1', participants=[participant], max_participants=8,
+                                  created_at=now, updated_at=now)
+
+
+async def wait_for_events():
+    # Публикация идет отдельной задачей, затем событие проходит через диспетчер
+    for _ in range(3):
+        await asyncio.sleep(0)
+    await asyncio.wait_for(event_dispatcher.join(), timeout=1)
+
+
+@pytest.mark.asyncio
+async def test_chatroom_events_are_routed_to_participants_only():
+    event_dispatcher.start()
+    member = chatroom_subscribers.subscribe(1)
+    member_other_tab = chatroom_subscribers.subscribe(1)
+    stranger = chatroom_subscribers.subscribe(3)
+    removed = chatroom_update_subscribers.subscribe(2)
+
+    chatroom = make_chatroom()
+
+    try:
+        notify_new_chatroom(chatroom)
+        notify_chatroom_update(chatroom, removed_user_ids={2})
+        await wait_for_events()
+
+        assert member.get_nowait().id == chatroom.id
+        assert member_other_tab.get_nowait().name == 'chatroom_1'
+        assert stranger.empty()
+        assert removed.get_nowait().id == chatroom.id
+    finally:
+        chatroom_subscribers.unsubscribe(1, member)
+        chatroom_subscribers.unsubscribe(1, member_other_tab)
+        chatroom_subscribers.unsubscribe(3, stranger)
+        chatroom_update_subscribers.unsubscribe(2, removed)
+        await event_dispatcher.stop()
+
+
+def test_unsubscribe_removes_every_registration():
+    subscriptions = ChatroomMessagesSubscription()
+    queue = SubscriberQueue()
+    subscriptions.bind_user(1, queue)
+    for chatroom_id in range(100):
+        subscriptions.add_subscriber(chatroom_id, queue)
+
+    subscriptions.unsubscribe(queue)
+
+    assert not subscriptions.queues
+    assert not subscriptions.chatrooms
+    assert not subscriptions.users
+    assert not subscriptions.owners
+
+
+def test_user_subscription_follows_membership_changes():
+    subscriptions = ChatroomMessagesSubscription()
+    queue = SubscriberQueue()
+    subscriptions.bind_user(1, queue)
+    subscriptions.add_subscriber(10, queue)
+
+    subscriptions.add_user_chatroom({1, 2}, 20)
+    assert subscriptions.chatrooms[queue] == {10, 20}
+
+    subscriptions.remove_user_chatroom({1}, 10)
+    subscriptions.remove_chatroom(20)
+    assert subscriptions.chatrooms[queue] == set()
+    assert not subscriptions.queues
+
+
+@pytest.mark.asyncio
+async def test_chatroom_message_subscriptions_do_not_leak():
+    subscriptions = ChatroomMessagesSubscription()
+
+    async def wait_registered(count):
+        while len(subscriptions.chatrooms) < count:
+            await asyncio.sleep(0.01)
+
+    for batch in range(10):
+        generators = [subscriptions.listen([1, 2, 3], user_id) for user_id in range(1000)]
+        tasks = [asyncio.create_task(anext(generator)) for generator in generators]
+        await asyncio.wait_for(wait_registered(len(tasks)), timeout=5)
+        assert len(subscriptions.queues[2]) == 1000
+
+        for task in tasks:
+            task.cancel()
+        await asyncio.wait_for(asyncio.gather(*tasks, return_exceptions=True), timeout=5)
+
+    assert not subscriptions.queues
+    assert not subscriptions.chatrooms
+    assert not subscriptions.users
+    assert not subscriptions.owners
+
+
+@pytest.mark.asyncio
+@pytest.mark.django_db(transaction=True)
+async def test_subscription_is_limited_to_user_chatrooms():
+    user = await User.objects.acreate(name='test_user', email='test_email')
+    own = await Chatroom.objects.acreate(name='own')
+    foreign = await Chatroom.objects.acreate(name='foreign')
+    await own.participants.aadd(user)
+
+    assert await get_subscription_chatroom_ids(None, None, user) == {own.id}
+    assert await get_subscription_chatroom_ids([own.id, foreign.id], None, user) == {own.id}
+    assert await get_subscription_chatroom_ids(None, ['foreign'], user) == set()
+
+
+
+def test_report_subscription_stats_calls_hook(settings, mocker):
+    hook = mocker.Mock()
+    import_string = mocker.patch('messenger.subscriptions.import_string', return_value=hook)
+    settings.MESSENGER_SUBSCRIPTIONS = {'STATS_HOOK': 'metrics.export_subscription_stats'}
+    stats = SubscriptionStats(delivered=5, dropped=2, evicted=1)
+
+    report_subscription_stats(stats)
+
+    import_string.assert_called_once_with('metrics.export_subscription_stats')
+    hook.assert_called_once_with({'delivered': 5, 'dropped': 2, 'evicted': 1})
+
+
+@pytest.mark.asyncio
+async def test_chatroom_events_go_through_broadcast(monkeypatch):
+    # Событие о чате доходит до подписчиков через брокер, как с другого воркера
+    layer = InMemoryChannelLayer()
+    chatroom_broadcast = ChannelLayerBroadcast(deliver_chatroom_event, layer=layer, group='messenger.chatrooms')
+    monkeypatch.setattr('messenger.strawberry.chatroom_broadcast', chatroom_broadcast)
+    await chatroom_broadcast.start()
+    event_dispatcher.start()
+    queue = chatroom_delete_subscribers.subscribe(1)
+
+    try:
+        chatroom = make_chatroom()
+        notify_chatroom_delete(chatroom)
+
+        received = await asyncio.wait_for(queue.next(), timeout=1)
+        assert (received.id, received.name, received.participants[0].name) == (1, 'chatroom_1', 'user_1')
+    finally:
+        chatroom_delete_subscribers.unsubscribe(1, queue)
+        await chatroom_broadcast.stop()
+        await event_dispatcher.stop()
@@ -0,0 +1,80 @@
+import io
+
+import pytest
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.core.files.storage import default_storage
+from PIL import Image
+
+from conftest import execute_graphene, image_bytes
+from messenger.models import Chatroom, User
+from messenger.thumbnails import generate_thumbnails, render_thumbnails, thumbnail_name
+
+
+ORIGINAL_SIZE = (800, 600)
+
+
+@pytest.fixture
+def media_root(media_root, settings):
+    settings.MESSENGER_AVATARS = {'THUMBNAIL_SIZES': (64, 256), 'QUALITY': 80, 'WORKERS': 1}
+    return media_root
+
+
+def test_render_makes_square_webp_thumbnails():
+    thumbnails = render_thumbnails(image_bytes(ORIGINAL_SIZE, mode='RGBA'), (64, 256), 80)
+
+    for size, content in thumbnails.items():
+        with Image.open(io.BytesIO(content)) as thumbnail:
+            assert thumbnail.format == 'WEBP'
+            assert thumbnail.size == (size, size)
+    # Превью для списка чатов намного меньше оригинала
+    assert len(thumbnails[64]) < len(image_bytes(ORIGINAL_SIZE)) / 4
+
+
+def test_thumbnail_name_is_derived_from_avatar():
+    assert thumbnail_name('avatars/user/photo.png', 64) == 'avatars/user/thumbs/photo_64.webp'
+
+
+@pytest.mark.django_db
+def test_upload_generates_thumbnails_in_background(media_root):
+    user = User.objects.create(name='test_user', email='test_email')
+    user.avatar.save('photo.png', ContentFile(image_bytes(ORIGINAL_SIZE)))
+
+    generate_thumbnails(user.avatar).result(timeout=60)
+
+    for size in (64, 256):
+        with default_storage.open(thumbnail_name(user.avatar.name, size)) as file:
+            assert Image.open(file).size == (size, size)
+
+
+@pytest.mark.django_db
+def test_types_expose_thumbnail_urls(media_root):
+    user = User.objects.create(name='test_user', email='test_email', avatar='avatars/user/photo.png')
+
+    result, _ = execute_graphene(user, '{ user(id: %d) { avatarThumbnails { size url } } }' % user.id)
+
+    assert result.errors is None, result.errors
+    assert result.data['user']['avatarThumbnails'] == [
+        {'size': 64, 'url': '/media/avatars/user/thumbs/photo_64.webp'},
+        {'size': 256, 'url': '/media/avatars/user/thumbs/photo_256.webp'},
+    ]
+
+
+@pytest.mark.django_db
+def test_command_generates_thumbnails_for_existing_avatars(media_root, capsys):
+    # Аватары загружены до появления превью, чат использует тот же файл, что и пользователь
+    user = User.objects.create(name='test_user', email='test_email')
+    user.avatar.save('photo.png', ContentFile(image_bytes(ORIGINAL_SIZE)))
+    chatroom = Chatroom.objects.create(name='chatroom_1', avatar=user.avatar.name)
+    other = Chatroom.objects.create(name='chatroom_2')
+    other.avatar.save('chat.png', ContentFile(image_bytes()))
+
+    call_command('generate_thumbnails')
+
+    for name in (chatroom.avatar.name, other.avatar.name):
+        for size in (64, 256):
+            assert default_storage.exists(thumbnail_name(name, size))
+    assert 'Generated thumbnails for 2 avatars, 0 failed' in capsys.readouterr().out
+    # Повторный запуск готовые превью не трогает
+    call_command('generate_thumbnails')
+    assert 'Generated thumbnails for 0 avatars' in capsys.readouterr().out
@@ -0,0 +1,190 @@
+import pytest
+from asgiref.sync import async_to_sync
+from django.core.management import call_command
+from django.db import connection
+from django.db.migrations.executor import MigrationExecutor
+
+from conftest import execute_graphene
+from messenger.models import Chatroom, ChatroomReadState, User
+from messenger.resolvers.message_resolver import create_message
+from messenger.resolvers.user_resolver import create_access_token
+from messenger.strawberry import schema
+from messenger.unread import create_read_states, rebuild_unread_counts
+
+USER_CHATROOMS = "{ userChatrooms { name unreadMessages { count } } }"
+
+
+def execute(user, query):
+    result, queries = execute_graphene(user, query)
+    assert result.errors is None, result.errors
+    return result.data, queries
+
+
+def create_chatrooms(count):
+    me = User.objects.create(name='me_user', email='me_email')
+    other = User.objects.create(name='other_user', email='other_email')
+    chatrooms = []
+    for i in range(count):
+        chatroom = Chatroom.objects.create(name=f'chatroom_{i}')
+        chatroom.participants.set([me, other])
+        create_read_states(chatroom.id, [me.id, other.id])
+        chatrooms.append(chatroom)
+    return me, other, chatrooms
+
+
+def unread(user):
+    data, _ = execute(user, USER_CHATROOMS)
+    return {chatroom['name']: chatroom['unreadMessages']['count'] for chatroom in data['userChatrooms']}
+
+
+@pytest.mark.django_db
+def test_counter_follows_sent_and_read_messages():
+    me, other, chatrooms = create_chatrooms(2)
+    for text in ('a', 'b', 'c'):
+        async_to_sync(create_message)(chatrooms[0], other, text)
+    async_to_sync(create_message)(chatrooms[1], me, 'mine')
+
+    assert unread(me) == {'chatroom_0': 3, 'chatroom_1': 0}
+    assert unread(other) == {'chatroom_0': 0, 'chatroom_1': 1}
+
+    data, _ = execute(me, 'mutation { markRead(chatroomId: %d) { count } }' % chatrooms[0].id)
+    assert data['markRead']['count'] == 0
+    assert unread(me) == {'chatroom_0': 0, 'chatroom_1': 0}
+
+
+def mark_read(user, chatroom, up_to):
+    data, queries = execute(user, 'mutation { markRead(chatroomId: %d, upTo: %d) { count } }' % (chatroom.id, up_to))
+    return data['markRead']['count'], queries
+
+
+@pytest.mark.django_db
+def test_mark_read_up_to_message_moves_cursor_forward_only():
+    me, other, chatrooms = create_chatrooms(1)
+    messages = [async_to_sync(create_message)(chatrooms[0], other, text) for text in 'abcde']
+    async_to_sync(create_message)(chatrooms[0], me, 'mine')
+
+    # Свои сообщения после курсора не считаются: UPDATE курсора и чтение счетчика
+    assert mark_read(me, chatrooms[0], messages[1].id) == (3, 2)
+    assert ChatroomReadState.objects.get(user=me).last_read_message_id == messages[1].id
+    # Отметка, пришедшая позже более свежей, курсор назад не двигает
+    assert mark_read(me, chatrooms[0], messages[3].id)[0] == 1
+    assert mark_read(me, chatrooms[0], messages[0].id)[0] == 1
+    assert ChatroomReadState.objects.get(user=me).last_read_message_id == messages[3].id
+    assert unread(other) == {'chatroom_0': 1}
+
+
+@pytest.mark.django_db
+def test_mark_read_rejects_foreign_chatroom_and_message():
+    me, other, chatrooms = create_chatrooms(2)
+    message = async_to_sync(create_message)(chatrooms[1], other, 'a')
+    stranger = User.objects.create(name='stranger', email='stranger_email')
+
+    # Сообщение из другого чата курсор не двигает
+    assert mark_read(me, chatrooms[0], message.id)[0] == 0
+    assert ChatroomReadState.objects.get(user=me, chatroom=chatrooms[0]).last_read_message_id is None
+
+    result, _ = execute_graphene(stranger, 'mutation { markRead(chatroomId: %d) { count } }' % chatrooms[1].id)
+    assert result.errors[0].message == "Chatroom does not exist"
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('count', [5, 100])
+def test_chat_list_with_counts_is_one_query(count):
+    me, other, chatrooms = create_chatrooms(count)
+    async_to_sync(create_message)(chatrooms[-1], other, 'hello')
+
+    data, queries = execute(me, USER_CHATROOMS)
+
+    assert [chatroom['unreadMessages']['count'] for chatroom in data['userChatrooms']] == [0] * (count - 1) + [1]
+    assert queries == 1
+
+
+@pytest.mark.django_db
+def test_rebuild_restores_counters():
+    me, other, chatrooms = create_chatrooms(2)
+    messages = [async_to_sync(create_message)(chatrooms[0], other, text) for text in 'abc']
+    mark_read(me, chatrooms[0], messages[0].id)
+    ChatroomReadState.objects.update(unread_count=42)
+    # Строка для пользователя, который больше не участник
+    stranger = User.objects.create(name='stranger', email='stranger_email')
+    create_read_states(chatrooms[0].id, [stranger.id])
+
+    call_command('rebuild_unread_counts')
+
+    assert unread(me) == {'chatroom_0': 2, 'chatroom_1': 0}
+    assert unread(other) == {'chatroom_0': 0, 'chatroom_1': 0}
+    assert not ChatroomReadState.objects.filter(user=stranger).exists()
+
+
+@pytest.mark.django_db
+def test_deleting_message_decrements_counters_of_those_who_have_not_read_it():
+    me, other, chatrooms = create_chatrooms(1)
+    first, second, third = [async_to_sync(create_message)(chatrooms[0], other, text) for text in 'abc']
+    mark_read(me, chatrooms[0], first.id)
+    assert unread(me) == {'chatroom_0': 2}
+
+    for message in (first, third):
+        result = async_to_sync(schema.execute)(
+            'mutation($token: String!, $id: ID!) { deleteMessage(accessToken: $token, chatroomName: "chatroom_0", '
+            'messageId: $id) { message } }', variable_values={'token': create_access_token(other), 'id': message.id})
+        assert result.errors is None, result.errors
+
+    # Прочитанное удаление счетчик не меняет, непрочитанное - уменьшает
+    assert unread(me) == {'chatroom_0': 1}
+    assert unread(other) == {'chatroom_0': 0}
+
+
+def migrate(target):
+    executor = MigrationExecutor(connection)
+    executor.migrate([('messenger', target)])
+    return executor.loader.project_state([('messenger', target)]).apps
+
+
+@pytest.mark.django_db(transaction=True)
+def test_migration_creates_counters_for_existing_chatrooms():
+    apps = migrate('0012_name_search_index')
+    try:
+        HistoricalUser = apps.get_model('messenger', 'User')
+        HistoricalChatroom = apps.get_model('messenger', 'Chatroom')
+        HistoricalMessage = apps.get_model('messenger', 'Message')
+        me = HistoricalUser.objects.create(name='me_user', email='me_email')
+        other = HistoricalUser.objects.create(name='other_user', email='other_email')
+        chatroom = HistoricalChatroom.objects.create(name='chatroom_1')
+        chatroom.participants.set([me, other])
+        for is_read in (True, False, False):
+            HistoricalMessage.objects.create(chatroom=chatroom, user=other, text='text', is_read=is_read)
+
+        apps = migrate('0013_chatroomreadstate')
+
+        counts = apps.get_model('messenger', 'ChatroomReadState').objects \
+            .values_list('user_id', 'unread_count').order_by('user_id')
+        assert list(counts) == [(me.id, 2), (other.id, 0)]
+    finally:
+        migrate(MigrationExecutor(connection).loader.graph.leaf_nodes('messenger')[0][1])
+
+
+@pytest.mark.django_db(transaction=True)
+def test_migration_moves_read_flags_to_cursors():
+    apps = migrate('0013_chatroomreadstate')
+    try:
+        HistoricalUser = apps.get_model('messenger', 'User')
+        HistoricalChatroom = apps.get_model('messenger', 'Chatroom')
+        HistoricalMessage = apps.get_model('messenger', 'Message')
+        me = HistoricalUser.objects.create(name='me_user', email='me_email')
+        other = HistoricalUser.objects.create(name='other_user', email='other_email')
+        chatroom = HistoricalChatroom.objects.create(name='chatroom_1')
+        chatroom.participants.set([me, other])
+        messages = [HistoricalMessage.objects.create(chatroom=chatroom, user=other, text='text', is_read=is_read)
+                    for is_read in (True,) * 5 + (False,)]
+        # База прошла 0013 до появления шага с данными: строк счетчиков нет
+        apps.get_model('messenger', 'ChatroomReadState').objects.all().delete()
+
+        migrate('0014_read_cursors')
+
+        state = ChatroomReadState.objects.get(user_id=me.id, chatroom_id=chatroom.id)
+        assert (state.last_read_message_id, state.unread_count) == (messages[4].id, 1)
+        assert ChatroomReadState.objects.get(user_id=other.id).unread_count == 0
+        rebuild_unread_counts()
+        assert ChatroomReadState.objects.get(user_id=me.id).unread_count == 1
+    finally:
+        migrate(MigrationExecutor(connection).loader.graph.leaf_nodes('messenger')[0][1])
@@ -0,0 +1,148 @@
+import json
+
+import pytest
+from django.core.asgi import get_asgi_application
+from django.core.files.uploadedfile import SimpleUploadedFile
+
+from conftest import image_bytes
+from messenger.models import User
+from messenger.resolvers.user_resolver import create_access_token
+from messenger.storage import AtomicFileSystemStorage
+from messenger.uploads import UploadLimitApp, UploadRejected, inspect_image_header, validate_avatar
+
+UPDATE_AVATAR = 'mutation ($avatar: Upload) { userUpdate(newUser: {avatar: $avatar}) { message } }'
+
+
+@pytest.fixture
+def media_root(media_root, settings, monkeypatch):
+    # Превью строятся в фоне и могут пережить тест с временным MEDIA_ROOT
+    monkeypatch.setattr('messenger.resolvers.user_resolver.generate_thumbnails', lambda avatar: None)
+    settings.MESSENGER_UPLOADS = {'MAX_SIZE': 64 * 1024, 'MAX_DIMENSION': 1024, 'HEADER_SIZE': 8 * 1024}
+    return media_root
+
+
+def upload_avatar(client, user, content, name='avatar.png'):
+    client.cookies['access-token'] = create_access_token(user)
+    return client.post('/graphql/graphene/', {
+        'operations': json.dumps({'query': UPDATE_AVATAR, 'variables': {'avatar': None}}),
+        'map': json.dumps({'0': ['variables.avatar']}),
+        '0': SimpleUploadedFile(name, content),
+    })
+
+
+def stored_files(root):
+    return sorted(path.name for path in root.rglob('*') if path.is_file())
+
+
+def test_header_is_enough_to_read_dimensions():
+    data = image_bytes((640, 480))
+    # PNG хранит размеры в первых байтах, весь файл для проверки не нужен
+    assert inspect_image_header(data[:64]) == ('PNG', 640, 480)
+    assert inspect_image_header(b'\x89PNG') is None
+
+
+@pytest.mark.django_db
+def test_valid_avatar_is_stored(client, media_root):
+    user = User.objects.create(name='test_user', email='test_email')
+
+    response = upload_avatar(client, user, image_bytes())
+
+    assert response.status_code == 200, response.content
+    user.refresh_from_db()
+    assert user.avatar.read(4) == b'\x89PNG'
+    assert [name for name in stored_files(media_root) if name.startswith('.upload-')] == []
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('content, error', [
+    (image_bytes() + b'\0' * 70 * 1024, 'File must not exceed 65536 bytes'),
+    (b'not an image' * 1000, 'Unsupported image format'),
+    (image_bytes((2000, 10)), 'Image must not exceed 1024x1024'),
+])
+def test_rejected_upload_is_not_stored(client, media_root, content, error):
+    user = User.objects.create(name='test_user', email='test_email')
+
+    response = upload_avatar(client, user, content)
+
+    assert response.status_code == 400
+    assert json.loads(response.content)['errors'][0]['message'] == error
+    user.refresh_from_db()
+    assert not user.avatar
+    assert stored_files(media_root) == []
+
+
+def test_resolvers_validate_files_passed_directly(media_root):
+    with pytest.raises(UploadRejected):
+        validate_avatar(SimpleUploadedFile('avatar.png', b'GIF89a'))
+    assert validate_avatar(SimpleUploadedFile('avatar.png', image_bytes())).read(4) == b'\x89PNG'
+
+
+def test_atomic_storage_does_not_overwrite(tmp_path):
+    storage = AtomicFileSystemStorage(location=str(tmp_path))
+
+    first = storage.save('avatars/a.png', SimpleUploadedFile('a.png', b'first'))
+    second = storage._save('avatars/a.png', SimpleUploadedFile('a.png', b'second'))
+
+    assert first == 'avatars/a.png' and second != first
+    assert storage.open(first).read() == b'first' and storage.open(second).read() == b'second'
+    assert stored_files(tmp_path) == sorted(['a.png', second.split('/')[-1]])
+
+
+async def call_app(app, chunks, headers=()):
+    """Запрос к ASGI-приложению с телом из chunks; возвращает отправленные сообщения и число прочитанных кусков"""
+    scope = {'type': 'http', 'method': 'POST', 'path': '/graphql/graphene/', 'query_string': b'',
+             'headers': [(key.encode(), value.encode()) for key, value in headers]}
+    chunks = list(chunks)
+    read = 0
+    messages = []
+
+    async def receive():
+        nonlocal read
+        read += 1
+        if read > len(chunks):
+            return {'type': 'http.disconnect'}
+        return {'type': 'http.request', 'body': chunks[read - 1], 'more_body': read < len(chunks)}
+
+    async def send(message):
+        messages.append(message)
+
+    await app(scope, receive, send)
+    return messages, read
+
+
+async def echo_app(scope, receive, send):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            break
+    await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+@pytest.mark.asyncio
+async def test_upload_limit_rejects_declared_length_before_reading(media_root):
+    messages, read = await call_app(UploadLimitApp(echo_app, '/graphql/graphene/'), [b'x'],
+                                    headers=[('content-length', str(200 * 1024))])
+
+    assert messages[0]['status'] == 413 and read == 0
+    assert json.loads(messages[1]['body'])['errors'][0]['message'] == 'File must not exceed 65536 bytes'
+
+
+@pytest.mark.asyncio
+async def test_upload_limit_stops_reading_chunked_body_before_django(media_root):
+    # Без Content-Length: Django дочитал бы все 1000 кусков во временный файл
+    chunks = [b'x' * 1024] * 1000
+    messages, read = await call_app(UploadLimitApp(get_asgi_application(), '/graphql/graphene/'), chunks)
+
+    assert [message.get('status') for message in messages] == [413, None]
+    assert read == 129
+
+
+@pytest.mark.asyncio
+async def test_upload_limit_passes_small_bodies(media_root):
+    messages, _ = await call_app(UploadLimitApp(echo_app, '/graphql/graphene/'), [b'a', b'b'],
+                                 headers=[('content-length', '2')])
+
+    assert messages[0]['status'] == 200 and messages[1]['body'] == b'ab'
@@ -0,0 +1,97 @@
+import io
+import multiprocessing
+import posixpath
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from PIL import Image, ImageOps
+
+
+def get_avatar_setting(name, default):
+    return getattr(settings, 'MESSENGER_AVATARS', {}).get(name, default)
+
+
+def get_thumbnail_sizes():
+    return get_avatar_setting('THUMBNAIL_SIZES', (64, 256))
+
+
+def thumbnail_name(name, size):
+    # avatars/user/photo.png -> avatars/user/thumbs/photo_64.webp: имя выводится из оригинала без запроса к базе
+    directory, filename = posixpath.split(str(name))
+    return posixpath.join(directory, 'thumbs', f'{posixpath.splitext(filename)[0]}_{size}.webp')
+
+
+def thumbnail_urls(field_file):
+    """Ссылки на превью аватара по размерам; имя файла или FieldFile, пусто - без аватара"""
+    if not field_file:
+        return []
+    storage = getattr(field_file, 'storage', None)
+    if storage is None:
+        from django.core.files.storage import default_storage as storage
+    return [(size, storage.url(thumbnail_name(field_file, size))) for size in get_thumbnail_sizes()]
+
+
+def render_thumbnails(data, sizes, quality):
+    """
+    Квадратные превью в WebP из байтов исходного изображения.
+    Выполняется в отдельном процессе, поэтому использует только Pillow, без Django
+    """
+    with Image.open(io.BytesIO(data)) as image:
+        image = ImageOps.exif_transpose(image)
+        image = image.convert('RGBA' if image.mode in ('RGBA', 'LA', 'P') else 'RGB')
+        thumbnails = {}
+        for size in sizes:
+            thumbnail = ImageOps.fit(image, (size, size), Image.Resampling.LANCZOS)
+            output = io.BytesIO()
+            thumbnail.save(output, 'WEBP', quality=quality, method=4)
+            thumbnails[size] = output.getvalue()
+    return thumbnails
+
+
+_process_pool = None
+_writer_pool = None
+
+
+def get_pools():
+    # Пулы создаются при первой загрузке. spawn: fork процесса с потоками Django и event loop небезопасен
+    global _process_pool, _writer_pool
+    if _process_pool is None:
+        workers = get_avatar_setting('WORKERS', 2)
+        _process_pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        _writer_pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='thumbnails')
+    return _process_pool, _writer_pool
+
+
+def save_thumbnails(storage, name, data):
+    process_pool, _ = get_pools()
+    thumbnails = process_pool.submit(render_thumbnails, data, tuple(get_thumbnail_sizes()),
+                                     get_avatar_setting('QUALITY', 80)).result()
+    # Превью пишутся под точными именами, мимо хэширования ContentAddressedStorage
+    storage = getattr(storage, 'derived', storage)
+    for size, content in thumbnails.items():
+        path = thumbnail_name(name, size)
+        # Имя превью фиксировано, иначе storage добавит к нему суффикс
+        storage.delete(path)
+        storage.save(path, ContentFile(content))
+    return thumbnails
+
+
+def generate_thumbnails(field_file):
+    """
+    Ставит превью аватара в очередь и сразу возвращает Future: резолвер не ждет Pillow.
+    Пока превью не готовы, клиент может показать оригинал по avatar
+    """
+    if not field_file:
+        return None
+    with field_file.open('rb') as file:
+        data = file.read()
+    _, writer_pool = get_pools()
+    future = writer_pool.submit(save_thumbnails, field_file.storage, field_file.name, data)
+    future.add_done_callback(report_thumbnail_error)
+    return future
+
+
+def report_thumbnail_error(future):
+    if future.exception() is not None:
+        print(f"Error generating avatar thumbnails: {future.exception()}")
@@ -0,0 +1,84 @@
+from django.db import transaction
+from django.db.models import Count, Exists, F, IntegerField, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Coalesce
+
+from messenger.models import Chatroom, ChatroomReadState, Message
+
+
+def create_read_states(chatroom_id, user_ids, last_read_message_id=None):
+    """
+    Строки курсоров для новых участников, чтобы отправка сообщения обходилась одним UPDATE.
+    last_read_message_id - последнее сообщение на момент входа: история до него не считается непрочитанной
+    """
+    ChatroomReadState.objects.bulk_create(
+        [ChatroomReadState(user_id=user_id, chatroom_id=chatroom_id, last_read_message_id=last_read_message_id)
+         for user_id in user_ids],
+        ignore_conflicts=True,
+    )
+
+
+def latest_message_id(chatroom_id):
+    return Message.objects.filter(chatroom_id=chatroom_id).order_by('-id').values_list('id', flat=True).first()
+
+
+def increment_unread(chatroom_id, sender_id, count=1):
+    # +count всем участникам, кроме отправителя
+    return ChatroomReadState.objects.filter(chatroom_id=chatroom_id) \
+        .exclude(user_id=sender_id) \
+        .update(unread_count=F('unread_count') + count)
+
+
+def decrement_unread(message):
+    # Удаляемое сообщение больше не непрочитанное у тех, чей курсор до него не дошел
+    return ChatroomReadState.objects.filter(chatroom_id=message.chatroom_id, unread_count__gt=0) \
+        .exclude(user_id=message.user_id) \
+        .filter(Q(last_read_message__isnull=True) | Q(last_read_message_id__lt=message.id)) \
+        .update(unread_count=F('unread_count') - 1)
+
+
+def unread_after(chatroom_id, user_id, last_read_message_id):
+    """Подзапрос: число чужих сообщений чата после курсора"""
+    messages = Message.objects.filter(chatroom_id=chatroom_id, id__gt=last_read_message_id).exclude(user_id=user_id)
+    count = messages.order_by().values('chatroom_id').annotate(count=Count('id')).values('count')
+    return Coalesce(Subquery(count, output_field=IntegerField()), Value(0))
+
+
+def mark_read(chatroom_id, user_id, up_to):
+    """
+    Сдвигает курсор пользователя до сообщения up_to и пересчитывает счетчик одним UPDATE.
+    Курсор только растет; возвращает False, если он уже дальше или up_to не из этого чата.
+    """
+    return ChatroomReadState.objects.filter(user_id=user_id, chatroom_id=chatroom_id) \
+        .filter(Q(last_read_message__isnull=True) | Q(last_read_message_id__lt=up_to)) \
+        .filter(Exists(Message.objects.filter(id=up_to, chatroom_id=chatroom_id))) \
+        .update(last_read_message_id=up_to, unread_count=unread_after(chatroom_id, user_id, up_to)) > 0
+
+
+def with_unread_count(queryset, user_id):
+    """Добавляет к чатам счетчик непрочитанных пользователя подзапросом, в том же запросе"""
+    unread_count = ChatroomReadState.objects.filter(chatroom_id=OuterRef('pk'), user_id=user_id) \
+        .values('unread_count')[:1]
+    return queryset.annotate(unread_count=Coalesce(Subquery(unread_count), Value(0)))
+
+
+def rebuild_unread_counts(batch_size=1000):
+    """Пересчитывает все счетчики по курсорам прочтения; строки для бывших участников удаляются"""
+    Participant = Chatroom.participants.through
+    last_read = ChatroomReadState.objects.filter(user_id=OuterRef('user_id'), chatroom_id=OuterRef('chatroom_id')) \
+        .values('last_read_message_id')[:1]
+    counts = Participant.objects \
+        .annotate(last_read=Subquery(last_read)) \
+        .annotate(unread_count=unread_after(OuterRef('chatroom_id'), OuterRef('user_id'),
+                                            Coalesce(OuterRef('last_read'), Value(0)))) \
+        .values_list('user_id', 'chatroom_id', 'last_read', 'unread_count')
+
+    with transaction.atomic():
+        states = [ChatroomReadState(user_id=user_id, chatroom_id=chatroom_id, last_read_message_id=last_read,
+                                    unread_count=unread_count)
+                  for user_id, chatroom_id, last_read, unread_count in counts.iterator(chunk_size=batch_size)]
+        ChatroomReadState.objects.bulk_create(states, batch_size=batch_size, update_conflicts=True,
+                                              unique_fields=['user', 'chatroom'], update_fields=['unread_count'])
+        ChatroomReadState.objects.filter(~Exists(
+            Participant.objects.filter(user_id=OuterRef('user_id'), chatroom_id=OuterRef('chatroom_id'))
+        )).delete()
+    return len(states)
@@ -0,0 +1,150 @@
+import io
+import json
+
+from django.conf import settings
+from django.core.exceptions import RequestAborted
+from django.core.files.uploadhandler import StopUpload, TemporaryFileUploadHandler
+from graphql import GraphQLError
+from PIL import Image
+
+ALLOWED_FORMATS = ('PNG', 'JPEG', 'GIF', 'WEBP')
+
+
+def get_upload_setting(name, default):
+    return getattr(settings, 'MESSENGER_UPLOADS', {}).get(name, default)
+
+
+class UploadRejected(GraphQLError):
+    pass
+
+
+def inspect_image_header(data, complete=False):
+    """
+    Формат и размеры изображения по заголовку: Image.open читает только его, пиксели не декодируются.
+    None - байтов пока мало для заголовка; complete=True - больше данных не будет
+    """
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            image_format, (width, height) = image.format, image.size
+    except Image.DecompressionBombError:
+        raise UploadRejected("Image dimensions are too large")
+    except Exception:
+        if not complete and len(data) < get_upload_setting('HEADER_SIZE', 256 * 1024):
+            return None
+        raise UploadRejected("Unsupported image format")
+
+    if image_format not in ALLOWED_FORMATS:
+        raise UploadRejected("Unsupported image format")
+    max_dimension = get_upload_setting('MAX_DIMENSION', 4096)
+    if width > max_dimension or height > max_dimension:
+        raise UploadRejected(f"Image must not exceed {max_dimension}x{max_dimension}")
+    return image_format, width, height
+
+
+def validate_avatar(upload):
+    """Проверка загруженного файла в резолвере: размер и заголовок, без чтения файла целиком"""
+    max_size = get_upload_setting('MAX_SIZE', 5 * 1024 * 1024)
+    if upload.size > max_size:
+        raise UploadRejected(f"File must not exceed {max_size} bytes")
+    upload.seek(0)
+    header = upload.read(get_upload_setting('HEADER_SIZE', 256 * 1024))
+    upload.seek(0)
+    inspect_image_header(header, complete=True)
+    return upload
+
+
+class AvatarUploadHandler(TemporaryFileUploadHandler):
+    """
+    Пишет файл из multipart-тела во временный файл кусками, память не зависит от размера файла.
+    Заголовок изображения проверяется по первым кускам, загрузка сверх MAX_SIZE обрывается.
+    Под ASGI Django читает тело целиком до upload handlers, поэтому размер тела там
+    ограничивает UploadLimitApp. Причина отказа сохраняется в request._upload_error
+    """
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.received = 0
+        self.header = b''
+
+    def receive_data_chunk(self, raw_data, start):
+        self.received += len(raw_data)
+        max_size = get_upload_setting('MAX_SIZE', 5 * 1024 * 1024)
+        if self.received > max_size:
+            self.reject(f"File must not exceed {max_size} bytes")
+
+        if self.header is not None:
+            self.header += raw_data
+            try:
+                if inspect_image_header(self.header) is not None:
+                    self.header = None  # заголовок проверен, дальше только пишем
+            except UploadRejected as e:
+                self.reject(e.message)
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        if self.header is not None:
+            try:
+                inspect_image_header(self.header, complete=True)
+            except UploadRejected as e:
+                self.reject(e.message)
+        return super().file_complete(file_size)
+
+    def reject(self, message):
+        self.file.close()  # временный файл удаляется при закрытии
+        self.request._upload_error = message
+        # Под WSGI остаток тела не читается; под ASGI он уже прочитан, но не больше лимита UploadLimitApp
+        raise StopUpload(connection_reset=True)
+
+
+class UploadLimitApp:
+    """
+    ASGI-приложение перед Django для маршрута загрузок: тело больше MAX_SIZE плюс MAX_BODY_OVERHEAD
+    (поля multipart) отклоняется с 413. Django сам читает тело целиком во временный файл до
+    upload handlers, поэтому лимит проверяется здесь: по Content-Length до чтения и по принятым байтам
+    """
+
+    def __init__(self, app, prefix):
+        self.app = app
+        self.prefix = prefix
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not scope['path'].startswith(self.prefix):
+            return await self.app(scope, receive, send)
+
+        max_size = get_upload_setting('MAX_SIZE', 5 * 1024 * 1024)
+        limit = max_size + get_upload_setting('MAX_BODY_OVERHEAD', 64 * 1024)
+        message = f"File must not exceed {max_size} bytes"
+        content_length = dict(scope['headers']).get(b'content-length')
+        if content_length is not None and content_length.isdigit() and int(content_length) > limit:
+            return await self.reject(send, message)
+
+        received = 0
+        started = False
+
+        async def limited_receive():
+            nonlocal received
+            event = await receive()
+            if event['type'] == 'http.request':
+                received += len(event.get('body', b''))
+                if received > limit:
+                    # Content-Length не было или он неверный: обрываем чтение на лимите
+                    if not started:
+                        await self.reject(send, message)
+                    raise RequestAborted()
+            return event
+
+        async def tracking_send(event):
+            nonlocal started
+            if event['type'] == 'http.response.start':
+                started = True
+            await send(event)
+
+        await self.app(scope, limited_receive, tracking_send)
+
+    @staticmethod
+    async def reject(send, message):
+        body = json.dumps({'errors': [{'message': message}]}).encode()
+        await send({'type': 'http.response.start', 'status': 413, 'headers': [
+            (b'content-type', b'application/json'), (b'content-length', str(len(body)).encode()),
+            (b'connection', b'close')]})
+        await send({'type': 'http.response.body', 'body': body})
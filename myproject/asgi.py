@@ -1,4 +1,5 @@
 import os
+from django.conf import settings
 from django.core.asgi import get_asgi_application
 from django.urls import path
 from channels.routing import ProtocolTypeRouter, URLRouter
@@ -6,14 +7,19 @@ from strawberry.asgi import GraphQL
 from strawberry.channels import GraphQLWSConsumer
 from strawberry.django.views import AsyncGraphQLView
 
+from messenger.media_server import MediaApp
 from messenger.strawberry import schema
+from messenger.uploads import UploadLimitApp
 
 os.environ.setdefault("DJANGO_SETTINGS_MODULE", "myproject.settings")
 
 graphql_ws_consumer = GraphQLWSConsumer(schema)
 
 application = ProtocolTypeRouter({
-    "http": get_asgi_application(),
+    # Файлы из MEDIA_ROOT отдаются без middleware и view, остальное - Django.
+    # Тело загрузки сверх лимита отклоняется до того, как Django запишет его на диск
+    "http": MediaApp(UploadLimitApp(get_asgi_application(), "/graphql/graphene/"),
+                     settings.MEDIA_ROOT, settings.MEDIA_URL),
     "websocket": (URLRouter([
         path("graphql/subscription/", graphql_ws_consumer.as_asgi(schema=schema)),
     ])),
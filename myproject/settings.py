@@ -158,6 +158,7 @@ GRAPHENE = {
     "MIDDLEWARE": [
         'graphql_jwt.middleware.JSONWebTokenMiddleware',
         "messenger.middlewares.GrapheneAuthMiddleware",
+        "messenger.middlewares.DataLoaderMiddleware",
     ],
     'EXECUTOR': 'graphql.execution.executors.asyncio.AsyncioExecutor',
     'CONTEXT': 'myproject.context.get_context'
@@ -166,5 +167,89 @@ GRAPHENE = {
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Файлы появляются в MEDIA_ROOT атомарно и хранятся под хэшем содержимого: одинаковые
+# загрузки занимают место один раз. Файлы без ссылок удаляет manage.py collect_media_garbage
+STORAGES = {
+    'default': {'BACKEND': 'messenger.storage.ContentAddressedStorage'},
+    'staticfiles': {'BACKEND': 'django.contrib.staticfiles.storage.StaticFilesStorage'},
+}
+
+# Загрузки пишутся во временный файл кусками, заголовок и размер проверяются по ходу загрузки
+FILE_UPLOAD_HANDLERS = ['messenger.uploads.AvatarUploadHandler']
+MESSENGER_UPLOADS = {
+    'MAX_SIZE': 5 * 1024 * 1024,
+    # Запас на поля multipart сверх MAX_SIZE: тело больше MAX_SIZE + MAX_BODY_OVERHEAD получает 413
+    'MAX_BODY_OVERHEAD': 64 * 1024,
+    'MAX_DIMENSION': 4096,
+    'HEADER_SIZE': 256 * 1024,
+}
+
+# Превью аватаров в WebP, квадраты со стороной THUMBNAIL_SIZES пикселей.
+# Строятся при загрузке в пуле из WORKERS процессов
+MESSENGER_AVATARS = {
+    'THUMBNAIL_SIZES': (64, 256),
+    'QUALITY': 80,
+    'WORKERS': 2,
+}
+
 AUTH_USER_MODEL = 'messenger.User'
 
+# Очереди подписчиков ограничены, политика для медленных клиентов:
+# drop_oldest, drop_newest или disconnect.
+# Счетчики delivered/dropped/evicted раз в STATS_INTERVAL секунд пишутся в лог
+# и передаются в STATS_HOOK (путь к функции, принимающей dict), если он задан.
+# Отметки о прочтении копятся READ_RECEIPT_WINDOW секунд и рассылаются пачкой на чат
+MESSENGER_SUBSCRIPTIONS = {
+    'QUEUE_SIZE': 100,
+    'SLOW_CONSUMER_POLICY': 'drop_oldest',
+    'STATS_INTERVAL': 60,
+    'STATS_HOOK': None,
+    'READ_RECEIPT_WINDOW': 0.5,
+}
+
+# Запросы на чтение и подписки доверяют claims из подписанного access-токена и не ходят в базу.
+# Мутации берут пользователя из кэша, запись живет USER_CACHE_TTL секунд. Кэш у каждого процесса свой
+# и сбрасывается только в процессе, где пользователь изменен: перед записью строку нужно перечитать
+MESSENGER_AUTH = {
+    'STATELESS_READS': True,
+    'USER_CACHE_TTL': 30,
+    'USER_CACHE_SIZE': 1024,
+}
+
+# Замер блокировок event loop синхронным кодом (по умолчанию только в DEBUG).
+# Опоздания дольше THRESHOLD секунд пишутся в лог и передаются в HOOK
+MESSENGER_LOOP_MONITOR = {
+    'ENABLED': DEBUG,
+    'INTERVAL': 0.1,
+    'THRESHOLD': 0.05,
+    'HOOK': None,
+}
+
+# Максимальный размер страницы для курсорной пагинации сообщений
+MESSENGER_PAGINATION = {
+    'MAX_PAGE_SIZE': 100,
+}
+
+# Одновременные sendMessage за BATCH_WINDOW секунд сохраняются одной вставкой;
+# MAX_BATCH_SIZE - предел пачки и числа сообщений в одном sendMessages
+MESSENGER_MESSAGES = {
+    'BATCH_WINDOW': 0.005,
+    'MAX_BATCH_SIZE': 500,
+}
+
+MESSENGER_BROADCAST = {
+    'BACKEND': 'messenger.broadcast.InMemoryBroadcast',
+}
+
+# Для нескольких воркеров сообщения рассылаются через Redis
+if os.environ.get('REDIS_URL'):
+    CHANNEL_LAYERS = {
+        'default': {
+            'BACKEND': 'channels_redis.core.RedisChannelLayer',
+            'CONFIG': {
+                'hosts': [os.environ['REDIS_URL']],
+            },
+        },
+    }
+    MESSENGER_BROADCAST['BACKEND'] = 'messenger.broadcast.ChannelLayerBroadcast'
+
@@ -1,14 +1,14 @@
 import logging
 
 from django.contrib import admin
-from django.urls import path
+from django.urls import path, re_path
 from django.conf import settings
-from django.conf.urls.static import static
 from strawberry.django.views import AsyncGraphQLView
 
 from messenger.CustomGraphQLView import CustomGraphQLView
 from messenger.deleteCookie import delete_http_only_cookie
 from messenger.graphene import graphene_schema
+from messenger.media_server import serve_media
 from messenger.strawberry import schema as strawberry_schema
 
 
@@ -19,4 +19,6 @@ urlpatterns = [
     # Strawberry маршруты
     path("graphql/strawberry/", AsyncGraphQLView.as_view(schema=strawberry_schema)),
     path('delete-http-only-cookie/', delete_http_only_cookie, name='delete_http_only_cookie'),
-] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
\ No newline at end of file
+    # Медиа с ETag, Range и кэшированием. Под ASGI эти запросы перехватывает MediaApp до Django
+    re_path(rf"^{settings.MEDIA_URL.lstrip('/')}(?P<path>.*)$", serve_media),
+]
\ No newline at end of file